@@ -0,0 +1,28 @@
+// SPDX-License-Identifier: MIT
+pragma solidity ^0.8.0;
+
+contract HashStorageV2 {
+    // block timestamp of the first anchor of each digest, 0 if never anchored
+    mapping(bytes32 => uint256) public anchoredAt;
+    uint256 public recordCount;
+
+    // same fields as v1, with the raw SHA-256 digest instead of its hex string
+    event HashStored(bytes32 indexed hash, uint256 timestamp, uint index);
+
+    function storeHash(bytes32 hashValue) public {
+        _store(hashValue);
+    }
+
+    function storeHashes(bytes32[] calldata hashValues) external {
+        for (uint i = 0; i < hashValues.length; i++) {
+            _store(hashValues[i]);
+        }
+    }
+
+    function _store(bytes32 hashValue) private {
+        if (anchoredAt[hashValue] == 0) {
+            anchoredAt[hashValue] = block.timestamp;
+        }
+        emit HashStored(hashValue, block.timestamp, recordCount++);
+    }
+}
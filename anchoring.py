@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from merkle import MerkleTree
+
+logger = logging.getLogger(__name__)
+
+
+class AnchorBatcher:
+    """
+    Collects file hashes and anchors a single Merkle root for the whole batch.
+
+    A batch is flushed once `max_size` hashes are pending or `max_wait`
+    seconds after the first hash of the batch arrived, whichever comes first.
+    `anchor` is an async callable that takes the root hex string and returns
+    the store_hash info dict of the transaction that stored it.
+    """
+
+    def __init__(self, anchor, max_size: int = 16, max_wait: float = 5.0):
+        self._anchor = anchor
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, file_hash: str) -> dict:
+        """
+        Queue `file_hash` for the next batch and wait until that batch is
+        anchored. Returns the store_hash info plus `merkle_root` and
+        `merkle_proof` for this file.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((file_hash, future))
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        task = asyncio.ensure_future(self._anchor_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _anchor_batch(self, batch):
+        tree = MerkleTree([file_hash for file_hash, _ in batch])
+        logger.info(f"Anchoring batch of {len(batch)} hashes, root {tree.root}")
+
+        try:
+            store_hash_info = await self._anchor(tree.root)
+        except Exception as e:
+            logger.error(f"Error anchoring batch {tree.root}: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for index, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result({
+                    **store_hash_info,
+                    "merkle_root": tree.root,
+                    "merkle_proof": tree.proof(index)
+                })
+
+    async def close(self):
+        """Flush whatever is pending and wait for in-flight batches."""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
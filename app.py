@@ -1,49 +1,95 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
+from fastapi import (
+    FastAPI, HTTPException, UploadFile, File, Form, Depends, Header, Query,
+    Request, Response)
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from web3 import Web3
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from web3.exceptions import ContractLogicError
 import json
 import os
 from dotenv import load_dotenv
-from pydantic import BaseModel
-from pinata_helper import upload_to_pinata, get_from_pinata
+from pydantic import BaseModel, TypeAdapter
+from pinata_helper import (
+    PINATA_CID_VERSION, PINATA_GATEWAY_URL, PinataClient, PinataError,
+    PinBatcher)
 from database import SessionLocal, engine
 import crud
+import migrations
 import models
 import schemas
 import logging
-from sqlalchemy.orm import Session
+import metrics
+from log_config import setup_logging
+from sqlalchemy.ext.asyncio import AsyncSession
 import hashlib
 import datetime
-import io
-from encrypt_and_hash import decrypt_file_from_link
+from encrypt_and_hash import (
+    decrypt_range_from_file, decrypt_range_from_link, open_encrypted_file_range,
+    open_encrypted_range, stream_decrypt_from_file, stream_decrypt_from_link)
+from cryptography.exceptions import InvalidTag
+from anchoring import AnchorBatcher
+from auth import CredentialCache, SessionTokens
+from cid_cache import CIDCache, GatewayFetcher, is_cid
+from cpu_executor import CPUExecutor, Overloaded
+import merkle
+from chain import (
+    w3, contract, contract_v2, HASH_STORED_TOPIC, HASH_STORED_V2_TOPIC,
+    check_nonces, connect, decode_hash_stored, disconnect, fee_oracle,
+    get_anchored_at, get_transaction_receipts, send_store_hash,
+    wait_for_store_hash)
+from indexer import HashStoredIndexer
+from lru_cache import LRUCache
+from singleflight import SingleFlight
+from unixfs import CIDBuilder
+from jobs import JobQueue
+import jobs
+import asyncio
+import base64
+import functools
+import time
+import secrets
+import uuid
+from typing import List, Union
 
 load_dotenv()
 
 
 app = FastAPI()
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("app.log"),
-        logging.StreamHandler()
-    ]
-)
+# records go through a queue and are written on a background thread, as
+# JSON lines unless LOG_FORMAT is "text"; LOG_FILE="" logs to stderr only
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+log_listener = setup_logging(LOG_LEVEL, LOG_FILE, LOG_FORMAT)
 
 logger = logging.getLogger(__name__)
+# aiosqlite logs every statement at DEBUG
+logging.getLogger("aiosqlite").setLevel(logging.INFO)
 
-models.Base.metadata.create_all(bind=engine)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+@app.on_event("startup")
+async def init_db():
+    async with engine.begin() as connection:
+        await connection.run_sync(models.Base.metadata.create_all)
+        await connection.run_sync(migrations.run_migrations)
+
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # the route template, not the path, keeps the number of series bounded
+    route = request.scope.get('route')
+    metrics.HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - start, method=request.method,
+        route=route.path if route else 'unmatched', status=response.status_code)
+    return response
 
 
 # Add CORS middleware
@@ -55,28 +101,147 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-infura_id = os.getenv('INFURA_ID')
-if not infura_id:
-    raise Exception("INFURA_ID is not set!")
 
-w3 = Web3(Web3.HTTPProvider(f'https://sepolia.infura.io/v3/{infura_id}'))
+@app.on_event("startup")
+async def connect_chain():
+    await connect()
 
-if not w3.is_connected():
-    raise Exception("Failed to connect to Ethereum network!")
 
-contract_abi_path = os.path.join(
-    'compiled_contract',
-    'HashStorage_sol_HashStorage.abi')
+@app.on_event("shutdown")
+async def disconnect_chain():
+    await disconnect()
 
-with open(contract_abi_path, 'r') as file:
-    contract_abi = json.load(file)
 
-contract_address = Web3.to_checksum_address(
-    '0xC2fba0A73D9843f109e235e985648207792Ce18f')
-contract = w3.eth.contract(address=contract_address, abi=contract_abi)
+ADMIN_KEY = os.getenv('ADMIN_KEY')
 
+# "single" sends one storeHash transaction per upload, "batch" anchors the
+# Merkle root of up to ANCHOR_BATCH_SIZE uploads collected over
+# ANCHOR_BATCH_WINDOW seconds in one transaction
+ANCHOR_MODE = os.getenv('ANCHOR_MODE', 'single')
+ANCHOR_BATCH_SIZE = int(os.getenv('ANCHOR_BATCH_SIZE', '16'))
+ANCHOR_BATCH_WINDOW = float(os.getenv('ANCHOR_BATCH_WINDOW', '5'))
+
+# upload jobs (/upload?async_job=true) are spooled here and run by
+# JOB_WORKERS background workers
+JOB_SPOOL_DIR = os.getenv('JOB_SPOOL_DIR', './job_spool')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+# a worker holds a lease of JOB_LEASE seconds on the job it runs and renews it
+# while it is alive, jobs of a worker that died are taken over once it expires
+JOB_LEASE = float(os.getenv('JOB_LEASE', '60'))
+JOB_OWNER = uuid.uuid4().hex  # this process, in upload_jobs.owner
+JOB_EVENTS_KEEPALIVE = 15
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+DECRYPT_CHUNK_SIZE = 1024 * 1024
+
+# how often stuck transactions and nonce gaps of the sending account are
+# looked for, see chain.check_nonces
+NONCE_CHECK_INTERVAL = int(os.getenv('NONCE_CHECK_INTERVAL', '30'))
+# how often to poll for a new head to refresh the cached fees
+FEE_REFRESH_INTERVAL = float(os.getenv('FEE_REFRESH_INTERVAL', '4'))
+
+# decoded HashStored events by tx hash, confirmed receipts never change
+verify_cache = LRUCache(int(os.getenv('VERIFY_CACHE_SIZE', '4096')))
+# items one /verify/batch request may check
+VERIFY_BATCH_MAX = int(os.getenv('VERIFY_BATCH_MAX', '1000'))
+
+# background copy of all HashStored events for /verify-by-hash, starting at
+# INDEXER_START_BLOCK (the contract's deployment block). It has no default,
+# from genesis eth_getLogs would crawl all of Sepolia, so the indexer only
+# runs once it is set. One process should run it, set INDEXER_ENABLED=0 on
+# the other workers.
+INDEXER_ENABLED = os.getenv('INDEXER_ENABLED', '1') == '1'
+INDEXER_START_BLOCK = os.getenv('INDEXER_START_BLOCK')
+INDEXER_START_BLOCK = int(INDEXER_START_BLOCK) if INDEXER_START_BLOCK else None
+INDEXER_POLL_INTERVAL = float(os.getenv('INDEXER_POLL_INTERVAL', '12'))
+
+# uploads arriving within PIN_BATCH_WINDOW seconds of each other are pinned
+# as one directory of up to PIN_BATCH_SIZE files, 1 pins every file alone
+PIN_BATCH_SIZE = int(os.getenv('PIN_BATCH_SIZE', '1'))
+PIN_BATCH_WINDOW = float(os.getenv('PIN_BATCH_WINDOW', '0.2'))
+
+# pinned ciphertexts are kept on disk by CID, up to CID_CACHE_MAX_BYTES.
+# /decrypt reads misses from whichever of IPFS_GATEWAYS answers first and
+# keeps the download if it matches the CID
+CID_CACHE_DIR = os.getenv('CID_CACHE_DIR', './cid_cache')
+CID_CACHE_MAX_BYTES = int(os.getenv('CID_CACHE_MAX_BYTES', str(1024 ** 3)))
+IPFS_GATEWAYS = [
+    gateway.strip() for gateway in os.getenv(
+        'IPFS_GATEWAYS',
+        f'{PINATA_GATEWAY_URL},https://ipfs.io,https://dweb.link').split(',')
+    if gateway.strip()]
+GATEWAY_TIMEOUT = float(os.getenv('GATEWAY_TIMEOUT', '60'))
+
+# /login issues session tokens signed with SESSION_SECRET that are valid for
+# SESSION_TTL seconds. Username/password checks of the other endpoints are
+# remembered for AUTH_CACHE_TTL seconds. Revocations by /reset-all-data are
+# kept in the database and reach the other workers within
+# SESSION_STATE_REFRESH seconds
+SESSION_SECRET = os.getenv('SESSION_SECRET')
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(12 * 3600)))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '60'))
+SESSION_STATE_REFRESH = float(os.getenv('SESSION_STATE_REFRESH', '5'))
+
+if not SESSION_SECRET:
+    logger.warning("SESSION_SECRET not set, sessions are signed with a key "
+                   "generated into the database")
+session_tokens = SessionTokens(SESSION_SECRET, SESSION_TTL)
+credential_cache = CredentialCache(ttl=AUTH_CACHE_TTL)
+
+
+async def refresh_session_state():
+    """Load the signing key and revocation time all workers share."""
+    async with SessionLocal() as db:
+        state = await crud.get_session_state(db, secrets.token_hex(32))
+    if not SESSION_SECRET:
+        session_tokens.set_secret(state.secret)
+    if state.not_before != session_tokens.not_before:
+        # revoked by another worker, its users may have been recreated
+        session_tokens.not_before = state.not_before
+        credential_cache.clear()
+
+
+async def run_session_state_refresh():
+    while True:
+        await asyncio.sleep(SESSION_STATE_REFRESH)
+        try:
+            await refresh_session_state()
+        except Exception as e:
+            logger.error(f"Error refreshing session state: {str(e)}")
 
-ADMIN_KEY = os.getenv('ADMIN_KEY')
+
+@app.on_event("startup")
+async def start_session_state_refresh():
+    await refresh_session_state()
+    app.state.session_state_refresh = asyncio.create_task(
+        run_session_state_refresh())
+
+
+@app.on_event("shutdown")
+async def stop_session_state_refresh():
+    app.state.session_state_refresh.cancel()
+
+# largest page of /transactions?limit=
+TRANSACTIONS_PAGE_MAX = int(os.getenv('TRANSACTIONS_PAGE_MAX', '1000'))
+# serialized /transactions responses by user, transactions version and page
+transactions_cache = LRUCache(int(os.getenv('TRANSACTIONS_CACHE_SIZE', '1024')))
+transactions_adapter = TypeAdapter(list[schemas.Transaction])
+
+# hashing and decryption run in a pool of CPU_WORKERS threads, at most
+# CPU_HASH_CONCURRENCY / CPU_DECRYPT_CONCURRENCY at a time with up to
+# CPU_QUEUE_MAX more waiting per operation, beyond that requests get a 503.
+# Both also read files, so the pool defaults to a few more threads than cores
+CPU_WORKERS = int(os.getenv('CPU_WORKERS') or min(32, (os.cpu_count() or 1) + 4))
+CPU_HASH_CONCURRENCY = int(os.getenv('CPU_HASH_CONCURRENCY') or CPU_WORKERS)
+CPU_DECRYPT_CONCURRENCY = int(os.getenv('CPU_DECRYPT_CONCURRENCY') or CPU_WORKERS)
+CPU_QUEUE_MAX = int(os.getenv('CPU_QUEUE_MAX', '64'))
+cpu_executor = CPUExecutor(
+    CPU_WORKERS,
+    {'hash': CPU_HASH_CONCURRENCY, 'decrypt': CPU_DECRYPT_CONCURRENCY},
+    max_queue=CPU_QUEUE_MAX)
+
+# uploads above this size are rejected with 413, unset means no limit
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES')) \
+    if os.getenv('MAX_UPLOAD_BYTES') else None
 
 
 class HashData(BaseModel):
@@ -84,20 +249,28 @@ class HashData(BaseModel):
 
 
 @app.delete("/reset-all-data/{admin_key}")
-def reset_instructors_test_data(admin_key: str):
+async def reset_instructors_test_data(admin_key: str):
     if not admin_key == os.getenv('ADMIN_KEY'):
         raise HTTPException(status_code=404, detail="Invalid key")
 
-    models.Base.metadata.drop_all(
-        bind=engine,
-        tables=[
-            models.User.__table__,
-            models.Transaction.__table__])
-    models.Base.metadata.create_all(
-        bind=engine,
-        tables=[
-            models.User.__table__,
-            models.Transaction.__table__])
+    tables = [
+        models.User.__table__,
+        models.Transaction.__table__,
+        models.UploadJob.__table__]
+    async with engine.begin() as connection:
+        await connection.run_sync(
+            lambda sync_connection: models.Base.metadata.drop_all(
+                bind=sync_connection, tables=tables))
+        await connection.run_sync(
+            lambda sync_connection: models.Base.metadata.create_all(
+                bind=sync_connection, tables=tables))
+    not_before = time.time()
+    async with SessionLocal() as db:
+        await crud.set_sessions_not_before(db, not_before)
+    verify_cache.clear()
+    transactions_cache.clear()
+    credential_cache.clear()
+    session_tokens.not_before = not_before
     return {"message": "All tables have been reset."}
 
 
@@ -105,228 +278,957 @@ def reset_instructors_test_data(admin_key: str):
 async def register(
         username: str,
         password: str,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
     try:
-        user = crud.get_user(db, username)
+        user = await crud.get_user(db, username)
         if user:
             raise HTTPException(status_code=400, detail="User already exists")
 
         pass_hash = get_password_hash(password)
 
         db_user = schemas.UserCreate(uname=username, pass_hash=pass_hash)
-        user = crud.create_user(db, db_user)
-        user_schema = schemas.User.from_orm(user)
+        user = await crud.create_user(db, db_user)
+        # a new user has no transactions, don't lazy load them
+        user_schema = schemas.User(
+            id=user.id, uname=user.uname, pass_hash=user.pass_hash)
         return user_schema
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in register: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/transactions/{username}", response_model=list[schemas.Transaction])
-async def transactions(username: str, password: str,
-                       db: Session = Depends(get_db)):
-    try:
-        user = crud.get_user(db, username)
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        if not user.pass_hash == get_password_hash(password):
-            raise HTTPException(status_code=401, detail="Invalid password")
+@app.post("/login", response_model=schemas.Token)
+async def login(
+        username: str,
+        password: str,
+        db: AsyncSession = Depends(get_db)
+):
+    user_id = await check_password(db, username, password)
+    return schemas.Token(
+        access_token=session_tokens.issue(user_id, username),
+        expires_in=SESSION_TTL)
 
-        user_transactions = crud.get_user_transactions(db, user.id)
-        user_transactions = [schemas.Transaction.from_orm(
-            transaction) for transaction in user_transactions]
-        user_transactions = new_list = sorted(user_transactions, key=lambda x: x.timestamp, reverse=True) #latest timestamp first
-        return user_transactions
 
+@app.get("/transactions/{username}", response_model=list[schemas.Transaction])
+async def transactions(username: str, request: Request,
+                       password: str = None,
+                       limit: int = Query(None, ge=1, le=TRANSACTIONS_PAGE_MAX),
+                       after: str = None,
+                       authorization: str = Header(None),
+                       db: AsyncSession = Depends(get_db)):
+    """
+    The user's transactions, latest first. With `limit`, one page at a time:
+    the X-Next-Cursor header of a full page is the `after` of the next one.
+
+    The ETag is the user's transactions version, so polls sending it back in
+    If-None-Match get a 304 until a new transaction is recorded. Responses
+    are cached serialized for each version.
+    """
+    try:
+        user_id = await authenticate(db, authorization, username, password)
+
+        version = await crud.get_transactions_version(db, user_id)
+        etag = f'"{user_id}.{version}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag_matches(request.headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=headers)
+
+        key = (user_id, version, limit, after)
+        cached = transactions_cache.get(key)
+        if cached is None:
+            cursor = decode_transactions_cursor(after) if after else None
+            # one extra row tells whether there is a next page
+            user_transactions = await crud.get_user_transactions(
+                db, user_id, limit=limit + 1 if limit else None, after=cursor)
+            next_cursor = None
+            if limit and len(user_transactions) > limit:
+                user_transactions = user_transactions[:limit]
+                next_cursor = encode_transactions_cursor(user_transactions[-1])
+            body = transactions_adapter.dump_json(
+                [schemas.Transaction.from_orm(transaction)
+                 for transaction in user_transactions])
+            cached = (body, next_cursor)
+            transactions_cache.put(key, cached)
+
+        body, next_cursor = cached
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        return Response(
+            content=body, media_type="application/json", headers=headers)
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in transactions: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/upload", response_model=schemas.UploadResponse)
+@app.post("/upload",
+          response_model=Union[schemas.UploadResponse, schemas.UploadJob])
 async def upload(
         filename: str,
-        email: str,
-        password: str,
         decrypt_key_first_last_5: str,
+        email: str = None,
+        password: str = None,
         encrypted_file: UploadFile = File(...),
-        db: Session = Depends(get_db)
+        async_job: bool = False,
+        authorization: str = Header(None),
+        db: AsyncSession = Depends(get_db)
 ):
     try:
-        user = crud.get_user(db, email)
-        if not user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        if not user.pass_hash == get_password_hash(password):
-            raise HTTPException(status_code=401, detail="Invalid password")
-        
+        user_id = await authenticate(db, authorization, email, password)
         file_name = filename
-        file_content = await encrypted_file.read()
 
-        ipfs_hash = upload_to_pinata(file_content)
-        ipfs_link = get_ipfs_link(ipfs_hash)
+        if async_job:
+            # persist the job and return right away, workers pin and anchor
+            job = await create_upload_job(
+                db, user_id, file_name, decrypt_key_first_last_5,
+                encrypted_file)
+            upload_jobs.enqueue(job.id)
+            return schemas.UploadJob.from_orm(job)
+
+        # hash before pinning, a file uploaded before is neither pinned nor
+        # anchored again
+        get_upload_size(encrypted_file)
+        reader = HashingReader(encrypted_file.file, MAX_UPLOAD_BYTES)
+        with metrics.stage('hashing'):
+            await run_cpu('hash', drain, reader)
+        file_hash = reader.hexdigest()
+        cid = reader.cid()
+        size = reader.bytes_read
+        pin_bytes_per_sec = None
+
+        async def pin():
+            nonlocal pin_bytes_per_sec
+            started = time.perf_counter()
+            pinned = await pin_file(encrypted_file.file, size)
+            elapsed = time.perf_counter() - started
+            pin_bytes_per_sec = size / max(elapsed, 1e-9)
+            logger.info(
+                f"Pinned {size} bytes in {elapsed:.3f}s "
+                f"({pin_bytes_per_sec:.0f} B/s)")
+            return pinned
+
+        async def pin_and_anchor():
+            # the CID is known before Pinata answers, so pinning runs
+            # alongside anchoring instead of before it
+            pinning = asyncio.ensure_future(pin())
+            try:
+                store_hash_info = await anchor_file_hash(file_hash)
+            except BaseException:
+                pinning.cancel()
+                raise
+            try:
+                ipfs_hash = check_pinned_cid(cid, await pinning)
+            except PinataError as e:
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"Failed to upload to IPFS: {str(e)}")
+            transaction = await record_transaction(
+                db, user_id, file_name, file_hash, decrypt_key_first_last_5,
+                ipfs_hash, store_hash_info)
+            return transaction.id
+
+        transaction = await crud.get_transaction_by_file_hash(db, file_hash)
+        deduplicated = transaction is not None
+        if not deduplicated:
+            # end the read transaction, pinning and anchoring don't need a
+            # connection from the pool
+            await db.commit()
+            # concurrent uploads of the same file wait for the first one
+            transaction_id, deduplicated = await upload_flights.do(
+                file_hash, pin_and_anchor)
+            transaction = await crud.get_transaction_by_id(db, transaction_id)
+        if deduplicated:
+            transaction = await record_reference(
+                db, transaction, user_id, file_name, decrypt_key_first_last_5)
+
+        await cache_ciphertext(
+            get_ipfs_hash(transaction.bc_file_link), encrypted_file.file)
+
+        response_data = get_upload_response(transaction)
+        response_data.size_bytes = size
+        response_data.pin_bytes_per_sec = pin_bytes_per_sec
+        response_data.deduplicated = deduplicated
+        return response_data
 
-        if not ipfs_hash:
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to upload to IPFS")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in upload: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        file_hash = get_file_hash(file_content)
 
-        store_hash_info = await store_hash(HashData(hash_value=file_hash))
-        timestamp = convert_unix_to_datetime(store_hash_info['timestamp'])
+# identical uploads in flight, keyed by file hash
+upload_flights = SingleFlight()
+
+
+async def record_transaction(db: AsyncSession, user_id: int, file_name: str,
+                       file_hash: str, decrypt_key_first_last_5: str,
+                       ipfs_hash: str, store_hash_info: dict,
+                       job: models.UploadJob = None):
+    ipfs_link = get_ipfs_link(ipfs_hash)
+    timestamp = convert_unix_to_datetime(store_hash_info['timestamp'])
+    anchored_at = migrations.parse_anchored_at(
+        timestamp, store_hash_info['timestamp'])
+    merkle_proof = store_hash_info.get('merkle_proof')
+
+    db_transaction = schemas.TransactionCreate(
+        user_id=user_id,
+        file_name=file_name,
+        file_hash=file_hash,
+        tr_hash=store_hash_info['tx_hash'],
+        bc_hash_link=store_hash_info['etherscan_url'],
+        bc_file_link=ipfs_link,
+        decrypt_key_first_last_5=decrypt_key_first_last_5,
+        timestamp=timestamp,
+        anchored_at=anchored_at,
+        merkle_root=store_hash_info.get('merkle_root'),
+        merkle_proof=json.dumps(merkle_proof) if merkle_proof is not None else None
+    )
+    event = store_hash_info.get('event')
+    if event:
+        db_transaction.onchain_hash = event['hash']
+        db_transaction.record_index = event['index']
+        db_transaction.block_number = event['block_number']
+        db_transaction.log_index = event['log_index']
+        db_transaction.block_timestamp = event['timestamp']
+
+    with metrics.stage('db_write'):
+        return await crud.create_transaction(db, db_transaction, job)
+
+
+async def record_reference(db: AsyncSession, source: models.Transaction, user_id: int,
+                     file_name: str, decrypt_key_first_last_5: str,
+                     job: models.UploadJob = None):
+    """Give `user_id` its own row for a file pinned and anchored before."""
+    db_transaction = schemas.TransactionCreate.model_validate(
+        source, from_attributes=True).model_copy(update={
+            "user_id": user_id,
+            "file_name": file_name,
+            "decrypt_key_first_last_5": decrypt_key_first_last_5
+        })
+    with metrics.stage('db_write'):
+        return await crud.create_transaction(db, db_transaction, job)
 
-        response_data = schemas.UploadResponse(
-            file_name=file_name,
-            file_hash=file_hash,
-            tx_hash=store_hash_info['tx_hash'],
-            etherscan_url=store_hash_info['etherscan_url'],
-            timestamp=timestamp,
-            ipfs_hash=ipfs_hash,
-            ipfs_link=ipfs_link
-        )
 
-        db_transaction = schemas.TransactionCreate(
-            user_id=user.id,
-            file_name=file_name,
-            file_hash=file_hash,
-            tr_hash=store_hash_info['tx_hash'],
-            bc_hash_link=store_hash_info['etherscan_url'],
-            bc_file_link=ipfs_link,
-            decrypt_key_first_last_5=decrypt_key_first_last_5,
-            timestamp=timestamp
-        )
+def get_upload_response(transaction: models.Transaction):
+    return schemas.UploadResponse(
+        file_name=transaction.file_name,
+        file_hash=transaction.file_hash,
+        tx_hash=transaction.tr_hash,
+        etherscan_url=transaction.bc_hash_link,
+        timestamp=transaction.timestamp,
+        ipfs_hash=get_ipfs_hash(transaction.bc_file_link),
+        ipfs_link=transaction.bc_file_link,
+        merkle_root=transaction.merkle_root,
+        merkle_proof=json.loads(transaction.merkle_proof)
+        if transaction.merkle_proof else None
+    )
+
+
+# === UPLOAD JOBS ===
+async def create_upload_job(db: AsyncSession, user_id: int, file_name: str,
+                            decrypt_key_first_last_5: str,
+                            encrypted_file: UploadFile):
+    job_id = uuid.uuid4().hex
+    os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+    spool_path = os.path.join(JOB_SPOOL_DIR, job_id)
+
+    # spool the ciphertext to disk so the job survives a restart
+    get_upload_size(encrypted_file)
+    reader = HashingReader(encrypted_file.file, MAX_UPLOAD_BYTES)
+    with metrics.stage('hashing'):
+        await run_cpu('hash', spool_upload, reader, spool_path)
+
+    job = models.UploadJob(
+        id=job_id,
+        user_id=user_id,
+        file_name=file_name,
+        file_hash=reader.hexdigest(),
+        decrypt_key_first_last_5=decrypt_key_first_last_5,
+        spool_path=spool_path,
+        status=jobs.JOB_QUEUED,
+        ipfs_hash=reader.cid()  # link works once the job is pinned
+    )
+    return await crud.create_upload_job(db, job)
+
+
+pinata = PinataClient()
+pin_batcher = PinBatcher(
+    pinata, max_size=PIN_BATCH_SIZE, max_wait=PIN_BATCH_WINDOW)
+
+
+@app.on_event("startup")
+async def start_pinata():
+    await pinata.start()
+
+
+@app.on_event("shutdown")
+async def close_pinata():
+    await pin_batcher.close()
+    await pinata.close()
+
+
+async def pin_file(fileobj, size: int) -> str:
+    if PIN_BATCH_SIZE > 1:
+        return await pin_batcher.submit(fileobj, size)
+    return await pinata.pin_file(fileobj, size)
+
+
+def check_pinned_cid(cid: str, pinned: str) -> str:
+    """The CID to link to: ours, unless Pinata pinned the file as another."""
+    if cid is None:
+        return pinned
+    if '/' in pinned:
+        # pinned inside a directory batch, the file keeps its own CID
+        return cid
+    if pinned != cid:
+        logger.error(f"Pinata pinned {pinned}, computed CID is {cid}")
+    return pinned
 
-        crud.create_transaction(db, db_transaction)
-        return response_data
 
+async def pin_spooled_file(spool_path: str) -> str:
+    with open(spool_path, 'rb') as spool:
+        return await pin_file(spool, os.path.getsize(spool_path))
+
+
+cid_cache = CIDCache(CID_CACHE_DIR, CID_CACHE_MAX_BYTES)
+gateway_fetcher = GatewayFetcher(IPFS_GATEWAYS, timeout=GATEWAY_TIMEOUT)
+
+
+@app.on_event("startup")
+async def start_gateway_fetcher():
+    await gateway_fetcher.start()
+
+
+@app.on_event("shutdown")
+async def close_gateway_fetcher():
+    await gateway_fetcher.close()
+
+
+async def cache_ciphertext(ipfs_hash: str, fileobj=None, spool_path: str = None):
+    """
+    Keep a pinned ciphertext in the CID cache, copied from `fileobj` or
+    moved from `spool_path`. Whatever `ipfs_hash` links to is these bytes,
+    so this works for deduplicated uploads too. Failures are only logged.
+    """
+    if not is_cid(ipfs_hash):
+        return  # pinned inside a directory batch before CIDs were computed
+    try:
+        if spool_path is not None:
+            await asyncio.to_thread(cid_cache.add, ipfs_hash, spool_path)
+        else:
+            await asyncio.to_thread(cid_cache.put, ipfs_hash, fileobj)
     except Exception as e:
-        logger.error(f"Error in upload: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.warning(f"Could not cache {ipfs_hash}: {str(e)}")
 
 
-@app.post("/store-hash/")
-async def store_hash(data: HashData):
+def get_cached_ciphertext(encrypted_file_link: str):
+    """Local path of the ciphertext behind an IPFS link, None on a miss."""
+    cid = get_ipfs_hash(encrypted_file_link)
+    if not is_cid(cid):
+        return None
+    return cid_cache.get(cid)
+
+
+async def get_gateway_link(encrypted_file_link: str) -> str:
+    """
+    Where to read an uncached ciphertext from: its CID on the first of
+    IPFS_GATEWAYS to answer, or the link itself.
+    """
+    cid = get_ipfs_hash(encrypted_file_link)
+    if not is_cid(cid):
+        return encrypted_file_link
+    return await gateway_fetcher.fastest(cid) or encrypted_file_link
+
+
+async def set_job_status(db: AsyncSession, job: models.UploadJob, **fields):
+    with metrics.stage('db_write'):
+        job = await crud.update_upload_job(db, job, **fields)
+    upload_jobs.publish(
+        job.id, schemas.UploadJob.from_orm(job).model_dump(mode='json'))
+    return job
+
+
+async def run_upload_job(job_id: str):
+    lease = datetime.timedelta(seconds=JOB_LEASE)
+    async with SessionLocal() as db:
+        job = await crud.claim_upload_job(
+            db, job_id, JOB_OWNER, lease, jobs.TERMINAL_STATES)
+        if job is None:
+            return  # finished, or running elsewhere
+
+        renewal = asyncio.create_task(renew_job_lease(job_id, lease))
+        try:
+            await drive_upload_job(db, job)
+        finally:
+            renewal.cancel()
+            async with SessionLocal() as lease_db:
+                await crud.release_upload_job(lease_db, job_id, JOB_OWNER)
+
+
+async def renew_job_lease(job_id: str, lease: datetime.timedelta):
+    while True:
+        await asyncio.sleep(lease.total_seconds() / 3)
+        try:
+            async with SessionLocal() as db:
+                if not await crud.renew_upload_job_lease(
+                        db, job_id, JOB_OWNER, lease):
+                    logger.warning(f"Lost the lease on upload job {job_id}")
+                    return
+        except Exception as e:
+            logger.error(f"Error renewing upload job {job_id}: {str(e)}")
+
+
+async def drive_upload_job(db: AsyncSession, job: models.UploadJob):
+    """Run a claimed job to confirmed or failed from the stage it is in."""
+    job_id = job.id
     try:
-        hash_value = data.hash_value
-        if not hash_value:
-            raise HTTPException(status_code=400, detail="Invalid hash")
+        transaction = None
+        recorded = job.transaction_id is not None
+        if recorded:
+            # stopped after recording the row, before confirming the job
+            transaction = await crud.get_transaction_by_id(
+                db, job.transaction_id)
+        elif job.status == jobs.JOB_QUEUED:
+            transaction = await crud.get_transaction_by_file_hash(
+                db, job.file_hash)
+        deduplicated = transaction is not None and not recorded
+        if transaction is None:
+            await db.commit()  # see upload
+            transaction_id, deduplicated = await upload_flights.do(
+                job.file_hash, lambda: advance_upload_job(db, job))
+            transaction = await crud.get_transaction_by_id(db, transaction_id)
+        if deduplicated:
+            transaction = await record_reference(
+                db, transaction, job.user_id, job.file_name,
+                job.decrypt_key_first_last_5, job)
+
+        job = await set_job_status(
+            db, job, status=jobs.JOB_CONFIRMED,
+            ipfs_hash=get_ipfs_hash(transaction.bc_file_link),
+            tx_hash=transaction.tr_hash)
+        await cache_ciphertext(job.ipfs_hash, spool_path=job.spool_path)
+    except Exception as e:
+        logger.error(f"Error in upload job {job_id}: {str(e)}")
+        await db.rollback()
+        await db.refresh(job)
+        job = await set_job_status(
+            db, job, status=jobs.JOB_FAILED, error=str(e))
+
+    if os.path.exists(job.spool_path):
+        os.remove(job.spool_path)
+
+
+async def advance_upload_job(db: AsyncSession, job: models.UploadJob) -> int:
+    """Pin and anchor the job's file from its current stage, returns the row id."""
+    store_hash_info = None
+
+    if job.status == jobs.JOB_QUEUED:
+        ipfs_hash = await pin_spooled_file(job.spool_path)
+        job = await set_job_status(
+            db, job, status=jobs.JOB_PINNED,
+            ipfs_hash=check_pinned_cid(job.ipfs_hash, ipfs_hash))
+
+    if job.status == jobs.JOB_PINNED:
+        if ANCHOR_MODE == 'batch':
+            # the batch transaction hash is only known once it is mined
+            job = await set_job_status(db, job, status=jobs.JOB_SUBMITTED)
+            store_hash_info = await anchor_file_hash(job.file_hash)
+        else:
+            tx_hash = await send_store_hash(job.file_hash)
+            job = await set_job_status(
+                db, job, status=jobs.JOB_SUBMITTED, tx_hash=tx_hash)
+
+    if store_hash_info is None:
+        if job.tx_hash:
+            store_hash_info = await wait_for_store_hash(job.tx_hash)
+        else:
+            # interrupted while waiting for a batch, anchor it again
+            store_hash_info = await anchor_file_hash(job.file_hash)
+
+    transaction = await record_transaction(
+        db, job.user_id, job.file_name, job.file_hash,
+        job.decrypt_key_first_last_5, job.ipfs_hash, store_hash_info, job)
+    return transaction.id
+
+
+upload_jobs = JobQueue(run_upload_job, workers=JOB_WORKERS)
+
+
+async def get_unclaimed_job_ids() -> list:
+    async with SessionLocal() as db:
+        unfinished = await crud.get_unfinished_upload_jobs(db, jobs.TERMINAL_STATES)
+        return [job.id for job in unfinished]
+
+
+async def run_job_recovery():
+    # jobs of a worker that stopped are taken over once their lease expires
+    while True:
+        await asyncio.sleep(JOB_LEASE)
+        try:
+            for job_id in await get_unclaimed_job_ids():
+                upload_jobs.enqueue(job_id)
+        except Exception as e:
+            logger.error(f"Error looking for unclaimed upload jobs: {str(e)}")
 
-        account_address = Web3.to_checksum_address(
-            '0xc3561A59F3E69C54DAFC1ed26E9d32f6DE293d42')
-        private_key = os.getenv('PRIVATE_KEY')
-        print(f"PRIVATE_KEY loaded: {'Yes' if private_key else 'No'}")
-        if not private_key:
-            raise HTTPException(status_code=400, detail="PRIVATE_KEY is not set")
-
-        nonce = w3.eth.get_transaction_count(account_address)
-        print(f"Nonce: {nonce}")
-
-        gas_estimate = contract.functions.storeHash(
-            hash_value).estimate_gas({'from': account_address})
-        print(f"Gas estimate: {gas_estimate}")
-
-        transaction = contract.functions.storeHash(hash_value).build_transaction({
-            'from': account_address,
-            'nonce': nonce,
-            'gas': gas_estimate,
-            'maxFeePerGas': w3.eth.max_priority_fee + (2 * w3.eth.get_block('latest')['baseFeePerGas']),
-            'maxPriorityFeePerGas': w3.eth.max_priority_fee,
-        })
-        print(f"Transaction built: {transaction}")
 
-        signed_txn = w3.eth.account.sign_transaction(
-            transaction, private_key=private_key)
-        print(f"Transaction signed: {signed_txn}")
+@app.on_event("startup")
+async def start_upload_jobs():
+    job_ids = await get_unclaimed_job_ids()
+    if job_ids:
+        logger.info(f"Resuming {len(job_ids)} unfinished upload jobs")
+    await upload_jobs.start(job_ids)
+    app.state.job_recovery = asyncio.create_task(run_job_recovery())
+
+
+@app.on_event("shutdown")
+async def stop_upload_jobs():
+    app.state.job_recovery.cancel()
+    await upload_jobs.stop()
+
+
+async def run_nonce_checks():
+    while True:
+        try:
+            await check_nonces()
+        except Exception as e:
+            logger.error(f"Error in nonce check: {str(e)}")
+        await asyncio.sleep(NONCE_CHECK_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_nonce_checks():
+    app.state.nonce_checks = asyncio.create_task(run_nonce_checks())
+
+
+@app.on_event("shutdown")
+async def stop_nonce_checks():
+    app.state.nonce_checks.cancel()
+
+
+async def run_fee_refresh():
+    while True:
+        try:
+            await fee_oracle.refresh()
+        except Exception as e:
+            logger.error(f"Error refreshing fees: {str(e)}")
+        await asyncio.sleep(FEE_REFRESH_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_fee_refresh():
+    app.state.fee_refresh = asyncio.create_task(run_fee_refresh())
+
+
+@app.on_event("shutdown")
+async def stop_fee_refresh():
+    app.state.fee_refresh.cancel()
+
 
-        # Use 'raw_transaction' instead of 'rawTransaction'
-        tx_hash = w3.eth.send_raw_transaction(signed_txn.raw_transaction)
-        print(f"Transaction sent, hash: {tx_hash.hex()}")
+hash_indexer = HashStoredIndexer(
+    w3, [(contract, HASH_STORED_TOPIC)]
+    + ([(contract_v2, HASH_STORED_V2_TOPIC)] if contract_v2 is not None else []),
+    start_block=INDEXER_START_BLOCK or 0)
 
-        tx_receipt = w3.eth.wait_for_transaction_receipt(tx_hash)
-        print(f"Transaction receipt: {tx_receipt}")
 
-        block = w3.eth.get_block(tx_receipt['blockHash'])
-        timestamp = block['timestamp']
+async def run_hash_indexer():
+    while True:
+        try:
+            indexed = await hash_indexer.run_once()
+            if indexed:
+                logger.info(f"Indexed {indexed} HashStored events")
+        except Exception as e:
+            logger.error(f"Error in HashStored indexer: {str(e)}")
+        await asyncio.sleep(INDEXER_POLL_INTERVAL)
+
+
+@app.on_event("startup")
+async def start_hash_indexer():
+    app.state.hash_indexer = None
+    if not INDEXER_ENABLED:
+        return
+    if INDEXER_START_BLOCK is None:
+        logger.warning("HashStored indexer not started, set INDEXER_START_BLOCK "
+                       "to the contract's deployment block")
+        return
+    app.state.hash_indexer = asyncio.create_task(run_hash_indexer())
+
+
+@app.on_event("shutdown")
+async def stop_hash_indexer():
+    if app.state.hash_indexer is not None:
+        app.state.hash_indexer.cancel()
+
+
+async def get_own_upload_job(db: AsyncSession, job_id: str, authorization: str,
+                             username: str, password: str) -> models.UploadJob:
+    """The job `job_id` if it belongs to the caller, authenticated as for /upload."""
+    user_id = await authenticate(db, authorization, username, password)
+    job = await crud.get_upload_job(db, job_id)
+    # someone else's job is reported as missing, not as forbidden
+    if not job or job.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}", response_model=schemas.UploadJob)
+async def get_job(job_id: str, email: str = None, password: str = None,
+                  authorization: str = Header(None),
+                  db: AsyncSession = Depends(get_db)):
+    job = await get_own_upload_job(db, job_id, authorization, email, password)
+    return schemas.UploadJob.from_orm(job)
+
+
+async def read_job_event(job_id: str):
+    """The job's current state as an event, None once it has been deleted."""
+    async with SessionLocal() as db:
+        job = await crud.get_upload_job(db, job_id)
+        if job is None:
+            return None
+        return schemas.UploadJob.from_orm(job).model_dump(mode='json')
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, email: str = None, password: str = None,
+                     authorization: str = Header(None),
+                     db: AsyncSession = Depends(get_db)):
+    job = await get_own_upload_job(db, job_id, authorization, email, password)
+
+    # subscribe before reading the current state so no transition is missed
+    queue = upload_jobs.subscribe(job_id)
+    current = schemas.UploadJob.from_orm(job).model_dump(mode='json')
+    await db.commit()  # don't hold a connection for the whole stream
+
+    async def event_stream():
+        try:
+            event = current
+            yield f"event: status\ndata: {json.dumps(event)}\n\n"
+            while event['status'] not in jobs.TERMINAL_STATES:
+                try:
+                    latest = await asyncio.wait_for(
+                        queue.get(), timeout=JOB_EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # only the worker running the job publishes events, it
+                    # may be another process
+                    latest = await read_job_event(job_id)
+                    if latest is None:
+                        return
+                if latest == event:
+                    yield ": keep-alive\n\n"
+                    continue
+                event = latest
+                yield f"event: status\ndata: {json.dumps(event)}\n\n"
+        finally:
+            upload_jobs.unsubscribe(job_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+async def anchor_root(root: str):
+    return await store_hash(HashData(hash_value=root))
+
+
+anchor_batcher = AnchorBatcher(
+    anchor_root,
+    max_size=ANCHOR_BATCH_SIZE,
+    max_wait=ANCHOR_BATCH_WINDOW)
+
+
+@app.on_event("shutdown")
+async def flush_anchor_batcher():
+    await anchor_batcher.close()
+
+
+@app.on_event("shutdown")
+async def stop_cpu_executor():
+    cpu_executor.shutdown()
+
+
+# registered after the other shutdown handlers, they may still use the database
+@app.on_event("shutdown")
+async def close_db():
+    await engine.dispose()
 
-        # Create Etherscan URL for Sepolia network
-        etherscan_url = f"https://sepolia.etherscan.io/tx/0x{tx_receipt['transactionHash'].hex()}"
-        print(f"Etherscan URL: {etherscan_url}")
 
-        return {
-            "tx_hash": tx_receipt['transactionHash'].hex(),
-            "timestamp": timestamp,
-            "status": "Hash stored",
-            "etherscan_url": etherscan_url
-        }
+@app.on_event("shutdown")
+async def stop_logging():
+    log_listener.stop()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Stage latencies and RPC and error counts for Prometheus."""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+async def anchor_file_hash(file_hash: str):
+    if ANCHOR_MODE == 'batch':
+        return await anchor_batcher.submit(file_hash)
+    return await store_hash(HashData(hash_value=file_hash))
+
+
+@app.post("/store-hash/")
+async def store_hash(data: HashData):
+    try:
+        hash_value = data.hash_value
+        if not hash_value:
+            raise HTTPException(status_code=400, detail="Invalid hash")
+
+        tx_hash = await send_store_hash(hash_value)
+        return await wait_for_store_hash(tx_hash)
     except ContractLogicError as e:
-        print(f"Contract error: {str(e)}")
+        logger.warning(f"Contract error: {str(e)}")
         raise HTTPException(
             status_code=400,
             detail=f"Contract error: {str(e)}")
     except Exception as e:
-        print(f"Error in store_hash: {str(e)}")
+        logger.error(f"Error in store_hash: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
-async def get_file_hash_from_tx_hash(tx_hash: str):
+async def get_file_hash_from_tx_hash(tx_hash: str, db: AsyncSession):
+    """
+    The HashStored event of `tx_hash`: from the in-memory cache, then from
+    the event fields saved at upload time, and only then from the chain.
+    """
+    result = verify_cache.get(tx_hash)
+    if result is not None:
+        return result
+
+    transaction = await crud.get_transaction(db, tx_hash)
+    if transaction and transaction.onchain_hash is not None:
+        result = {"hash": transaction.onchain_hash, "timestamp": convert_unix_to_datetime(
+            transaction.block_timestamp), "index": transaction.record_index}
+        verify_cache.put(tx_hash, result)
+        return result
+
     try:
-        tx_receipt = w3.eth.get_transaction_receipt(tx_hash)
-        print(f"Transaction receipt: {tx_receipt}")
+        tx_receipt = await w3.eth.get_transaction_receipt(tx_hash)
 
         if not tx_receipt:
             raise HTTPException(
                 status_code=404,
                 detail="Transaction not found")
 
-        logs = tx_receipt['logs']
-        print(f"Transaction logs: {logs}")
+        event = decode_hash_stored(tx_receipt)
 
-        event_signature_hash = Web3.keccak(
-            text="HashStored(string,uint256,uint256)").hex()
-        event_log = next(
-            (log for log in logs if log['topics'][0].hex() == event_signature_hash), None)
-
-        if not event_log:
+        if not event:
             raise HTTPException(
                 status_code=404,
                 detail="No HashStored event found in the transaction")
 
-        event_data = contract.events.HashStored().process_log(event_log)
-        print(f"Decoded event data: {event_data}")
-
-        event_args = event_data['args']
-        print(f"Event args: {event_args}")
-
-        return {"hash": event_args['hash'], "timestamp": convert_unix_to_datetime(
-            event_args['timestamp']), "index": event_args['index']}
+        result = {"hash": event['hash'], "timestamp": convert_unix_to_datetime(
+            event['timestamp']), "index": event['index']}
+        verify_cache.put(tx_hash, result)
+        return result
     except Exception as e:
-        print(f"Error in verify_hash: {str(e)}")
+        logger.error(f"Error in verify_hash: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
+def match_anchored_file(transactions, file_hash: str, onchain_hash: str,
+                        user_id: int = None):
+    """
+    The row of `transactions` (all rows of one tx hash) that anchors
+    `file_hash` under `onchain_hash`, the row of `user_id` if they uploaded
+    it too. Raises a 404 if there is none.
+    """
+    # a batched transaction has one row per file and a deduplicated upload
+    # one per uploader, pick the uploaded file, preferably the caller's row
+    matching = [transaction for transaction in transactions
+                if transaction.file_hash == file_hash]
+    transaction = next(
+        (transaction for transaction in matching
+         if user_id is not None and transaction.user_id == user_id),
+        matching[0] if matching else
+        transactions[0] if transactions else None)
+    if not transaction:
+        raise HTTPException(status_code=404, detail="IPFS link not found")
+
+    if transaction.merkle_proof:
+        # the chain holds the batch root, walk the proof up to it
+        proof = json.loads(transaction.merkle_proof)
+        if not (transaction.file_hash == file_hash
+                and merkle.verify_proof(file_hash, proof, onchain_hash)):
+            raise HTTPException(status_code=404, detail="File hash mismatch")
+    elif not file_hash == onchain_hash:
+        raise HTTPException(status_code=404, detail="File hash mismatch")
+    return transaction
+
+
+def visible_file_name(transactions, transaction: models.Transaction,
+                      user_id: int = None):
+    """
+    The name `transaction` was uploaded under, unless it is another user's
+    name for a file several users uploaded: deduplicated uploads share the
+    anchor, and each uploader only sees their own name.
+    """
+    if user_id is not None and transaction.user_id == user_id:
+        return transaction.file_name
+    uploaders = {other.user_id for other in transactions
+                 if other.file_hash == transaction.file_hash}
+    return transaction.file_name if len(uploaders) == 1 else None
+
+
+def get_caller_id(authorization: str):
+    """The user id of an optional session token, for public endpoints."""
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    session = session_tokens.verify(token.strip())
+    if session is None:
+        raise HTTPException(
+            status_code=401, detail="Invalid or expired session token",
+            headers={"WWW-Authenticate": "Bearer"})
+    return session[0]
+
+
+async def get_hash_stored_events(tx_hashes, transactions) -> dict:
+    """
+    Batch version of get_file_hash_from_tx_hash: {tx_hash: event or error
+    message}. Receipts missing from the cache and `transactions` are
+    fetched in JSON-RPC batches.
+    """
+    events = {}
+    for tx_hash in tx_hashes:
+        result = verify_cache.get(tx_hash)
+        if result is not None:
+            events[tx_hash] = result
+    for transaction in transactions:
+        if transaction.tr_hash not in events \
+                and transaction.onchain_hash is not None:
+            result = {"hash": transaction.onchain_hash, "timestamp": convert_unix_to_datetime(
+                transaction.block_timestamp), "index": transaction.record_index}
+            verify_cache.put(transaction.tr_hash, result)
+            events[transaction.tr_hash] = result
+
+    missing = [tx_hash for tx_hash in tx_hashes if tx_hash not in events]
+    receipts = await get_transaction_receipts(missing) if missing else {}
+    for tx_hash, tx_receipt in receipts.items():
+        if isinstance(tx_receipt, Exception):
+            events[tx_hash] = str(tx_receipt)
+            continue
+        event = decode_hash_stored(tx_receipt) if tx_receipt else None
+        if not tx_receipt:
+            events[tx_hash] = "Transaction not found"
+        elif not event:
+            events[tx_hash] = "No HashStored event found in the transaction"
+        else:
+            result = {"hash": event['hash'], "timestamp": convert_unix_to_datetime(
+                event['timestamp']), "index": event['index']}
+            verify_cache.put(tx_hash, result)
+            events[tx_hash] = result
+    return events
+
+
+@app.post("/verify/batch", response_model=List[schemas.BatchVerifyResult])
+async def verify_batch(
+    tx_hash: List[str] = Form([]),
+    encrypted_file: List[UploadFile] = File([]),
+    manifest: UploadFile = File(None),
+    authorization: str = Header(None),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Verify many files at once. Pair each `encrypted_file` with the
+    `tx_hash` at the same position, and/or upload a JSON `manifest` of
+    {"tx_hash": ..., "file_hash": ...} items for files hashed locally.
+    Returns one result per item, in order. With a session token, files the
+    caller uploaded too are reported under their own name.
+    """
+    user_id = get_caller_id(authorization)
+    if len(tx_hash) != len(encrypted_file):
+        raise HTTPException(
+            status_code=400,
+            detail="Every encrypted_file needs a tx_hash")
+    items = list(zip(tx_hash, encrypted_file))
+    if manifest is not None:
+        try:
+            entries = json.loads(await manifest.read())
+            items += [(entry['tx_hash'], str(entry['file_hash']).lower())
+                      for entry in entries]
+        except (ValueError, TypeError, KeyError):
+            raise HTTPException(
+                status_code=400,
+                detail="manifest must be a JSON list of tx_hash/file_hash items")
+    if not items:
+        raise HTTPException(status_code=400, detail="Nothing to verify")
+    if len(items) > VERIFY_BATCH_MAX:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {VERIFY_BATCH_MAX} items per batch")
+
+    # hash the uploads while the database and node are queried, in as many
+    # groups as may run at once so a large batch can't fill the queue
+    files = [file.file for _, file in items if not isinstance(file, str)]
+    group_size = max(1, -(-len(files) // cpu_executor.limit('hash')))
+    hashing = asyncio.gather(*(
+        run_cpu('hash', get_fileobj_hashes, files[start:start + group_size])
+        for start in range(0, len(files), group_size)))
+    try:
+        tx_hashes = [item_tx_hash[2:] if item_tx_hash.startswith("0x")
+                     else item_tx_hash for item_tx_hash, _ in items]
+        unique_tx_hashes = list(dict.fromkeys(tx_hashes))
+        transactions = await crud.get_transactions_by_tr_hashes(
+            db, unique_tx_hashes)
+        events = await get_hash_stored_events(unique_tx_hashes, transactions)
+    finally:
+        file_hashes = (file_hash for group in await hashing for file_hash in group)
+
+    transactions_by_hash = {}
+    for transaction in transactions:
+        transactions_by_hash.setdefault(transaction.tr_hash, []).append(transaction)
+
+    results = []
+    for item_tx_hash, (_, file) in zip(tx_hashes, items):
+        file_hash = file if isinstance(file, str) else next(file_hashes)
+        result = schemas.BatchVerifyResult(
+            tx_hash=item_tx_hash, file_hash=file_hash, verified=False)
+        event = events[item_tx_hash]
+        if isinstance(event, str):
+            result.error = event
+            results.append(result)
+            continue
+        rows = transactions_by_hash.get(item_tx_hash, [])
+        try:
+            transaction = match_anchored_file(
+                rows, file_hash, event['hash'], user_id)
+        except HTTPException as e:
+            result.error = e.detail
+        else:
+            result.verified = True
+            result.file_name = visible_file_name(rows, transaction, user_id)
+            result.timestamp = event['timestamp']
+            result.bc_file_link = transaction.bc_file_link
+            result.merkle_root = transaction.merkle_root
+        results.append(result)
+    return results
+
+
 @app.post("/verify/{tx_hash}", response_model=schemas.VerifyResponse)
 async def verify(
     tx_hash: str,
     encrypted_file: UploadFile = File(...),
-    db: Session = Depends(get_db)
+    authorization: str = Header(None),
+    db: AsyncSession = Depends(get_db)
 ):
     try:
+        user_id = get_caller_id(authorization)
         tx_hash = tx_hash[2:] if tx_hash.startswith("0x") else tx_hash
-        result = await get_file_hash_from_tx_hash(tx_hash)
-        file_hash = result['hash']
+        result = await get_file_hash_from_tx_hash(tx_hash, db)
+        onchain_hash = result['hash']
         timestamp = result['timestamp']
 
-        transaction = crud.get_transaction(db, tx_hash)
-        if not transaction:
-            raise HTTPException(status_code=404, detail="IPFS link not found")
-        
-        file_name = transaction.file_name
-        ipfs_link = transaction.bc_file_link
-        ipfs_hash = ipfs_link.split('/')[-1]
-        
         #nolonger getting encypted_file from IPFS. It is uploaded by user
         # encrypted_file = get_from_pinata(ipfs_hash)
         # if not encrypted_file:
@@ -334,55 +1236,260 @@ async def verify(
         #         status_code=404,
         #         detail="Failed to fetch from IPFS")
 
-        file_content = await encrypted_file.read()
+        ipfs_file_hash = await get_upload_file_hash(encrypted_file)
 
-        ipfs_file_hash = get_file_hash(file_content)
-        if not ipfs_file_hash == file_hash:
-            raise HTTPException(status_code=404, detail="File hash mismatch")
+        transactions = await crud.get_transactions_by_tr_hashes(db, [tx_hash])
+        transaction = match_anchored_file(
+            transactions, ipfs_file_hash, onchain_hash, user_id)
+
+        file_name = visible_file_name(transactions, transaction, user_id)
+        ipfs_link = transaction.bc_file_link
 
         response = schemas.VerifyResponse(
             file_name=file_name,
-            file_hash=file_hash,
+            file_hash=ipfs_file_hash,
             timestamp=timestamp,
-            bc_file_link=ipfs_link
+            bc_file_link=ipfs_link,
+            merkle_root=transaction.merkle_root
         )
         return response
 
     except Exception as e:
-        print(f"Error in verify: {str(e)}")
+        logger.warning(f"Error in verify: {str(e)}")
         raise e
 
 
+@app.post("/verify-by-hash", response_model=schemas.VerifyByHashResponse)
+async def verify_by_hash(
+    encrypted_file: UploadFile = File(...),
+    db: AsyncSession = Depends(get_db)
+):
+    file_hash = await get_upload_file_hash(encrypted_file)
+
+    merkle_root = None
+    anchor = await crud.get_anchor_by_hash(db, file_hash)
+    if not anchor:
+        # anchored in a batch: find the root through our proof
+        transaction = await crud.get_batched_transaction_by_file_hash(db, file_hash)
+        if transaction and merkle.verify_proof(
+                file_hash, json.loads(transaction.merkle_proof),
+                transaction.merkle_root):
+            merkle_root = transaction.merkle_root
+            anchor = await crud.get_anchor_by_hash(db, merkle_root)
+    if not anchor:
+        # not indexed, the indexer is off by default: use the HashStored
+        # event saved when this deployment anchored the file
+        return await verify_by_stored_event(db, file_hash)
+
+    return schemas.VerifyByHashResponse(
+        file_hash=file_hash,
+        tx_hash=anchor.tx_hash,
+        record_index=anchor.record_index,
+        block_number=anchor.block_number,
+        timestamp=convert_unix_to_datetime(anchor.timestamp),
+        merkle_root=merkle_root
+    )
+
+
+async def verify_by_stored_event(db: AsyncSession, file_hash: str):
+    transaction = await crud.get_transaction_by_file_hash(db, file_hash)
+    if not transaction or transaction.onchain_hash is None \
+            or transaction.block_number is None:
+        raise HTTPException(status_code=404, detail="No anchor found for file")
+    try:
+        match_anchored_file([transaction], file_hash, transaction.onchain_hash)
+    except HTTPException:
+        raise HTTPException(status_code=404, detail="No anchor found for file")
+
+    return schemas.VerifyByHashResponse(
+        file_hash=file_hash,
+        tx_hash=transaction.tr_hash,
+        record_index=transaction.record_index,
+        block_number=transaction.block_number,
+        timestamp=convert_unix_to_datetime(transaction.block_timestamp),
+        merkle_root=transaction.merkle_root
+    )
+
+
+@app.get("/anchored/{file_hash}", response_model=schemas.AnchoredResponse)
+async def anchored(file_hash: str, db: AsyncSession = Depends(get_db)):
+    """
+    Whether `file_hash` (the SHA-256 of a ciphertext) is anchored in
+    HashStorageV2, checked with one eth_call instead of receipts or logs.
+    Files anchored in a batch are checked through their Merkle root.
+    """
+    if contract_v2 is None:
+        raise HTTPException(
+            status_code=404, detail="HashStorageV2 is not configured")
+    file_hash = file_hash.lower()
+    try:
+        merkle_root = None
+        anchored_at = await get_anchored_at(file_hash)
+        if not anchored_at:
+            transaction = await crud.get_batched_transaction_by_file_hash(
+                db, file_hash)
+            if transaction and merkle.verify_proof(
+                    file_hash, json.loads(transaction.merkle_proof),
+                    transaction.merkle_root):
+                merkle_root = transaction.merkle_root
+                anchored_at = await get_anchored_at(merkle_root)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return schemas.AnchoredResponse(
+        file_hash=file_hash,
+        anchored=bool(anchored_at),
+        timestamp=convert_unix_to_datetime(anchored_at) if anchored_at else None,
+        merkle_root=merkle_root if anchored_at else None
+    )
+
+
 @app.post("/decrypt")
 async def decrypt(
     encryptedFileLink: str,
-    encryptionKey: str
+    encryptionKey: str,
+    request: Request
 ):
     try:
-        print("in /decrypt try")
-        decrypted_filename, decrypted_file = decrypt_file_from_link(encryptedFileLink, encryptionKey)
-        print("decrypted_filename:",decrypted_filename)
-        print("decrypted_file[:100]:",decrypted_file[:100])
-    
-        encoded_filename = decrypted_filename.encode('utf-8') # encode filename using utf-8
-        content_disposition = f"attachment; filename*=UTF-8''{encoded_filename.decode('latin-1')}"
-
-        try:
-            resp = StreamingResponse(
-                io.BytesIO(decrypted_file),
-                media_type="application/octet-stream",
-                headers={"Content-Disposition": content_disposition}
-            )
-            return resp
-        except Exception as e:
-            logging.error(f"Error with StreamingResponse: {str(e)}")
+        range_header = request.headers.get('range')
+        cached_path = get_cached_ciphertext(encryptedFileLink)
+        if cached_path is not None:
+            source = cached_path
+            stream_decrypt, open_range, decrypt_range = (
+                stream_decrypt_from_file, open_encrypted_file_range,
+                decrypt_range_from_file)
+            run = functools.partial(run_cpu, 'decrypt')
+        else:
+            # a miss streams from the fastest gateway, every segment is
+            # authenticated as it is decrypted. Reading the whole file fills
+            # the cache on the way, a Range request only fetches its segments
+            source = await get_gateway_link(encryptedFileLink)
+            stream_decrypt, open_range, decrypt_range = (
+                stream_decrypt_from_link, open_encrypted_range,
+                decrypt_range_from_link)
+            cid = get_ipfs_hash(encryptedFileLink)
+            if is_cid(cid):
+                stream_decrypt = functools.partial(
+                    stream_decrypt_from_link, sink=cid_cache.writer(cid))
+            # opening a link mostly waits on the gateway, a stalled one
+            # mustn't hold a slot of cpu_executor
+            run = asyncio.to_thread
+
+        if range_header:
+            opened = await run(open_range, source, encryptionKey)
+            if opened:
+                return ranged_decrypt_response(
+                    decrypt_range, source, encryptionKey, range_header,
+                    *opened)
+
+        decrypted_filename, plaintext_chunks, size = await run(
+            stream_decrypt, source, encryptionKey)
+
+        headers = {"Content-Disposition": get_content_disposition(decrypted_filename)}
+        if size is not None:
+            headers["Content-Length"] = str(size)
+            headers["Accept-Ranges"] = "bytes"
+
+        return StreamingResponse(
+            decrypt_stream(plaintext_chunks, cached_path is not None),
+            media_type="application/octet-stream",
+            headers=headers
+        )
 
+    except HTTPException:
+        raise
+    except InvalidTag:
+        raise HTTPException(
+            status_code=400,
+            detail="Failed to decrypt. The ciphertext may have been tampered with or the wrong key was used.")
     except Exception as e:
-        print("in /decrypt except")
+        logger.error(f"Error in decrypt: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
+def ranged_decrypt_response(decrypt_range, source, encryption_key,
+                            range_header, filename, layout):
+    size = layout.plaintext_size
+    byte_range = parse_range_header(range_header, size)
+    headers = {
+        "Content-Disposition": get_content_disposition(filename),
+        "Accept-Ranges": "bytes"
+    }
+    if byte_range is None:
+        headers["Content-Range"] = f"bytes */{size}"
+        raise HTTPException(
+            status_code=416, detail="Range not satisfiable", headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        decrypt_stream(
+            decrypt_range(source, encryption_key, layout, start, end),
+            decrypt_range is decrypt_range_from_file),
+        status_code=206,
+        media_type="application/octet-stream",
+        headers=headers
+    )
+
+
+def decrypt_stream(plaintext_chunks, local: bool):
+    """
+    Response body decrypting `plaintext_chunks`. Local ciphertexts are
+    decrypted on cpu_executor, a few segments per call to keep the hops
+    between threads few. Streams from a gateway mostly wait on the network
+    and stay in Starlette's threadpool.
+    """
+    chunks = metrics.stage_iter('decrypt', plaintext_chunks)
+    if not local:
+        return chunks
+    return cpu_executor.iterate('decrypt', join_chunks(chunks, DECRYPT_CHUNK_SIZE))
+
+
 # === HELPERS ===
+async def check_password(db: AsyncSession, username: str, password: str) -> int:
+    """The user's id if the password is right, raises 404/401 otherwise."""
+    user_id = credential_cache.get(username, password)
+    if user_id is not None:
+        return user_id
+
+    user = await crud.get_user(db, username)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    if not user.pass_hash == get_password_hash(password):
+        raise HTTPException(status_code=401, detail="Invalid password")
+
+    credential_cache.put(username, password, user.id)
+    return user.id
+
+
+async def authenticate(db: AsyncSession, authorization: str, username: str = None,
+                 password: str = None) -> int:
+    """
+    The id of the calling user, from an "Authorization: Bearer" session
+    token or else a username and password. A token for another user than
+    `username` is rejected.
+    """
+    scheme, _, token = (authorization or '').partition(' ')
+    if scheme.lower() == 'bearer' and token:
+        session = session_tokens.verify(token.strip())
+        if session is None:
+            raise HTTPException(
+                status_code=401, detail="Invalid or expired session token",
+                headers={"WWW-Authenticate": "Bearer"})
+        user_id, session_username = session
+        if username is not None and username != session_username:
+            raise HTTPException(status_code=403, detail="Token is for another user")
+        return user_id
+
+    if username is None or password is None:
+        raise HTTPException(
+            status_code=401, detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"})
+    return await check_password(db, username, password)
+
+
 def get_password_hash(key: str) -> str:
     hash_object = hashlib.sha256()
     hash_object.update(key.encode('utf-8'))
@@ -395,17 +1502,166 @@ def get_file_hash(data):
     hasher.update(data)
     hash_256 = hasher.digest()
     hash_hex = hash_256.hex()
-    print("hash_hex: ", hash_hex)
     return hash_hex
 
 
+class HashingReader:
+    """
+    Wraps a file object, feeding everything read through SHA-256 and the
+    IPFS CID builder, failing once more than `max_bytes` have been read.
+    """
+
+    def __init__(self, fileobj, max_bytes: int = None):
+        self._fileobj = fileobj
+        self._hasher = hashlib.sha256()
+        self._cid = CIDBuilder(PINATA_CID_VERSION)
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._fileobj.read(size)
+        self.bytes_read += len(chunk)
+        if self.max_bytes is not None and self.bytes_read > self.max_bytes:
+            raise HTTPException(status_code=413, detail="File too large")
+        self._hasher.update(chunk)
+        self._cid.update(chunk)
+        return chunk
+
+    def hexdigest(self) -> str:
+        return self._hasher.hexdigest()
+
+    def cid(self) -> str:
+        return self._cid.cid()
+
+
+def join_chunks(chunks, size: int):
+    """Regroup byte `chunks` into chunks of at least `size` bytes."""
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield b''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def drain(fileobj, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    while fileobj.read(chunk_size):
+        pass
+
+
+def spool_upload(reader: HashingReader, spool_path: str):
+    with open(spool_path, 'wb') as spool:
+        while chunk := reader.read(UPLOAD_CHUNK_SIZE):
+            spool.write(chunk)
+
+
+async def run_cpu(op: str, fn, *args):
+    """Run `fn(*args)` on cpu_executor, a full queue answers 503."""
+    try:
+        return await cpu_executor.run(op, fn, *args)
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+
+def get_upload_size(upload_file: UploadFile) -> int:
+    size = upload_file.size
+    if size is None:
+        upload_file.file.seek(0, os.SEEK_END)
+        size = upload_file.file.tell()
+        upload_file.file.seek(0)
+    if MAX_UPLOAD_BYTES is not None and size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+    return size
+
+
+async def get_upload_file_hash(upload_file: UploadFile) -> str:
+    return await run_cpu('hash', get_fileobj_hash, upload_file.file)
+
+
+def get_fileobj_hash(fileobj) -> str:
+    """SHA-256 of a whole file object, blocking: run it on cpu_executor."""
+    fileobj.seek(0)
+    hasher = hashlib.sha256()
+    with metrics.stage('hashing'):
+        while chunk := fileobj.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_fileobj_hashes(fileobjs) -> list[str]:
+    return [get_fileobj_hash(fileobj) for fileobj in fileobjs]
+
+
+def get_content_disposition(filename: str) -> str:
+    encoded_filename = filename.encode('utf-8') # encode filename using utf-8
+    return f"attachment; filename*=UTF-8''{encoded_filename.decode('latin-1')}"
+
+
+def parse_range_header(range_header: str, size: int):
+    """
+    Parse a single "bytes=start-end" range against a body of `size` bytes.
+    Returns an inclusive (start, end) or None when it is not satisfiable.
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # suffix range: the last N bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    # weak comparison, as If-None-Match calls for
+    return any(tag.strip().removeprefix('W/') == etag
+               for tag in if_none_match.split(','))
+
+
+def encode_transactions_cursor(transaction: models.Transaction) -> str:
+    position = f"{transaction.anchored_at.isoformat()}|{transaction.id}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_transactions_cursor(cursor: str) -> tuple:
+    try:
+        anchored_at, _, transaction_id = base64.urlsafe_b64decode(
+            cursor.encode()).decode().partition('|')
+        return (datetime.datetime.fromisoformat(anchored_at),
+                int(transaction_id))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 def convert_unix_to_datetime(unix_timestamp):
     return datetime.datetime.fromtimestamp(
         unix_timestamp).strftime('%Y-%m-%d-%H-%M-%S')
 
 
 def get_ipfs_link(ipfs_hash):
-    return f"https://gateway.pinata.cloud/ipfs/{ipfs_hash}"
+    return f"{PINATA_GATEWAY_URL}/ipfs/{ipfs_hash}"
+
+
+def get_ipfs_hash(ipfs_link):
+    return ipfs_link.split('/ipfs/', 1)[-1]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import time
+from lru_cache import LRUCache
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class SessionTokens:
+    """
+    Issues and checks HMAC-SHA256 signed session tokens, so a request can
+    be authenticated without a database lookup.
+
+    A token is "<payload>.<signature>", both base64url, the payload being
+    JSON with the user id ("uid"), username ("sub") and issue and expiry
+    times. Tokens issued before `not_before` are rejected. Without a
+    `secret`, nothing verifies until `set_secret` is called, e.g. with a
+    key shared through the database.
+    """
+
+    def __init__(self, secret: str = None, ttl: int = 12 * 3600):
+        self._key = secret.encode() if secret else None
+        self.ttl = ttl
+        self.not_before = 0
+
+    def set_secret(self, secret: str):
+        self._key = secret.encode()
+
+    def issue(self, user_id: int, username: str) -> str:
+        now = time.time()
+        payload = _b64encode(json.dumps({
+            'uid': user_id,
+            'sub': username,
+            'iat': now,
+            'exp': int(now) + self.ttl
+        }, separators=(',', ':')).encode())
+        return f'{payload}.{self._sign(payload)}'
+
+    def verify(self, token: str):
+        """Returns (user_id, username), or None for a bad or expired token."""
+        payload, _, signature = token.partition('.')
+        if self._key is None:
+            return None
+        if not hmac.compare_digest(
+                signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+        if claims['exp'] <= time.time() or claims['iat'] < self.not_before:
+            return None
+        return claims['uid'], claims['sub']
+
+    def _sign(self, payload: str) -> str:
+        if self._key is None:
+            raise RuntimeError("Session secret not set")
+        return _b64encode(
+            hmac.new(self._key, payload.encode(), hashlib.sha256).digest())
+
+
+class CredentialCache:
+    """
+    Remembers successful username/password checks for `ttl` seconds.
+    Keys are a keyed hash of the credentials, passwords are never stored.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 60):
+        self.ttl = ttl
+        self._key = secrets.token_bytes(32)
+        self._cache = LRUCache(maxsize)
+
+    def get(self, username: str, password: str):
+        """The cached user id, or None."""
+        key = self._credentials_key(username, password)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        user_id, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._cache.pop(key)
+            return None
+        return user_id
+
+    def put(self, username: str, password: str, user_id: int):
+        if self.ttl > 0:
+            self._cache.put(self._credentials_key(username, password),
+                            (user_id, time.monotonic() + self.ttl))
+
+    def clear(self):
+        self._cache.clear()
+
+    def _credentials_key(self, username: str, password: str) -> bytes:
+        return hmac.new(
+            self._key, f'{username}\0{password}'.encode(),
+            hashlib.sha256).digest()
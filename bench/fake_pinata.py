@@ -0,0 +1,71 @@
+import json
+import uuid
+from aiohttp import web
+from unixfs import CIDBuilder
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FakePinata:
+    """
+    In-process stand-in for the Pinata pinning API and an IPFS gateway.
+    Pinned files are kept in memory under the CID IPFS would give them, so
+    the app's local CID checks and the gateway fetcher work unchanged.
+    Several files pinned in one request get a random directory id and are
+    served as "<directory>/<name>".
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.pins = 0
+        self.url = None
+        self._runner = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application(client_max_size=1 << 40)
+        app.router.add_post('/pinning/pinFileToIPFS', self._pin)
+        app.router.add_get('/ipfs/{path:.+}', self._get)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _pin(self, request):
+        reader = await request.multipart()
+        cid_version = 0
+        pinned = []
+        while (part := await reader.next()) is not None:
+            if part.filename is None:
+                if part.name == 'pinataOptions':
+                    cid_version = json.loads(await part.text()).get('cidVersion', 0)
+                continue
+            builder = CIDBuilder(cid_version)
+            data = bytearray()
+            while chunk := await part.read_chunk(CHUNK_SIZE):
+                builder.update(chunk)
+                data += chunk
+            pinned.append((part.filename, builder.cid(), bytes(data)))
+
+        self.pins += 1
+        if len(pinned) == 1:
+            _, cid, data = pinned[0]
+            self.files[cid] = data
+            return web.json_response({'IpfsHash': cid})
+        directory = uuid.uuid4().hex
+        for filename, _, data in pinned:
+            self.files[f'{directory}/{filename.rsplit("/", 1)[-1]}'] = data
+        return web.json_response({'IpfsHash': directory})
+
+    async def _get(self, request):
+        data = self.files.get(request.match_info['path'])
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data, content_type='application/octet-stream')
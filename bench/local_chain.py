@@ -0,0 +1,67 @@
+import os
+from web3 import EthereumTesterProvider, Web3
+
+SOLC_VERSION = '0.8.28'
+
+
+def compile_hash_storage(source: str = 'HashStorage.sol',
+                         solc_version: str = SOLC_VERSION) -> str:
+    """Deployable bytecode of HashStorage, installing solc if needed."""
+    import solcx
+    if solc_version not in {str(version) for version
+                            in solcx.get_installed_solc_versions()}:
+        solcx.install_solc(solc_version)
+    compiled = solcx.compile_files(
+        [source], output_values=['bin'], solc_version=solc_version)
+    return compiled[f'{source}:HashStorage']['bin']
+
+
+def deploy_to_node(node_url: str, private_key: str, bytecode: str, abi) -> str:
+    """
+    Deploy HashStorage to a local node (anvil, hardhat, geth --dev) and
+    point the app at it through the environment. Call before importing
+    `chain`. Returns the contract address.
+    """
+    w3 = Web3(Web3.HTTPProvider(node_url))
+    account = w3.eth.account.from_key(private_key)
+    transaction = w3.eth.contract(abi=abi, bytecode=bytecode).constructor() \
+        .build_transaction({
+            'from': account.address,
+            'nonce': w3.eth.get_transaction_count(account.address)
+        })
+    signed = account.sign_transaction(transaction)
+    receipt = w3.eth.wait_for_transaction_receipt(
+        w3.eth.send_raw_transaction(signed.raw_transaction))
+    os.environ.update({
+        'WEB3_PROVIDER_URI': node_url,
+        'HASH_STORAGE_ADDRESS': receipt['contractAddress'],
+        'ACCOUNT_ADDRESS': account.address,
+        'PRIVATE_KEY': private_key
+    })
+    return receipt['contractAddress']
+
+
+def start_eth_tester(bytecode: str) -> str:
+    """
+    Run `chain` against a fresh in-process eth-tester chain with HashStorage
+    deployed, sending from its first funded account. Call after importing
+    `chain` and before importing `app`, which copies `chain.contract`.
+    Returns the contract address.
+    """
+    from web3.providers.eth_tester import AsyncEthereumTesterProvider
+    import chain
+
+    provider = AsyncEthereumTesterProvider()
+    tester = provider.ethereum_tester
+    w3 = Web3(EthereumTesterProvider(tester))
+    account = w3.eth.account.from_key(tester.backend.account_keys[0])
+    deployment = w3.eth.contract(abi=chain.contract_abi, bytecode=bytecode) \
+        .constructor().transact({'from': account.address})
+    address = w3.eth.get_transaction_receipt(deployment)['contractAddress']
+
+    os.environ['PRIVATE_KEY'] = account.key.hex()
+    chain.w3.provider = provider
+    chain.contract = chain.w3.eth.contract(address=address, abi=chain.contract_abi)
+    chain.account_address = account.address
+    chain.nonce_manager.address = account.address
+    return address
@@ -0,0 +1,437 @@
+"""
+Offline benchmark of /upload, /verify and /decrypt against a local chain and
+an in-process fake Pinata. Run from the repository root:
+
+    python -m bench.run --sizes 1024,1048576 --concurrency 1,8 --output results.json
+
+Each (operation, file size, concurrency) profile sends --requests requests
+and reports latency percentiles, throughput and the peak RSS of the process.
+The app runs in this process under uvicorn, so the RSS covers both.
+
+--mix SMALL,LARGE adds mixed profiles, where a --mix-large-share of the
+requests are LARGE and the rest SMALL, reported per size: the latency of the
+small requests shows how much the large ones hold up everything else.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import resource
+import secrets
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import aiohttp
+
+OPERATIONS = ('upload', 'verify', 'decrypt')
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1024,65536,1048576',
+                        help="plaintext sizes in bytes, comma separated")
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help="concurrent clients, comma separated")
+    parser.add_argument('--requests', type=int, default=50,
+                        help="requests per profile")
+    parser.add_argument('--ops', default=','.join(OPERATIONS),
+                        help="operations to run, comma separated")
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--baseline',
+                        help="earlier results file to compare against")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the generated file contents")
+    parser.add_argument('--contract-bin',
+                        help="HashStorage bytecode file, compiled with solc if unset")
+    parser.add_argument('--node',
+                        help="local node URL to deploy to instead of eth-tester")
+    parser.add_argument('--private-key',
+                        help="funded account on --node")
+    parser.add_argument('--anchor-mode', default='single',
+                        choices=('single', 'batch'))
+    parser.add_argument('--mix',
+                        help="small and large size of mixed profiles, comma separated")
+    parser.add_argument('--mix-large-share', type=float, default=0.1,
+                        help="fraction of large requests in mixed profiles")
+    parser.add_argument('--content', default='random', choices=('random', 'text'),
+                        help="random bytes, or compressible JSON log lines")
+    parser.add_argument('--compress', default='none', choices=('none', 'zlib', 'zstd'),
+                        help="codec the files are compressed with before encrypting")
+    args = parser.parse_args(argv)
+    args.sizes = [int(size) for size in args.sizes.split(',')]
+    if args.mix:
+        args.mix = [int(size) for size in args.mix.split(',')]
+        if len(args.mix) != 2:
+            parser.error("--mix takes two sizes")
+    args.concurrency = [int(level) for level in args.concurrency.split(',')]
+    args.ops = [op for op in args.ops.split(',') if op]
+    unknown = set(args.ops) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"unknown operations: {', '.join(sorted(unknown))}")
+    if args.node and not args.private_key:
+        parser.error("--node needs --private-key")
+    return args
+
+
+def configure_environment(args, workdir: str, pinata_url: str):
+    """Settings for the app, before any of its modules are imported."""
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{os.path.join(workdir, "bench.db")}',
+        'CID_CACHE_DIR': os.path.join(workdir, 'cid_cache'),
+        'JOB_SPOOL_DIR': os.path.join(workdir, 'job_spool'),
+        'PINATA_API_URL': pinata_url,
+        'PINATA_GATEWAY_URL': pinata_url,
+        'IPFS_GATEWAYS': pinata_url,
+        'PINATA_API_KEY': 'bench',
+        'PINATA_SECRET_KEY': 'bench',
+        'SESSION_SECRET': secrets.token_hex(32),
+        'HASH_STORAGE_V2_ADDRESS': '',
+        'ANCHOR_MODE': args.anchor_mode,
+        'INDEXER_ENABLED': '0',
+        'LOG_LEVEL': 'WARNING',
+        'LOG_FILE': ''
+    })
+    # replaced by the eth-tester provider once chain is imported
+    os.environ.setdefault('WEB3_PROVIDER_URI', 'http://127.0.0.1:8545')
+
+
+def load_bytecode(args) -> str:
+    if args.contract_bin:
+        with open(args.contract_bin) as file:
+            return file.read().strip()
+    from bench.local_chain import compile_hash_storage
+    return compile_hash_storage()
+
+
+def encrypt(plaintext: bytes, filename: str, compress: str = 'none') -> tuple[bytes, str]:
+    """Ciphertext in the segmented format, and the hex key."""
+    from stream_crypto import CODECS, encrypt_stream
+    key = secrets.token_bytes(32)
+    ciphertext = io.BytesIO()
+    encrypt_stream(io.BytesIO(plaintext), ciphertext, filename, key,
+                   codec=CODECS[compress])
+    return ciphertext.getvalue(), key.hex()
+
+
+def generate(rng: random.Random, size: int, content: str) -> bytes:
+    """`size` bytes of random data, or of JSON log lines that compress well."""
+    if content == 'random':
+        return rng.randbytes(size)
+    lines = []
+    length = 0
+    while length < size:
+        line = json.dumps({
+            'time': 1700000000 + len(lines),
+            'level': rng.choice(('INFO', 'INFO', 'INFO', 'WARNING', 'ERROR')),
+            'route': rng.choice(('/upload', '/verify', '/decrypt')),
+            'status': rng.choice((200, 200, 200, 400, 404)),
+            'ms': round(rng.expovariate(1 / 40), 2),
+            'request_id': rng.randbytes(8).hex()
+        }) + '\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+
+async def run_profile(op: str, size: int, concurrency: int, items, send) -> dict:
+    """Send one request per item from `concurrency` workers, timing each."""
+    elapsed = await send_all(concurrency, items, send)
+    return summarize(op, size, concurrency, items, elapsed)
+
+
+async def run_mixed_profile(op: str, concurrency: int, items, send) -> list[dict]:
+    """Like run_profile for items of several sizes, one result per size."""
+    elapsed = await send_all(concurrency, items, send)
+    results = []
+    for size in sorted({item['size'] for item in items}):
+        result = summarize(
+            op, size, concurrency,
+            [item for item in items if item['size'] == size], elapsed)
+        result['profile'] = 'mixed'
+        results.append(result)
+    return results
+
+
+async def send_all(concurrency: int, items, send) -> float:
+    """
+    Send one request per item from `concurrency` workers, storing each
+    item's latency or error on it. Returns the seconds it took.
+    """
+    pending = iter(items)
+
+    async def worker():
+        for item in pending:
+            item.pop('error', None)
+            start = time.perf_counter()
+            try:
+                await send(item)
+            except Exception as e:
+                item['error'] = str(e)
+            item['latency'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start
+
+
+def summarize(op: str, size: int, concurrency: int, items, elapsed: float) -> dict:
+    latencies = sorted(item['latency'] for item in items if 'error' not in item)
+    errors = [item['error'] for item in items if 'error' in item]
+    result = {
+        'op': op,
+        'size': size,
+        'concurrency': concurrency,
+        'requests': len(items),
+        # encrypted bytes sent or fetched per request, after any compression
+        'ciphertext_bytes': round(
+            sum(len(item['ciphertext']) for item in items) / max(len(items), 1)),
+        'errors': len(errors),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'throughput_mbps': round(len(latencies) * size / elapsed / 1e6, 3),
+        'peak_rss_mb': peak_rss_mb()
+    }
+    for name, fraction in (('p50_ms', 0.50), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+        value = percentile(latencies, fraction)
+        result[name] = round(value * 1000, 2) if value is not None else None
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+
+class BenchClient:
+    def __init__(self, session: aiohttp.ClientSession, base_url: str):
+        self.session = session
+        self.base_url = base_url
+        self.token = None
+
+    async def login(self):
+        async with self.session.post(
+                f'{self.base_url}/register',
+                params={'username': USERNAME, 'password': PASSWORD}):
+            pass  # already registered when running against a reused node
+        async with self.session.post(
+                f'{self.base_url}/login',
+                params={'username': USERNAME, 'password': PASSWORD}) as response:
+            response.raise_for_status()
+            self.token = (await response.json())['access_token']
+
+    async def upload(self, item: dict):
+        form = aiohttp.FormData()
+        form.add_field('encrypted_file', item['ciphertext'], filename=item['name'])
+        async with self.session.post(
+                f'{self.base_url}/upload',
+                params={'filename': item['name'],
+                        'decrypt_key_first_last_5': item['key'][:5] + item['key'][-5:]},
+                headers={'Authorization': f'Bearer {self.token}'},
+                data=form) as response:
+            await _check(response)
+            item['upload'] = await response.json()
+
+    async def verify(self, item: dict):
+        form = aiohttp.FormData()
+        form.add_field('encrypted_file', item['ciphertext'], filename=item['name'])
+        async with self.session.post(
+                f'{self.base_url}/verify/{item["upload"]["tx_hash"]}',
+                data=form) as response:
+            await _check(response)
+            await response.read()
+
+    async def decrypt(self, item: dict):
+        async with self.session.post(
+                f'{self.base_url}/decrypt',
+                params={'encryptedFileLink': item['upload']['ipfs_link'],
+                        'encryptionKey': item['key']}) as response:
+            await _check(response)
+            while await response.content.read(1024 * 1024):
+                pass
+
+
+async def _check(response):
+    if response.status >= 400:
+        raise RuntimeError(f"HTTP {response.status}: {await response.text()}")
+
+
+async def benchmark(args) -> dict:
+    from bench.fake_pinata import FakePinata
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    pinata = FakePinata()
+    pinata_url = await pinata.start()
+    configure_environment(args, workdir, pinata_url)
+
+    bytecode = load_bytecode(args)
+    if args.node:
+        from bench.local_chain import deploy_to_node
+        with open(os.path.join(
+                'compiled_contract', 'HashStorage_sol_HashStorage.abi')) as file:
+            deploy_to_node(args.node, args.private_key, bytecode, json.load(file))
+        import chain  # noqa: F401, configured from the environment
+    else:
+        from bench.local_chain import start_eth_tester
+        import chain  # noqa: F401, patched by start_eth_tester
+        start_eth_tester(bytecode)
+
+    import uvicorn
+    from app import app
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    # keep-alive outlasts generating the next profile's files, or the
+    # client reuses connections the server already closed
+    server = uvicorn.Server(uvicorn.Config(
+        app, log_level='warning', lifespan='on', timeout_keep_alive=600))
+    serving = asyncio.ensure_future(server.serve(sockets=[sock]))
+    while not server.started:
+        if serving.done():
+            serving.result()
+        await asyncio.sleep(0.05)
+    base_url = f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+    rng = random.Random(args.seed)
+    results = []
+    try:
+        connector = aiohttp.TCPConnector(limit=max(args.concurrency) * 2)
+        timeout = aiohttp.ClientTimeout(total=600)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            client = BenchClient(session, base_url)
+            await client.login()
+            for size in args.sizes:
+                for concurrency in args.concurrency:
+                    # fresh files per profile, or uploads would be deduplicated
+                    items = []
+                    for index in range(args.requests):
+                        name = f'bench-{size}-{concurrency}-{index}.bin'
+                        ciphertext, key = encrypt(
+                            generate(rng, size, args.content), name, args.compress)
+                        items.append({'name': name, 'ciphertext': ciphertext, 'key': key})
+
+                    upload = await run_profile(
+                        'upload', size, concurrency, items, client.upload)
+                    if 'upload' in args.ops:
+                        results.append(upload)
+                        report(upload)
+                    uploaded = [item for item in items if 'upload' in item]
+                    for op in ('verify', 'decrypt'):
+                        if op in args.ops:
+                            result = await run_profile(
+                                op, size, concurrency, uploaded,
+                                getattr(client, op))
+                            results.append(result)
+                            report(result)
+
+            for concurrency in args.concurrency if args.mix else ():
+                small, large = args.mix
+                items = []
+                for index in range(args.requests):
+                    size = large if rng.random() < args.mix_large_share else small
+                    name = f'bench-mix-{concurrency}-{index}.bin'
+                    ciphertext, key = encrypt(
+                        generate(rng, size, args.content), name, args.compress)
+                    items.append({'name': name, 'ciphertext': ciphertext,
+                                  'key': key, 'size': size})
+
+                for result in await run_mixed_profile(
+                        'upload', concurrency, items, client.upload):
+                    if 'upload' in args.ops:
+                        results.append(result)
+                        report(result)
+                uploaded = [item for item in items if 'upload' in item]
+                for op in ('verify', 'decrypt'):
+                    if op in args.ops:
+                        for result in await run_mixed_profile(
+                                op, concurrency, uploaded, getattr(client, op)):
+                            results.append(result)
+                            report(result)
+    finally:
+        server.should_exit = True
+        await serving
+        await pinata.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'chain': 'node' if args.node else 'eth-tester',
+        'anchor_mode': args.anchor_mode,
+        'content': args.content,
+        'compress': args.compress,
+        'mix': args.mix,
+        'mix_large_share': args.mix_large_share if args.mix else None,
+        'requests_per_profile': args.requests,
+        'seed': args.seed,
+        'results': results
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(result: dict):
+    mixed = ' mixed' if result.get('profile') == 'mixed' else ''
+    print(f"{result['op']:>8} {result['size']:>9}B x{result['concurrency']:<3}{mixed} "
+          f"p50 {result['p50_ms']}ms p95 {result['p95_ms']}ms "
+          f"p99 {result['p99_ms']}ms {result['throughput_rps']} req/s "
+          f"{result['ciphertext_bytes']}B sent "
+          f"rss {result['peak_rss_mb']}MB errors {result['errors']}")
+
+
+def compare(results: dict, baseline: dict):
+    """Print the change of p95 latency and throughput against `baseline`."""
+    def key(result):
+        return (result['op'], result['size'], result['concurrency'],
+                result.get('profile'))
+
+    earlier = {key(result): result for result in baseline['results']}
+    print(f"compared to {baseline.get('commit') or 'baseline'}:")
+    for result in results['results']:
+        before = earlier.get(key(result))
+        if not before or not before['p95_ms'] or not before['throughput_rps']:
+            continue
+        print(f"{result['op']:>8} {result['size']:>9}B x{result['concurrency']:<3} "
+              f"p95 {result['p95_ms'] / before['p95_ms'] - 1:+.1%} "
+              f"throughput {result['throughput_rps'] / before['throughput_rps'] - 1:+.1%}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(benchmark(args))
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"wrote {args.output}")
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Encrypt and hash many files at once, then upload them.
+
+    python bulk_encrypt.py encrypt archive/ --output encrypted/
+    python bulk_encrypt.py upload encrypted/manifest.jsonl --url http://localhost:8000 \\
+        --username alice --password secret
+
+`encrypt` takes a directory (walked recursively) or a text file listing one
+path per line, and encrypts the files in the segmented format across a
+process pool, compressing them first with --compress zlib or zstd. Each
+worker streams its file through encrypt_stream, so memory stays at a couple
+of segments per worker whatever the file sizes. Ciphertexts
+are written to the output directory as <sha256>.enc, and one line per file is
+appended to manifest.jsonl there: source path, size, ciphertext, sha256 of the
+ciphertext and the key fingerprint the upload API takes. The keys themselves
+go to keys.jsonl, readable only by the owner. Running it again skips files
+already in the manifest and unchanged since, so an interrupted run resumes.
+
+`upload` sends every ciphertext in a manifest to /upload, recording the
+responses in uploads.jsonl next to it, and skips the ones recorded before.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import secrets
+import sys
+import aiohttp
+from stream_crypto import CODECS, CODEC_NONE, DEFAULT_SEGMENT_SIZE, encrypt_stream
+
+MANIFEST_NAME = 'manifest.jsonl'
+KEYS_NAME = 'keys.jsonl'
+UPLOADS_NAME = 'uploads.jsonl'
+
+
+class HashingWriter:
+    """File object wrapper hashing everything written through it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.hasher = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+
+def key_fingerprint(key_hex: str) -> str:
+    """The first and last 5 hex digits of a key, as /upload expects them."""
+    return key_hex[:5] + key_hex[-5:]
+
+
+def list_sources(source: str) -> list[str]:
+    """The files under directory `source`, or listed in the file `source`."""
+    if os.path.isdir(source):
+        paths = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            paths.extend(os.path.join(root, name) for name in sorted(files))
+        return paths
+    with open(source) as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def read_jsonl(path: str) -> list[dict]:
+    """The entries of a JSON lines file, ignoring a line cut off by a crash."""
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path) as file:
+        for line in file:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return entries
+
+
+def encrypt_one(path: str, output_dir: str, key_hex: str, segment_size: int,
+                codec: int = CODEC_NONE, level: int = None) -> dict:
+    """Encrypt `path` into `output_dir`, runs in a worker process."""
+    stat = os.stat(path)
+    partial = os.path.join(output_dir, f'.{os.getpid()}-{secrets.token_hex(4)}.part')
+    try:
+        with open(path, 'rb') as src, open(partial, 'wb') as dst:
+            writer = HashingWriter(dst)
+            encrypt_stream(src, writer, os.path.basename(path),
+                           bytes.fromhex(key_hex), segment_size, codec, level)
+        file_hash = writer.hexdigest()
+        ciphertext = f'{file_hash}.enc'
+        os.replace(partial, os.path.join(output_dir, ciphertext))
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    return {
+        'source': path,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'ciphertext': ciphertext,
+        'file_hash': file_hash,
+        'key_fingerprint': key_fingerprint(key_hex),
+        'encrypted_at': datetime.datetime.now(datetime.timezone.utc).isoformat()
+    }
+
+
+def is_done(entry: dict, output_dir: str) -> bool:
+    """Whether the manifest `entry` is still current for its source file."""
+    try:
+        stat = os.stat(entry['source'])
+    except OSError:
+        return True  # source moved away, keep what was encrypted
+    return (stat.st_size == entry['size']
+            and stat.st_mtime_ns == entry['mtime_ns']
+            and os.path.exists(os.path.join(output_dir, entry['ciphertext'])))
+
+
+def encrypt_all(source: str, output_dir: str, workers: int = None,
+                key_hex: str = None, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                codec: int = CODEC_NONE, level: int = None) -> dict:
+    """
+    Encrypt every file of `source` not yet in the manifest of `output_dir`.
+    With `key_hex` all files share that key, otherwise each gets its own.
+    Returns counts of the files encrypted, skipped and failed.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    keys_path = os.path.join(output_dir, KEYS_NAME)
+
+    done = {entry['source'] for entry in read_jsonl(manifest_path)
+            if is_done(entry, output_dir)}
+    sources = list_sources(source)
+    paths = [path for path in sources if path not in done]
+    counts = {'encrypted': 0, 'skipped': len(sources) - len(paths), 'failed': 0}
+
+    workers = workers or os.cpu_count() or 1
+    keys_fd = os.open(keys_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    with open(manifest_path, 'a') as manifest, os.fdopen(keys_fd, 'a') as keys, \
+            concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = {}
+        paths = iter(paths)
+        while True:
+            # a bounded number of queued files, the list can be very long
+            for path in paths:
+                key = key_hex or secrets.token_hex(32)
+                future = pool.submit(
+                    encrypt_one, path, output_dir, key, segment_size, codec, level)
+                pending[future] = (path, key)
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            finished, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                path, key = pending.pop(future)
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    counts['failed'] += 1
+                    print(f"failed {path}: {e}", file=sys.stderr)
+                    continue
+                # the key first, a manifest entry must never lack its key
+                keys.write(json.dumps({'file_hash': entry['file_hash'], 'key': key}) + '\n')
+                keys.flush()
+                manifest.write(json.dumps(entry) + '\n')
+                manifest.flush()
+                counts['encrypted'] += 1
+    return counts
+
+
+async def upload_all(manifest_path: str, url: str, token: str,
+                     concurrency: int = 4, async_job: bool = False) -> dict:
+    """
+    Upload the ciphertexts of a manifest to the API at `url`, skipping the
+    ones already in uploads.jsonl. Returns counts of uploaded, skipped and
+    failed files.
+    """
+    output_dir = os.path.dirname(os.path.abspath(manifest_path))
+    uploads_path = os.path.join(output_dir, UPLOADS_NAME)
+    uploaded = {entry['file_hash'] for entry in read_jsonl(uploads_path)}
+    # a source encrypted again after it changed has a newer entry
+    manifest = list({entry['source']: entry
+                     for entry in read_jsonl(manifest_path)}.values())
+    entries = [entry for entry in manifest if entry['file_hash'] not in uploaded]
+    counts = {'uploaded': 0, 'skipped': len(manifest) - len(entries), 'failed': 0}
+
+    pending = iter(entries)
+    with open(uploads_path, 'a') as uploads:
+        async with aiohttp.ClientSession(
+                headers={'Authorization': f'Bearer {token}'},
+                timeout=aiohttp.ClientTimeout(total=None)) as session:
+
+            async def worker():
+                for entry in pending:
+                    try:
+                        response = await upload_one(
+                            session, url, output_dir, entry, async_job)
+                    except Exception as e:
+                        counts['failed'] += 1
+                        print(f"failed {entry['source']}: {e}", file=sys.stderr)
+                        continue
+                    uploads.write(json.dumps({
+                        'file_hash': entry['file_hash'],
+                        'source': entry['source'],
+                        **response}) + '\n')
+                    uploads.flush()
+                    counts['uploaded'] += 1
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return counts
+
+
+async def upload_one(session, url: str, output_dir: str, entry: dict,
+                     async_job: bool) -> dict:
+    file_name = os.path.basename(entry['source'])
+    with open(os.path.join(output_dir, entry['ciphertext']), 'rb') as file:
+        form = aiohttp.FormData()
+        form.add_field('encrypted_file', file, filename=file_name)
+        async with session.post(
+                f'{url}/upload',
+                params={'filename': file_name,
+                        'decrypt_key_first_last_5': entry['key_fingerprint'],
+                        'async_job': str(async_job).lower()},
+                data=form) as response:
+            if response.status >= 400:
+                raise RuntimeError(f"HTTP {response.status}: {await response.text()}")
+            return await response.json()
+
+
+async def login(url: str, username: str, password: str) -> str:
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+                f'{url}/login',
+                params={'username': username, 'password': password}) as response:
+            if response.status >= 400:
+                raise RuntimeError(f"Login failed: {await response.text()}")
+            return (await response.json())['access_token']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    encrypt = commands.add_parser('encrypt', help="encrypt and hash files")
+    encrypt.add_argument('source', help="directory, or file listing one path per line")
+    encrypt.add_argument('--output', required=True, help="directory for ciphertexts and manifest")
+    encrypt.add_argument('--workers', type=int, help="processes, defaults to the CPU count")
+    encrypt.add_argument('--key', help="hex key for every file instead of one key per file")
+    encrypt.add_argument('--segment-size', type=int, default=DEFAULT_SEGMENT_SIZE)
+    encrypt.add_argument('--compress', choices=CODECS, default='none',
+                         help="compress before encrypting, skipped for incompressible files")
+    encrypt.add_argument('--level', type=int, help="compression level, the codec's default if unset")
+
+    upload = commands.add_parser('upload', help="upload the files of a manifest")
+    upload.add_argument('manifest')
+    upload.add_argument('--url', default='http://localhost:8000')
+    upload.add_argument('--token', help="session token, or log in with --username")
+    upload.add_argument('--username')
+    upload.add_argument('--password')
+    upload.add_argument('--concurrency', type=int, default=4)
+    upload.add_argument('--async-job', action='store_true',
+                        help="queue the uploads as jobs instead of waiting for the anchors")
+
+    args = parser.parse_args(argv)
+    if args.command == 'encrypt' and args.key:
+        try:
+            if len(bytes.fromhex(args.key)) != 32:
+                raise ValueError
+        except ValueError:
+            parser.error("--key must be 32 bytes in hex")
+    if args.command == 'upload' and not args.token \
+            and not (args.username and args.password):
+        parser.error("upload needs --token or --username and --password")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'encrypt':
+        counts = encrypt_all(args.source, args.output, args.workers,
+                             args.key, args.segment_size,
+                             CODECS[args.compress], args.level)
+    else:
+        async def upload():
+            url = args.url.rstrip('/')
+            token = args.token or await login(url, args.username, args.password)
+            return await upload_all(
+                args.manifest, url, token, args.concurrency, args.async_job)
+        counts = asyncio.run(upload())
+    print(', '.join(f'{count} {name}' for name, count in counts.items()))
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,459 @@
+from web3 import AsyncHTTPProvider, AsyncWeb3, Web3
+from web3.middleware import Web3Middleware
+from web3.exceptions import (
+    TimeExhausted, TransactionNotFound, Web3RPCError, Web3TypeError)
+import aiohttp
+import asyncio
+import datetime
+import json
+import logging
+import os
+from dotenv import load_dotenv
+import metrics
+from confirmations import ConfirmationEngine
+from nonce_manager import NonceManager
+from fee_oracle import FeeOracle, GasEstimateCache
+
+load_dotenv()
+
+# WEB3_PROVIDER_URI points the backend at any node, e.g. a local dev chain,
+# otherwise Sepolia through Infura is used
+provider_uri = os.getenv('WEB3_PROVIDER_URI')
+if not provider_uri:
+    infura_id = os.getenv('INFURA_ID')
+    if not infura_id:
+        raise Exception("INFURA_ID is not set!")
+    provider_uri = f'https://sepolia.infura.io/v3/{infura_id}'
+
+# keep-alive connections shared by every RPC call of this process
+RPC_POOL_SIZE = int(os.getenv('RPC_POOL_SIZE', '100'))
+RPC_TIMEOUT = float(os.getenv('RPC_TIMEOUT', '30'))
+# most nodes cap the number of calls in one JSON-RPC batch
+RPC_BATCH_SIZE = int(os.getenv('RPC_BATCH_SIZE', '100'))
+
+
+
+class RPCMetricsMiddleware(Web3Middleware):
+    """Counts JSON-RPC requests and error responses by method, batched or not."""
+
+    async def async_request_processor(self, method, params):
+        metrics.RPC_REQUESTS.inc(method=method)
+        return method, params
+
+    async def async_response_processor(self, method, response):
+        if 'error' in response:
+            metrics.RPC_ERRORS.inc(method=method)
+        return response
+
+
+w3 = AsyncWeb3(AsyncHTTPProvider(
+    provider_uri, request_kwargs={'timeout': aiohttp.ClientTimeout(total=RPC_TIMEOUT)}))
+w3.middleware_onion.add(RPCMetricsMiddleware, 'rpc_metrics')
+
+contract_abi_path = os.path.join(
+    'compiled_contract',
+    'HashStorage_sol_HashStorage.abi')
+
+with open(contract_abi_path, 'r') as file:
+    contract_abi = json.load(file)
+
+contract_address = Web3.to_checksum_address(
+    os.getenv('HASH_STORAGE_ADDRESS', '0xC2fba0A73D9843f109e235e985648207792Ce18f'))
+contract = w3.eth.contract(address=contract_address, abi=contract_abi)
+
+# with HASH_STORAGE_V2_ADDRESS set new hashes are anchored as bytes32 in
+# HashStorageV2, anchors in the v1 contract above keep verifying
+HASH_STORAGE_V2_ADDRESS = os.getenv('HASH_STORAGE_V2_ADDRESS')
+contract_v2 = None
+if HASH_STORAGE_V2_ADDRESS:
+    with open(os.path.join(
+            'compiled_contract', 'HashStorageV2_sol_HashStorageV2.abi'), 'r') as file:
+        contract_v2 = w3.eth.contract(
+            address=Web3.to_checksum_address(HASH_STORAGE_V2_ADDRESS),
+            abi=json.load(file))
+
+account_address = Web3.to_checksum_address(
+    os.getenv('ACCOUNT_ADDRESS', '0xc3561A59F3E69C54DAFC1ed26E9d32f6DE293d42'))
+
+HASH_STORED_TOPIC = Web3.keccak(text="HashStored(string,uint256,uint256)")
+HASH_STORED_V2_TOPIC = Web3.keccak(text="HashStored(bytes32,uint256,uint256)")
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_TIMEOUT = 120
+# blocks a transaction needs, counting its own, before it is treated as
+# final; the head is polled every CONFIRMATION_POLL_INTERVAL seconds
+CONFIRMATIONS = int(os.getenv('CONFIRMATIONS', '1'))
+CONFIRMATION_POLL_INTERVAL = float(os.getenv('CONFIRMATION_POLL_INTERVAL', '1'))
+# a pending transaction is re-sent with higher fees after TX_STUCK_AFTER
+# seconds, replacements must raise both fees by at least 10%
+TX_STUCK_AFTER = int(os.getenv('TX_STUCK_AFTER', '180'))
+FEE_BUMP_PERCENT = 125
+
+nonce_manager = NonceManager(account_address)
+
+
+async def connect():
+    """Open the pooled RPC session and check the node is reachable."""
+    if isinstance(w3.provider, AsyncHTTPProvider):
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=RPC_POOL_SIZE, keepalive_timeout=60))
+        await w3.provider.cache_async_session(session)
+    if not await w3.is_connected():
+        raise Exception("Failed to connect to Ethereum network!")
+
+
+async def disconnect():
+    await confirmation_engine.close()
+    if isinstance(w3.provider, AsyncHTTPProvider):
+        await w3.provider.disconnect()
+
+
+def get_private_key() -> str:
+    private_key = os.getenv('PRIVATE_KEY')
+    if not private_key:
+        raise ValueError("PRIVATE_KEY is not set")
+    return private_key
+
+
+fee_oracle = FeeOracle(w3)
+gas_estimates = GasEstimateCache()
+_chain_id = None
+
+
+async def get_fees() -> tuple[int, int]:
+    """Returns (maxFeePerGas, maxPriorityFeePerGas) for a new transaction."""
+    return await fee_oracle.fees()
+
+
+async def get_chain_id() -> int:
+    global _chain_id
+    if _chain_id is None:
+        _chain_id = await w3.eth.chain_id
+    return _chain_id
+
+
+def store_hash_call(hash_value: str):
+    """storeHash call of the contract new anchors go to."""
+    if contract_v2 is not None:
+        return contract_v2.functions.storeHash(to_bytes32(hash_value))
+    return contract.functions.storeHash(hash_value)
+
+
+def to_bytes32(hash_value: str) -> bytes:
+    digest = bytes.fromhex(hash_value[2:] if hash_value.startswith("0x") else hash_value)
+    if len(digest) != 32:
+        raise ValueError(f"Not a 32 byte hash: {hash_value}")
+    return digest
+
+
+async def estimate_store_hash_gas(hash_value: str) -> int:
+    with metrics.stage('gas_estimate'):
+        return await gas_estimates.get(
+            'storeHash', len(hash_value),
+            lambda: store_hash_call(
+                hash_value).estimate_gas({'from': account_address}))
+
+
+async def reserve_nonce() -> int:
+    nonce = await nonce_manager.reserve()
+    if nonce is None:
+        # first send of this account against this database
+        await nonce_manager.sync(
+            await w3.eth.get_transaction_count(account_address, 'pending'))
+        nonce = await nonce_manager.reserve()
+    return nonce
+
+
+async def send_store_hash(hash_value: str) -> str:
+    """Sign and send a storeHash transaction, returns its hash without waiting."""
+    private_key = get_private_key()
+
+    gas_estimate = await estimate_store_hash_gas(hash_value)
+    max_fee_per_gas, max_priority_fee_per_gas = await get_fees()
+
+    nonce = await reserve_nonce()
+    try:
+        with metrics.stage('sign_send'):
+            transaction = await store_hash_call(hash_value).build_transaction({
+                'from': account_address,
+                'nonce': nonce,
+                'gas': gas_estimate,
+                'maxFeePerGas': max_fee_per_gas,
+                'maxPriorityFeePerGas': max_priority_fee_per_gas,
+                'chainId': await get_chain_id(),
+            })
+            # payload dumps only at DEBUG, formatted only when enabled
+            logger.debug("Transaction built: %s", transaction)
+
+            signed_txn = w3.eth.account.sign_transaction(
+                transaction, private_key=private_key)
+
+            # Use 'raw_transaction' instead of 'rawTransaction'
+            tx_hash = await w3.eth.send_raw_transaction(signed_txn.raw_transaction)
+        logger.info(
+            f"Sent storeHash as {tx_hash.hex()}",
+            extra={'nonce': nonce, 'gas': gas_estimate,
+                   'max_fee_per_gas': max_fee_per_gas})
+    except Exception:
+        # hand the nonce to the next sender instead of leaving a gap
+        await nonce_manager.release(nonce)
+        raise
+
+    await nonce_manager.mark_sent(
+        nonce, tx_hash.hex(), hash_value, gas_estimate,
+        max_fee_per_gas, max_priority_fee_per_gas)
+    return tx_hash.hex()
+
+
+async def get_transaction_receipts(tx_hashes) -> dict:
+    """
+    Receipts of `tx_hashes` fetched in JSON-RPC batches of up to
+    RPC_BATCH_SIZE calls, as {tx_hash: receipt}. Unknown and pending
+    transactions map to None, failed lookups to their exception.
+    """
+    receipts = {}
+    for start in range(0, len(tx_hashes), RPC_BATCH_SIZE):
+        chunk = tx_hashes[start:start + RPC_BATCH_SIZE]
+        try:
+            results = await _batch_receipts(chunk)
+        except TransactionNotFound:
+            # one missing receipt fails the whole batch: find the mined
+            # transactions first and fetch only their receipts
+            try:
+                mined = await _mined_transactions(chunk)
+                found = dict(zip(mined, await _batch_receipts(mined))) if mined else {}
+                results = [found.get(tx_hash) for tx_hash in chunk]
+            except Exception as e:
+                logger.warning(f"Batched receipt lookup failed: {str(e)}")
+                results = await _receipts_one_by_one(chunk)
+        except (Web3RPCError, Web3TypeError):
+            # not every provider batches
+            results = await _receipts_one_by_one(chunk)
+        receipts.update(zip(chunk, results))
+    return receipts
+
+
+async def _batch_receipts(tx_hashes) -> list:
+    async with w3.batch_requests() as batch:
+        for tx_hash in tx_hashes:
+            batch.add(w3.eth.get_transaction_receipt(tx_hash))
+        return await batch.async_execute()
+
+
+async def _mined_transactions(tx_hashes) -> list:
+    """
+    The `tx_hashes` that have a receipt, from one raw batch, which unlike
+    the formatted one tolerates null results.
+    """
+    responses = await w3.provider.make_batch_request([
+        ('eth_getTransactionReceipt', [Web3.to_hex(hexstr=tx_hash)])
+        for tx_hash in tx_hashes])
+    # the raw batch skips the middleware
+    metrics.RPC_REQUESTS.inc(len(tx_hashes), method='eth_getTransactionReceipt')
+    if not isinstance(responses, list) or len(responses) != len(tx_hashes):
+        raise ValueError(f"Unexpected batch response: {responses}")
+    return [tx_hash for tx_hash, response in zip(tx_hashes, responses)
+            if response.get('result')]
+
+
+async def _receipts_one_by_one(tx_hashes) -> list:
+    return await asyncio.gather(
+        *(get_receipt_or_none(tx_hash) for tx_hash in tx_hashes),
+        return_exceptions=True)
+
+
+async def get_receipt_or_none(tx_hash: str):
+    try:
+        return await w3.eth.get_transaction_receipt(tx_hash)
+    except TransactionNotFound:
+        return None
+
+
+async def get_replacements(tx_hashes) -> dict:
+    """
+    For each of `tx_hashes`, itself and every hash re-sent with its nonce,
+    the newest last. One query for all of them.
+    """
+    records = await nonce_manager.find_many(tx_hashes)
+    return {tx_hash: json.loads(records[tx_hash].tx_hashes)
+            if tx_hash in records else [tx_hash]
+            for tx_hash in tx_hashes}
+
+
+confirmation_engine = ConfirmationEngine(
+    w3, get_transaction_receipts, get_replacements,
+    confirmations=CONFIRMATIONS, poll_interval=CONFIRMATION_POLL_INTERVAL)
+
+
+async def wait_for_receipt(tx_hash: str, timeout: float = RECEIPT_TIMEOUT):
+    """
+    Wait for the transaction sent with the same nonce as `tx_hash` to be
+    mined with CONFIRMATIONS blocks, following fee-bumped replacements of
+    it. Every pending transaction is confirmed by the one shared poller of
+    `confirmation_engine`.
+    """
+    with metrics.stage('receipt_wait'):
+        try:
+            tx_receipt = await confirmation_engine.wait(tx_hash, timeout)
+        except asyncio.TimeoutError:
+            raise TimeExhausted(
+                f"Transaction {tx_hash} is not confirmed after {timeout} seconds")
+
+    record = await nonce_manager.find(tx_hash)
+    if record:
+        await nonce_manager.mark_confirmed(
+            record.nonce, tx_receipt['transactionHash'].hex())
+    return tx_receipt
+
+
+async def wait_for_store_hash(tx_hash: str) -> dict:
+    """Wait until `tx_hash` is mined and return the store_hash info dict."""
+    tx_receipt = await wait_for_receipt(tx_hash)
+    logger.debug("Transaction receipt: %s", tx_receipt)
+
+    # the event carries the block timestamp, no need to fetch the block
+    event = decode_hash_stored(tx_receipt)
+    if event is None:
+        raise ValueError(f"No HashStored event in transaction {tx_hash}")
+
+    etherscan_url = get_etherscan_url(tx_receipt['transactionHash'].hex())
+    logger.info(
+        f"Hash stored: {etherscan_url}",
+        extra={'block_number': event['block_number'], 'index': event['index']})
+
+    return {
+        "tx_hash": tx_receipt['transactionHash'].hex(),
+        "timestamp": event['timestamp'],
+        "status": "Hash stored",
+        "etherscan_url": etherscan_url,
+        "event": event
+    }
+
+
+def decode_hash_stored(tx_receipt):
+    """
+    Decode the HashStored event of a receipt into a dict with the on-chain
+    hash, record index, block timestamp, block number and log index.
+    Returns None if the transaction did not emit one. Events of both
+    contract versions are decoded, v2 digests as hex like v1 hashes.
+    """
+    event_log = next(
+        (log for log in tx_receipt['logs']
+         if log['topics'] and (log['topics'][0] == HASH_STORED_TOPIC or (
+             log['topics'][0] == HASH_STORED_V2_TOPIC and contract_v2 is not None))),
+        None)
+    if not event_log:
+        return None
+
+    event_contract = contract if event_log['topics'][0] == HASH_STORED_TOPIC \
+        else contract_v2
+    event_args = event_contract.events.HashStored().process_log(event_log)['args']
+    return {
+        "hash": get_event_hash(event_args),
+        "index": event_args['index'],
+        "timestamp": event_args['timestamp'],
+        "block_number": event_log['blockNumber'],
+        "log_index": event_log['logIndex']
+    }
+
+
+def get_event_hash(event_args) -> str:
+    """The anchored hash of a decoded HashStored event as a hex string."""
+    if isinstance(event_args['hash'], bytes):
+        return event_args['hash'].hex()  # v2 bytes32 digest
+    return event_args['hash']
+
+
+async def get_anchored_at(hash_value: str) -> int:
+    """
+    Block timestamp of the first HashStorageV2 anchor of `hash_value`, 0 if
+    it was never anchored there. One eth_call, no receipt or logs.
+    """
+    return await contract_v2.functions.anchoredAt(to_bytes32(hash_value)).call()
+
+
+def get_etherscan_url(tx_hash: str) -> str:
+    # Create Etherscan URL for Sepolia network
+    tx_hash = tx_hash[2:] if tx_hash.startswith("0x") else tx_hash
+    return f"https://sepolia.etherscan.io/tx/0x{tx_hash}"
+
+
+async def check_nonces():
+    """
+    Reconcile the nonce manager with the chain: settle mined nonces, re-send
+    stuck transactions with bumped fees and fill nonce gaps that would hold
+    back every later transaction. Run periodically.
+    """
+    await nonce_manager.sync(
+        await w3.eth.get_transaction_count(account_address, 'pending'))
+    await nonce_manager.settle(
+        await w3.eth.get_transaction_count(account_address, 'latest'))
+    stuck_after = datetime.timedelta(seconds=TX_STUCK_AFTER)
+    await nonce_manager.release_stale(stuck_after)
+
+    for record in await nonce_manager.stuck(stuck_after):
+        try:
+            await resend_with_fee_bump(record)
+        except Exception as e:
+            logger.error(f"Error re-sending nonce {record.nonce}: {str(e)}")
+
+    for nonce in await nonce_manager.gaps(stuck_after):
+        if not await nonce_manager.claim_gap(nonce):
+            continue
+        try:
+            await fill_nonce_gap(nonce)
+        except Exception as e:
+            await nonce_manager.release(nonce)
+            logger.error(f"Error filling nonce gap {nonce}: {str(e)}")
+
+
+async def resend_with_fee_bump(record):
+    max_fee_per_gas, max_priority_fee_per_gas = await get_fees()
+    max_fee_per_gas = max(
+        max_fee_per_gas, record.max_fee_per_gas * FEE_BUMP_PERCENT // 100)
+    max_priority_fee_per_gas = max(
+        max_priority_fee_per_gas,
+        record.max_priority_fee_per_gas * FEE_BUMP_PERCENT // 100)
+
+    transaction = {
+        'from': account_address,
+        'nonce': record.nonce,
+        'gas': record.gas,
+        'maxFeePerGas': max_fee_per_gas,
+        'maxPriorityFeePerGas': max_priority_fee_per_gas,
+        'chainId': await get_chain_id(),
+    }
+    if record.hash_value is not None:
+        transaction = await store_hash_call(
+            record.hash_value).build_transaction(transaction)
+    else:
+        transaction.update({'to': account_address, 'value': 0})
+
+    signed_txn = w3.eth.account.sign_transaction(
+        transaction, private_key=get_private_key())
+    tx_hash = (await w3.eth.send_raw_transaction(signed_txn.raw_transaction)).hex()
+    logger.warning(
+        f"Re-sent nonce {record.nonce} as {tx_hash} "
+        f"with maxFeePerGas {max_fee_per_gas}")
+    await nonce_manager.mark_replaced(
+        record, tx_hash, max_fee_per_gas, max_priority_fee_per_gas)
+
+
+async def fill_nonce_gap(nonce: int):
+    """Use a nonce nobody else will send with a zero value self transfer."""
+    max_fee_per_gas, max_priority_fee_per_gas = await get_fees()
+    signed_txn = w3.eth.account.sign_transaction({
+        'from': account_address,
+        'to': account_address,
+        'value': 0,
+        'nonce': nonce,
+        'gas': 21000,
+        'maxFeePerGas': max_fee_per_gas,
+        'maxPriorityFeePerGas': max_priority_fee_per_gas,
+        'chainId': await get_chain_id(),
+    }, private_key=get_private_key())
+    tx_hash = (await w3.eth.send_raw_transaction(signed_txn.raw_transaction)).hex()
+    logger.warning(f"Filled nonce gap {nonce} with {tx_hash}")
+    await nonce_manager.mark_sent(
+        nonce, tx_hash, None, 21000, max_fee_per_gas, max_priority_fee_per_gas)
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+import aiohttp
+from unixfs import CIDBuilder
+
+logger = logging.getLogger(__name__)
+
+CID_PATTERN = re.compile(r'^(Qm[1-9A-HJ-NP-Za-km-z]{44}|b[a-z2-7]{58,})$')
+TEMP_PREFIX = '.tmp-'
+FETCH_CHUNK_SIZE = 64 * 1024
+# temp files untouched this long were left behind by an interrupted fetch
+STALE_TEMP_AGE = 3600
+
+
+def is_cid(value: str) -> bool:
+    """True for the plain CIDv0/CIDv1 strings the cache can verify."""
+    return bool(value and CID_PATTERN.match(value))
+
+
+class CIDCache:
+    """
+    Size-bounded disk cache of pinned ciphertexts, one file per CID.
+
+    Files are only ever added under the CID of their content, so a cached
+    file never goes stale. Once the cached files add up to more than
+    `max_bytes` the least recently used are evicted, recency being the
+    files' modification times. The directory is the only state, so several
+    uvicorn workers can share it and the bound holds for all of them.
+    """
+
+    def __init__(self, directory: str, max_bytes: int,
+                 stale_temp_age: float = STALE_TEMP_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(directory, exist_ok=True)
+        # temp files still being written belong to fetches of other workers
+        stale = time.time() - stale_temp_age
+        for entry in os.scandir(directory):
+            if entry.name.startswith(TEMP_PREFIX):
+                try:
+                    if entry.stat().st_mtime < stale:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        self._evict()
+
+    def get(self, cid: str):
+        """Path of the cached file for `cid`, or None."""
+        if not is_cid(cid):
+            return None
+        path = self._path(cid)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, cid: str, fileobj):
+        """Copy the whole of `fileobj` into the cache as `cid`."""
+        if not is_cid(cid) or cid in self:
+            return
+        temp_path = self.temp_path()
+        try:
+            fileobj.seek(0)
+            with open(temp_path, 'wb') as temp:
+                shutil.copyfileobj(fileobj, temp, FETCH_CHUNK_SIZE)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        self.add(cid, temp_path)
+
+    def add(self, cid: str, path: str) -> str:
+        """Move the file at `path` into the cache as `cid`."""
+        if not is_cid(cid):
+            raise ValueError(f"Not a CID: {cid}")
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            os.remove(path)
+            return None
+        try:
+            os.replace(path, self._path(cid))
+        except OSError:
+            # on another filesystem, copy it over and swap it in atomically
+            temp_path = self.temp_path()
+            try:
+                shutil.copyfile(path, temp_path)
+                os.replace(temp_path, self._path(cid))
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            os.remove(path)
+        self._evict()
+        return self._path(cid)
+
+    def temp_path(self) -> str:
+        return os.path.join(self.directory, TEMP_PREFIX + uuid.uuid4().hex)
+
+    def writer(self, cid: str) -> 'CacheWriter':
+        return CacheWriter(self, cid)
+
+    def _evict(self):
+        files = self._files()
+        total = sum(size for _, _, size in files)
+        for _, cid, size in sorted(files):
+            if total <= self.max_bytes:
+                return
+            try:
+                os.remove(self._path(cid))
+            except FileNotFoundError:
+                pass  # evicted by another worker
+            total -= size
+
+    def _files(self) -> list:
+        """(mtime, cid, size) of every cached file."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if not is_cid(entry.name):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        return files
+
+    def _path(self, cid: str) -> str:
+        return os.path.join(self.directory, cid)
+
+    def __contains__(self, cid):
+        return is_cid(cid) and os.path.exists(self._path(cid))
+
+    def __len__(self):
+        return len(self._files())
+
+
+class CacheWriter:
+    """
+    Copies a download of `cid` into `cache` as it streams past, fed with
+    `write` from the thread reading the download. `close` keeps the file if
+    the bytes written hash to `cid`, an interrupted or wrong download is
+    dropped. Nothing touches the disk before the first `write`.
+    """
+
+    def __init__(self, cache: CIDCache, cid: str):
+        self.cache = cache
+        self.cid = cid
+        self._builder = CIDBuilder(0 if cid.startswith('Qm') else 1)
+        self._temp_path = None
+        self._temp = None
+        self._size = 0
+        self._closed = False
+
+    def write(self, chunk: bytes):
+        if self._closed:
+            return
+        self._size += len(chunk)
+        if self._size > self.cache.max_bytes:
+            self._discard()  # would be evicted right away
+            return
+        try:
+            if self._temp is None:
+                self._temp_path = self.cache.temp_path()
+                self._temp = open(self._temp_path, 'wb')
+            self._builder.update(chunk)
+            self._temp.write(chunk)
+        except OSError as e:
+            # the download goes on, only uncached
+            logger.warning(f"Could not cache {self.cid}: {str(e)}")
+            self._discard()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._temp is None:
+            return
+        try:
+            self._temp.close()
+            if self._builder.cid() == self.cid:
+                self.cache.add(self.cid, self._temp_path)
+                logger.info(f"Cached {self.cid} ({self._size} bytes)")
+        except OSError as e:
+            logger.warning(f"Could not cache {self.cid}: {str(e)}")
+        finally:
+            self._remove_temp()
+
+    def _discard(self):
+        self._closed = True
+        if self._temp is not None:
+            self._temp.close()
+        self._remove_temp()
+
+    def _remove_temp(self):
+        if self._temp_path is not None and os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+class GatewayFetcher:
+    """
+    Finds the gateway that answers for a CID first: asks every gateway for
+    its first byte at once and cancels the others once one answers, so one
+    slow or unreachable gateway cannot hold a read up.
+    """
+
+    def __init__(self, gateways, timeout: float = 60,
+                 max_connections: int = 32):
+        self.gateways = [gateway.rstrip('/') for gateway in gateways]
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._session = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def fastest(self, cid: str):
+        """Link to `cid` on the first gateway that has it, None if none does."""
+        await self.start()
+        tasks = [asyncio.ensure_future(self._probe(gateway, cid))
+                 for gateway in self.gateways]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except Exception as e:
+                    logger.warning(f"Gateway probe of {cid} failed: {str(e)}")
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _probe(self, gateway: str, cid: str) -> str:
+        link = f'{gateway}/ipfs/{cid}'
+        # leaving the block drops the connection of a gateway that ignored
+        # the Range header, without reading the body
+        async with self._session.get(
+                link, headers={'Range': 'bytes=0-0'}) as response:
+            if response.status not in (200, 206):
+                raise ValueError(f"{gateway} answered {response.status}")
+        return link
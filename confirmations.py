@@ -0,0 +1,108 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ConfirmationEngine:
+    """
+    Confirms every pending transaction from a single poller, so RPC load
+    grows with the number of blocks instead of the number of waiters.
+
+    `wait` registers a transaction hash. The poller follows the head with
+    eth_blockNumber every `poll_interval` seconds, and on each new block
+    (or when new waiters arrived) fetches the receipts of all pending
+    transactions with one `get_receipts` call. A waiter resolves once its
+    transaction has `confirmations` blocks, counting its own. Receipts are
+    checked again on every block until then, so a transaction dropped by a
+    reorg goes back to waiting.
+
+    `get_replacements(tx_hashes)` returns, for each hash, the hashes sent
+    with the same nonce, the newest last, so fee-bumped replacements
+    confirm the original hash. It is called once per check for all pending
+    transactions. The poller only runs while something is waiting.
+    """
+
+    def __init__(self, w3, get_receipts, get_replacements=None,
+                 confirmations: int = 1, poll_interval: float = 1.0):
+        self._w3 = w3
+        self._get_receipts = get_receipts
+        self._get_replacements = get_replacements
+        self.confirmations = max(confirmations, 1)
+        self.poll_interval = poll_interval
+        self._waiters = {}  # tx_hash -> futures
+        self._new_waiters = asyncio.Event()
+        self._task = None
+
+    async def wait(self, tx_hash: str, timeout: float = None):
+        """
+        The receipt of `tx_hash` (or of its replacement) once confirmed.
+        Raises asyncio.TimeoutError after `timeout` seconds.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(tx_hash, []).append(future)
+        self._new_waiters.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            futures = self._waiters.get(tx_hash, [])
+            if future in futures:
+                futures.remove(future)
+            if not futures:
+                self._waiters.pop(tx_hash, None)
+
+    def pending(self) -> int:
+        return len(self._waiters)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        last_head = None
+        while self._waiters:
+            try:
+                head = await self._w3.eth.block_number
+                if head != last_head or self._new_waiters.is_set():
+                    self._new_waiters.clear()
+                    await self._check(head)
+                    last_head = head
+            except Exception as e:
+                logger.error(f"Error checking pending transactions: {str(e)}")
+            if not self._waiters:
+                break
+            try:
+                # new waiters are checked right away rather than next block
+                await asyncio.wait_for(
+                    self._new_waiters.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, head: int):
+        tx_hashes = list(self._waiters)
+        candidates = await self._get_replacements(tx_hashes) \
+            if self._get_replacements else {}
+        candidates = {tx_hash: candidates.get(tx_hash) or [tx_hash]
+                      for tx_hash in tx_hashes}
+        lookups = list(dict.fromkeys(
+            candidate for hashes in candidates.values() for candidate in hashes))
+        receipts = await self._get_receipts(lookups)
+
+        for tx_hash in tx_hashes:
+            receipt = next(
+                (receipts.get(candidate) for candidate in reversed(candidates[tx_hash])
+                 if receipts.get(candidate) is not None
+                 and not isinstance(receipts.get(candidate), Exception)), None)
+            if receipt is None \
+                    or head - receipt['blockNumber'] + 1 < self.confirmations:
+                continue
+            for future in self._waiters.pop(tx_hash, []):
+                if not future.done():
+                    future.set_result(receipt)
@@ -0,0 +1,104 @@
+import asyncio
+import concurrent.futures
+import time
+import metrics
+
+CPU_QUEUE_SECONDS = metrics.Histogram(
+    'hashstorage_cpu_queue_seconds',
+    'Time CPU-bound calls waited for a slot of their operation', ['op'])
+CPU_REJECTED = metrics.Counter(
+    'hashstorage_cpu_rejected_total',
+    'CPU-bound calls turned away because their queue was full', ['op'])
+
+_DONE = object()
+
+
+class Overloaded(Exception):
+    """Raised instead of queueing a call behind `max_queue` others."""
+
+
+class CPUExecutor:
+    """
+    Runs hashing and decryption off the event loop in one shared thread
+    pool. hashlib and AES-GCM release the GIL on large buffers, so threads
+    use every core for them.
+
+    Each operation runs at most `limits[op]` calls at a time (`default_limit`
+    for the others) and lets at most `max_queue` more wait for a slot. Later
+    calls raise Overloaded right away, so a burst of large files queues up
+    to a bound and is then shed, instead of piling up behind the pool.
+    """
+
+    def __init__(self, workers: int, limits: dict = None,
+                 default_limit: int = None, max_queue: int = 64):
+        self.workers = max(1, workers)
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit or self.workers
+        self.max_queue = max_queue
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            self.workers, thread_name_prefix='cpu')
+        self._semaphores = {}
+        self._waiting = {}
+
+    def limit(self, op: str) -> int:
+        return self.limits.get(op, self.default_limit)
+
+    def queued(self, op: str) -> int:
+        return self._waiting.get(op, 0)
+
+    async def run(self, op: str, fn, *args):
+        """Call `fn(*args)` in the pool under the limits of `op`."""
+        semaphore = self._semaphore(op)
+        if semaphore.locked() and self.queued(op) >= self.max_queue:
+            CPU_REJECTED.inc(op=op)
+            raise Overloaded(f"Too many {op} operations queued")
+        return await self._call(op, semaphore, fn, *args)
+
+    async def iterate(self, op: str, iterator):
+        """
+        Async iterator over the blocking `iterator`, producing each item in
+        the pool under the limits of `op`. Streams that already started are
+        never turned away, their items only wait for a slot.
+        """
+        iterator = iter(iterator)
+        semaphore = self._semaphore(op)
+        try:
+            while True:
+                item = await self._call(op, semaphore, next, iterator, _DONE)
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                await asyncio.wrap_future(self._pool.submit(close))
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _semaphore(self, op: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(op)
+        if semaphore is None:
+            semaphore = self._semaphores[op] = asyncio.Semaphore(self.limit(op))
+        return semaphore
+
+    async def _call(self, op: str, semaphore: asyncio.Semaphore, fn, *args):
+        self._waiting[op] = self.queued(op) + 1
+        start = time.perf_counter()
+        try:
+            await semaphore.acquire()
+        finally:
+            self._waiting[op] -= 1
+        CPU_QUEUE_SECONDS.observe(time.perf_counter() - start, op=op)
+
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            semaphore.release()
+            raise
+        # the slot is held until the call returns, even when the caller
+        # stops waiting for it (a client disconnecting mid-download)
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(semaphore.release))
+        return await asyncio.wrap_future(future)
@@ -1,9 +1,15 @@
-from sqlalchemy.orm import Session
+import datetime
+import secrets
+from sqlalchemy import func, or_, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 import models
 import schemas
 
 
-def create_transaction(db: Session, transaction: schemas.TransactionCreate):
+async def create_transaction(db: AsyncSession,
+                             transaction: schemas.TransactionCreate,
+                             job: models.UploadJob = None):
     db_transaction = models.Transaction(
         user_id=transaction.user_id,
         file_name=transaction.file_name,
@@ -12,34 +18,205 @@ def create_transaction(db: Session, transaction: schemas.TransactionCreate):
         bc_hash_link=transaction.bc_hash_link,
         bc_file_link=transaction.bc_file_link,
         decrypt_key_first_last_5=transaction.decrypt_key_first_last_5,
-        timestamp=transaction.timestamp
+        timestamp=transaction.timestamp,
+        anchored_at=transaction.anchored_at,
+        merkle_root=transaction.merkle_root,
+        merkle_proof=transaction.merkle_proof,
+        onchain_hash=transaction.onchain_hash,
+        record_index=transaction.record_index,
+        block_number=transaction.block_number,
+        log_index=transaction.log_index,
+        block_timestamp=transaction.block_timestamp
     )
     db.add(db_transaction)
-    db.commit()
-    db.refresh(db_transaction)
+    # in the same commit, so no reader sees the row under the old version
+    await db.execute(
+        update(models.User)
+        .where(models.User.id == transaction.user_id)
+        .values(transactions_version=func.coalesce(
+            models.User.transactions_version, 0) + 1)
+        .execution_options(synchronize_session=False))
+    if job is not None:
+        await db.flush()
+        job.transaction_id = db_transaction.id
+        job.updated_at = datetime.datetime.utcnow()
+    # no refresh: with expire_on_commit off the row stays loaded, and a
+    # refresh would hold a connection in a new transaction
+    await db.commit()
     return db_transaction
 
 
-def get_transaction(db: Session, tr_hash: str):
-    return db.query(models.Transaction).filter(
-        models.Transaction.tr_hash == tr_hash).first()
+async def get_transaction(db: AsyncSession, tr_hash: str):
+    return (await db.scalars(select(models.Transaction).where(
+        models.Transaction.tr_hash == tr_hash).limit(1))).first()
 
 
-def get_user_transactions(db: Session, user_id: int):
-    return db.query(models.Transaction).filter(
-        models.Transaction.user_id == user_id).all()
+async def get_transactions_by_tr_hashes(db: AsyncSession, tr_hashes):
+    """Rows of all `tr_hashes` in one query, a batched anchor has several."""
+    return (await db.scalars(select(models.Transaction).where(
+        models.Transaction.tr_hash.in_(tr_hashes)).order_by(
+        models.Transaction.id))).all()
 
 
-def create_user(db: Session, user: schemas.UserCreate):
+async def get_transaction_by_id(db: AsyncSession, transaction_id: int):
+    return await db.get(models.Transaction, transaction_id)
+
+
+async def get_transaction_by_file_hash(db: AsyncSession, file_hash: str):
+    """First upload of `file_hash`, whose pin and anchor repeats reuse."""
+    return (await db.scalars(select(models.Transaction).where(
+        models.Transaction.file_hash == file_hash).order_by(
+        models.Transaction.id).limit(1))).first()
+
+
+async def get_anchor_by_hash(db: AsyncSession, onchain_hash: str):
+    """Earliest indexed anchor of `onchain_hash`."""
+    return (await db.scalars(select(models.HashAnchor).where(
+        models.HashAnchor.onchain_hash == onchain_hash).order_by(
+        models.HashAnchor.block_number, models.HashAnchor.log_index).limit(1))).first()
+
+
+async def get_batched_transaction_by_file_hash(db: AsyncSession, file_hash: str):
+    return (await db.scalars(select(models.Transaction).where(
+        models.Transaction.file_hash == file_hash,
+        models.Transaction.merkle_root.isnot(None)).limit(1))).first()
+
+
+async def get_user_transactions(db: AsyncSession, user_id: int,
+                                limit: int = None, after: tuple = None):
+    """
+    A user's transactions, newest first. `after` is the (anchored_at, id)
+    of the last row of the previous page.
+    """
+    query = select(models.Transaction).where(
+        models.Transaction.user_id == user_id)
+    if after is not None:
+        query = query.where(
+            tuple_(models.Transaction.anchored_at, models.Transaction.id)
+            < tuple_(*after))
+    query = query.order_by(
+        models.Transaction.anchored_at.desc(), models.Transaction.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return (await db.scalars(query)).all()
+
+
+async def get_transactions_version(db: AsyncSession, user_id: int) -> str:
+    """
+    Changes whenever the user gets a new transaction: the user's epoch and
+    transaction count, never repeated by a user recreated with the same id.
+    """
+    row = (await db.execute(select(
+        models.User.transactions_epoch, models.User.transactions_version).where(
+        models.User.id == user_id))).first()
+    epoch, version = row or (None, None)
+    return f"{epoch or ''}.{version or 0}"
+
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
     db_user = models.User(
         uname=user.uname,
-        pass_hash=user.pass_hash
+        pass_hash=user.pass_hash,
+        transactions_epoch=secrets.token_hex(8)
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
     return db_user
 
 
-def get_user(db: Session, uname: str):
-    return db.query(models.User).filter(models.User.uname == uname).first()
+async def get_user(db: AsyncSession, uname: str):
+    return (await db.scalars(select(models.User).where(
+        models.User.uname == uname))).first()
+
+
+async def create_upload_job(db: AsyncSession, job: models.UploadJob):
+    now = datetime.datetime.utcnow()
+    job.created_at = now
+    job.updated_at = now
+    db.add(job)
+    await db.commit()
+    return job
+
+
+async def get_upload_job(db: AsyncSession, job_id: str):
+    return await db.get(models.UploadJob, job_id)
+
+
+async def update_upload_job(db: AsyncSession, job: models.UploadJob, **fields):
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.updated_at = datetime.datetime.utcnow()
+    await db.commit()
+    return job
+
+
+def _job_unclaimed(now: datetime.datetime):
+    return or_(models.UploadJob.owner.is_(None),
+               models.UploadJob.lease_until < now)
+
+
+async def get_unfinished_upload_jobs(db: AsyncSession, terminal_states):
+    """Unfinished jobs no worker holds a lease on."""
+    return (await db.scalars(select(models.UploadJob).where(
+        models.UploadJob.status.notin_(terminal_states),
+        _job_unclaimed(datetime.datetime.utcnow())).order_by(
+        models.UploadJob.created_at))).all()
+
+
+async def claim_upload_job(db: AsyncSession, job_id: str, owner: str,
+                           lease: datetime.timedelta, terminal_states):
+    """
+    Take the lease on an unfinished job nobody holds one on. Returns the job,
+    or None when it is finished or another worker (or another task of this
+    one) runs it.
+    """
+    now = datetime.datetime.utcnow()
+    claimed = (await db.execute(update(models.UploadJob).where(
+        models.UploadJob.id == job_id,
+        models.UploadJob.status.notin_(terminal_states),
+        _job_unclaimed(now)).values(
+        owner=owner, lease_until=now + lease).returning(
+        models.UploadJob.id))).scalar()
+    await db.commit()
+    if claimed is None:
+        return None
+    return await db.get(models.UploadJob, job_id, populate_existing=True)
+
+
+async def renew_upload_job_lease(db: AsyncSession, job_id: str, owner: str,
+                                 lease: datetime.timedelta) -> bool:
+    """Extend `owner`'s lease, False if it has been lost."""
+    renewed = (await db.execute(update(models.UploadJob).where(
+        models.UploadJob.id == job_id,
+        models.UploadJob.owner == owner).values(
+        lease_until=datetime.datetime.utcnow() + lease).returning(
+        models.UploadJob.id))).scalar()
+    await db.commit()
+    return renewed is not None
+
+
+async def release_upload_job(db: AsyncSession, job_id: str, owner: str):
+    await db.execute(update(models.UploadJob).where(
+        models.UploadJob.id == job_id,
+        models.UploadJob.owner == owner).values(owner=None, lease_until=None))
+    await db.commit()
+
+
+async def get_session_state(db: AsyncSession, new_secret: str) -> models.SessionState:
+    """The shared session state, created with `new_secret` by the first worker."""
+    state = await db.get(models.SessionState, 1)
+    if state is None:
+        db.add(models.SessionState(id=1, secret=new_secret, not_before=0))
+        try:
+            await db.commit()
+        except IntegrityError:
+            # another worker created it first
+            await db.rollback()
+        state = await db.get(models.SessionState, 1, populate_existing=True)
+    return state
+
+
+async def set_sessions_not_before(db: AsyncSession, not_before: float):
+    await db.execute(update(models.SessionState).where(
+        models.SessionState.id == 1).values(not_before=not_before))
+    await db.commit()
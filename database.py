@@ -1,12 +1,63 @@
-from sqlalchemy import create_engine
+import os
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+load_dotenv()
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# any SQLAlchemy URL, plain sqlite:// and postgresql:// URLs get their async
+# driver (aiosqlite, asyncpg) filled in
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///./sql_app.db')
+# connections kept open, and how many more may be opened under load
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+# how long SQLite waits for another writer before "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+
+def get_async_url(database_url: str):
+    url = make_url(database_url)
+    if url.drivername in ASYNC_DRIVERS:
+        url = url.set(drivername=ASYNC_DRIVERS[url.drivername])
+    return url
+
+
+SQLALCHEMY_DATABASE_URL = get_async_url(DATABASE_URL)
+
+if SQLALCHEMY_DATABASE_URL.get_backend_name() == 'sqlite' \
+        and SQLALCHEMY_DATABASE_URL.database in (None, '', ':memory:'):
+    # one shared in-memory database, there is no pool to size
+    engine = create_async_engine(SQLALCHEMY_DATABASE_URL)
+else:
+    # aiosqlite defaults to no pool at all, every session would reconnect
+    engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_pre_ping=True
+    )
+
+if engine.dialect.name == 'sqlite':
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers run alongside a writer, and writers wait for
+        # each other instead of failing
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+# objects stay usable after commit, async sessions can't lazy load them
+SessionLocal = async_sessionmaker(
+    engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
@@ -6,6 +6,16 @@ import hashlib
 import sys
 import requests
 import logging
+import struct
+from stream_crypto import (
+    MAGIC, HEADER_SIZE, NAME_LENGTH_SIZE, TAG_SIZE, DEFAULT_SEGMENT_SIZE,
+    VERSION, CODEC_NONE, ContainerLayout, StreamDecryptor, decrypt_bytes,
+    encrypt_stream, header_version, is_segmented)
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+RANGE_PROBE_SIZE = 4096
+# (connect, read) seconds, read is the longest wait for the next bytes
+REQUEST_TIMEOUT = (10, 60)
 
 def encrypt_file(file_path, key):
     nonce = secrets.token_bytes(12)
@@ -22,6 +32,19 @@ def encrypt_file(file_path, key):
     return nonce + ciphertext
 
 
+def encrypt_file_segmented(file_path, out_path, key,
+                           segment_size=DEFAULT_SEGMENT_SIZE,
+                           codec=CODEC_NONE, level=None):
+    """
+    Encrypt `file_path` into `out_path` in the segmented container format,
+    compressed with `codec` (stream_crypto.CODEC_*) if that pays off.
+    """
+    with open(file_path, 'rb') as src, open(out_path, 'wb') as dst:
+        return encrypt_stream(
+            src, dst, os.path.basename(file_path), key, segment_size,
+            codec, level)
+
+
 def create_hash(data):
     hasher = hashlib.sha256()
     hasher.update(data)
@@ -39,6 +62,13 @@ def decrypt_file(encrypted_data, key):
         except Exception as e:
             logging.error(f"Error converting key to bytes: {e}")
             return None
+    if is_segmented(encrypted_data):
+        try:
+            return decrypt_bytes(encrypted_data, key)
+        except InvalidTag:
+            logging.error("except InvalidTag")
+            return None
+
     try:
         aesgcm = AESGCM(key)
     except Exception as e:
@@ -49,43 +79,279 @@ def decrypt_file(encrypted_data, key):
         decrypted_data = aesgcm.decrypt(nonce, ciphertext, None)
     except InvalidTag:
         logging.error("except InvalidTag")
-        print("Failed to decrypt. The ciphertext may have been tampered with or the wrong key was used.")
+        logging.error("Failed to decrypt. The ciphertext may have been tampered with or the wrong key was used.")
         return None
 
     filename, file_data = decrypted_data.split(b'\x00', 1)
     return filename.decode(), file_data
 
 def decrypt_file_from_link(encrypted_file_link, encryption_key):
-    response = requests.get(encrypted_file_link)
+    response = requests.get(encrypted_file_link, timeout=REQUEST_TIMEOUT)
     response.raise_for_status()  # check if request successful
     return decrypt_file(response.content, encryption_key)
 
 
-# main to test decrypt_file_from_link
-# example: 
-# python3 encrypt_and_hash.py https://gateway.pinata.cloud/ipfs/QmeFkK2V9PKD37i6cLiPxBXSAqkds4e5e8vs2vWtCHgmjX 89accf71c6c12863f0f9471ff41a85349dc1ed8d27e532bd37e2cfafc697f570
+def _key_bytes(key):
+    return bytes.fromhex(key) if isinstance(key, str) else key
+
+
+def stream_decrypt_from_link(encrypted_file_link, encryption_key, sink=None):
+    """
+    Start decrypting the file at `encrypted_file_link` while it downloads.
+
+    Returns (filename, plaintext chunk iterator, plaintext size or None).
+    Segmented containers are decrypted segment by segment, legacy files are
+    downloaded completely first. Raises InvalidTag on a wrong key.
+
+    `sink` gets every ciphertext chunk through `write` as it is read and is
+    closed with the download, e.g. a cid_cache.CacheWriter.
+    """
+    response = requests.get(
+        encrypted_file_link, stream=True, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    size = None
+    content_length = response.headers.get('Content-Length')
+    if content_length and not response.headers.get('Content-Encoding'):
+        size = int(content_length)
+    chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+    close = response.close
+    if sink is not None:
+        chunks = _tee(chunks, sink)
+
+        def close():
+            response.close()
+            sink.close()
+    return _stream_decrypt(
+        chunks, _key_bytes(encryption_key), size, close)
+
+
+def _tee(chunks, sink):
+    for chunk in chunks:
+        sink.write(chunk)
+        yield chunk
+
+
+def stream_decrypt_from_file(encrypted_file_path, encryption_key):
+    """Like stream_decrypt_from_link, for a ciphertext on local disk."""
+    file = open(encrypted_file_path, 'rb')
+    return _stream_decrypt(
+        iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''),
+        _key_bytes(encryption_key), os.fstat(file.fileno()).st_size,
+        file.close)
+
+
+def _stream_decrypt(chunks, key, ciphertext_size, close):
+    chunks = iter(chunks)
+    try:
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= len(MAGIC):
+                break
+
+        if not is_segmented(head):
+            result = decrypt_file(head + b''.join(chunks), key)
+            close()
+            if result is None:
+                raise InvalidTag()
+            filename, file_data = result
+            return filename, iter([file_data]), len(file_data)
+
+        # decrypt up to the name record before handing out the iterator
+        decryptor = StreamDecryptor(key)
+        pending = decryptor.feed_chunks(head)
+        while decryptor.filename is None:
+            chunk = next(chunks, None)
+            if chunk is None:
+                decryptor.finish()  # raises on a truncated container
+            pending = decryptor.feed_chunks(chunk)
+    except BaseException:
+        close()
+        raise
+
+    size = None
+    # the size of compressed data is only known once it is decompressed
+    if ciphertext_size is not None and decryptor.codec == CODEC_NONE:
+        size = ContainerLayout(
+            decryptor.header, decryptor.name_length,
+            ciphertext_size).plaintext_size
+
+    def plaintext_chunks():
+        try:
+            yield from pending
+            for chunk in chunks:
+                yield from decryptor.feed_chunks(chunk)
+            yield from decryptor.finish_chunks()
+        finally:
+            close()
+
+    return decryptor.filename, plaintext_chunks(), size
+
+
+def _get_range(encrypted_file_link, start, end):
+    response = requests.get(
+        encrypted_file_link, headers={'Range': f'bytes={start}-{end}'},
+        timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    if response.status_code != 206:
+        return None, None
+    total_size = int(response.headers['Content-Range'].split('/')[-1])
+    return response.content, total_size
+
+
+def _read_file_range(encrypted_file_path, start, end):
+    with open(encrypted_file_path, 'rb') as file:
+        file.seek(start)
+        return file.read(end - start + 1), os.fstat(file.fileno()).st_size
+
+
+def open_encrypted_range(encrypted_file_link, encryption_key):
+    """
+    Read the header and name record of a segmented container with a Range
+    request. Returns (filename, ContainerLayout), or None when the file is
+    in the legacy format, compressed (only decryptable from the start) or
+    the server ignores Range requests.
+    """
+    return _open_range(
+        lambda start, end: _get_range(encrypted_file_link, start, end),
+        _key_bytes(encryption_key))
+
+
+def open_encrypted_file_range(encrypted_file_path, encryption_key):
+    """Like open_encrypted_range, for a ciphertext on local disk."""
+    return _open_range(
+        lambda start, end: _read_file_range(encrypted_file_path, start, end),
+        _key_bytes(encryption_key))
+
+
+def _open_range(read_range, key):
+    probe, total_size = read_range(0, RANGE_PROBE_SIZE - 1)
+    if probe is None or not is_segmented(probe) \
+            or header_version(probe) != VERSION:
+        return None
+
+    preamble_size = HEADER_SIZE + NAME_LENGTH_SIZE
+    name_length = struct.unpack('>I', probe[HEADER_SIZE:preamble_size])[0]
+    if len(probe) < preamble_size + name_length:
+        probe, _ = read_range(0, preamble_size + name_length - 1)
+
+    layout = ContainerLayout(probe[:HEADER_SIZE], name_length, total_size)
+    decryptor = StreamDecryptor(key)
+    decryptor.feed(probe[:preamble_size + name_length])
+    return decryptor.filename, layout
+
+
+def decrypt_range_from_link(encrypted_file_link, encryption_key, layout,
+                            start, end):
+    """
+    Yield plaintext bytes start..end (inclusive) by downloading and
+    decrypting only the segments that cover them.
+    """
+    first, last = layout.segments_for(start, end)
+    cipher_start, cipher_end = layout.ciphertext_range(first, last)
+    response = requests.get(
+        encrypted_file_link,
+        headers={'Range': f'bytes={cipher_start}-{cipher_end}'},
+        stream=True, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    if response.status_code != 206:
+        response.close()
+        raise ValueError("Server ignored the Range request")
+
+    try:
+        yield from _decrypt_records(
+            response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+            _key_bytes(encryption_key), layout, start, end)
+    finally:
+        response.close()
+
+
+def decrypt_range_from_file(encrypted_file_path, encryption_key, layout,
+                            start, end):
+    """Like decrypt_range_from_link, for a ciphertext on local disk."""
+    first, last = layout.segments_for(start, end)
+    cipher_start, cipher_end = layout.ciphertext_range(first, last)
+    with open(encrypted_file_path, 'rb') as file:
+        file.seek(cipher_start)
+        remaining = cipher_end - cipher_start + 1
+
+        def chunks():
+            nonlocal remaining
+            while remaining > 0:
+                chunk = file.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+        yield from _decrypt_records(
+            chunks(), _key_bytes(encryption_key), layout, start, end)
+
+
+def _decrypt_records(chunks, key, layout, start, end):
+    """
+    Decrypt the segment records in `chunks`, which hold the ciphertext of
+    exactly the segments covering plaintext bytes start..end.
+    """
+    first, last = layout.segments_for(start, end)
+    cipher_start, cipher_end = layout.ciphertext_range(first, last)
+    record_size = layout.segment_size + TAG_SIZE
+    index = first
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        while buffer:
+            if index == last:
+                # the final segment of the file may be short
+                remaining = cipher_end - cipher_start + 1 \
+                    - (index - first) * record_size
+                if len(buffer) < remaining:
+                    break
+                record, buffer = buffer[:remaining], b''
+            elif len(buffer) >= record_size:
+                record, buffer = buffer[:record_size], buffer[record_size:]
+            else:
+                break
+
+            plaintext = layout.decrypt_segment(key, index, record)
+            segment_start = index * layout.segment_size
+            yield plaintext[max(start - segment_start, 0):
+                            end - segment_start + 1]
+            if index == last:
+                return
+            index += 1
+    raise ValueError("Range response ended early")
+
+
 def main():
     #demo file key:
     "8304ce05712e15215d2e41ea2df9f681ec20ffd298316c6b851456d25e5ae8f2"
     encrypted_file_link = sys.argv[1]
     key = sys.argv[2]
-    key = bytes.fromhex(key)
-    
-    result = decrypt_file_from_link(encrypted_file_link, key)
-    if result:
-        filename, file_data = result
+
+    try:
+        filename, plaintext_chunks, _ = stream_decrypt_from_link(
+            encrypted_file_link, key)
         print("############### decrypted file ###############\n")
         print(f"Decrypted file: {filename}")
-        with open(f"decrypted_{filename}", 'wb') as f:
-            f.write(file_data)
-            print(file_data)
-            print("\n")
-            print("File restored successfully")
-        f.close()
+        out_path = f"decrypted_{os.path.basename(filename)}"
+        with open(out_path, 'wb') as f:
+            try:
+                for chunk in plaintext_chunks:
+                    f.write(chunk)
+            except BaseException:
+                f.close()
+                os.remove(out_path)  # don't leave a partial plaintext behind
+                raise
+    except InvalidTag:
+        logging.error("Failed to decrypt. The ciphertext may have been tampered with or the wrong key was used.")
+        return
+    print("File restored successfully")
+
 
 if __name__ == "__main__":
     main()
-    
+
     # MysteryFile is the encrypted text of DemoFile
     # To demonstrate, in decryptionDemo/ run:
-    # python encrypt_and_hash.py MysteryFile 8304ce05712e15215d2e41ea2df9f681ec20ffd298316c6b851456d25e5ae8f2
\ No newline at end of file
+    # python encrypt_and_hash.py MysteryFile 8304ce05712e15215d2e41ea2df9f681ec20ffd298316c6b851456d25e5ae8f2
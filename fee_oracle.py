@@ -0,0 +1,77 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FeeOracle:
+    """
+    Caches the base fee and priority fee of the latest block.
+
+    `refresh` is meant to be called on every new head (one eth_blockNumber
+    call when nothing changed), after which `fees` costs no RPC at all. If
+    nothing refreshed the cache for `max_age` seconds, `fees` refreshes it
+    itself.
+    """
+
+    def __init__(self, w3, max_age: float = 30):
+        self._w3 = w3
+        self.max_age = max_age
+        self.block_number = None
+        self.base_fee = None
+        self.priority_fee = None
+        self._refreshed_at = 0
+
+    async def refresh(self, block=None) -> bool:
+        """
+        Pick up fees of the latest block, or of `block` if the caller already
+        has it. Returns True when a new block was seen.
+        """
+        if block is None:
+            block_number = await self._w3.eth.block_number
+            if block_number == self.block_number:
+                self._refreshed_at = time.monotonic()
+                return False
+            block = await self._w3.eth.get_block(block_number)
+        elif block['number'] == self.block_number:
+            self._refreshed_at = time.monotonic()
+            return False
+
+        priority_fee = await self._w3.eth.max_priority_fee
+        if self.block_number is None or block['number'] > self.block_number:
+            self.block_number = block['number']
+            self.base_fee = block['baseFeePerGas']
+            self.priority_fee = priority_fee
+        self._refreshed_at = time.monotonic()
+        return True
+
+    async def fees(self) -> tuple[int, int]:
+        """Returns (maxFeePerGas, maxPriorityFeePerGas) for a new transaction."""
+        if self.block_number is None \
+                or time.monotonic() - self._refreshed_at > self.max_age:
+            await self.refresh()
+        # 2x base fee covers six full blocks of base fee increases
+        return self.priority_fee + (2 * self.base_fee), self.priority_fee
+
+
+class GasEstimateCache:
+    """
+    Memoizes gas estimates per (function name, key). storeHash costs the
+    same for every hash string of the same length, so the length is the key.
+    Cached estimates get `margin_percent` headroom since storage costs can
+    differ slightly from the state they were estimated against.
+    """
+
+    def __init__(self, margin_percent: int = 110):
+        self.margin_percent = margin_percent
+        self._estimates = {}
+
+    async def get(self, function_name: str, key, estimate) -> int:
+        """`estimate` returns an awaitable gas estimate, awaited on a miss."""
+        cache_key = (function_name, key)
+        gas = self._estimates.get(cache_key)
+        if gas is None:
+            gas = await estimate() * self.margin_percent // 100
+            self._estimates[cache_key] = gas
+            logger.info(f"Cached gas estimate {gas} for {function_name} {key}")
+        return gas
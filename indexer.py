@@ -0,0 +1,124 @@
+import logging
+from web3 import Web3
+from web3.exceptions import BlockNotFound
+from sqlalchemy import delete, select
+from database import SessionLocal
+import models
+
+logger = logging.getLogger(__name__)
+
+
+class HashStoredIndexer:
+    """
+    Copies HashStored events of the HashStorage contracts into the
+    hash_anchors table so anchors can be looked up by hash. `contracts` are
+    (contract, HashStored topic) pairs, one per contract version; the
+    checkpoint is named after the first.
+
+    Each `run_once` call backfills from the checkpoint to the current head
+    with eth_getLogs. The block range of a call halves when the node rejects
+    it (too many results or a timeout) and doubles again after successes.
+    The checkpoint keeps the hash of its block; if that block is no longer
+    on the chain the indexer rewinds `reorg_depth` blocks and drops the
+    anchors it had recorded there.
+    """
+
+    def __init__(self, w3, contracts, start_block: int = 0,
+                 max_chunk: int = 10000, reorg_depth: int = 12,
+                 session_factory=SessionLocal):
+        self._w3 = w3
+        self._contracts = {contract.address: contract for contract, _ in contracts}
+        self._topics = [Web3.to_hex(topic) for _, topic in contracts]
+        self.start_block = start_block
+        self.max_chunk = max_chunk
+        self.chunk = max_chunk
+        self.reorg_depth = reorg_depth
+        self._session_factory = session_factory
+        self.name = contracts[0][0].address
+
+    async def run_once(self) -> int:
+        """Index up to the current head, returns the number of new anchors."""
+        async with self._session_factory() as db:
+            checkpoint = await db.get(models.IndexerCheckpoint, self.name)
+            if checkpoint is None:
+                checkpoint = models.IndexerCheckpoint(
+                    name=self.name, block_number=self.start_block - 1)
+                db.add(checkpoint)
+                await db.commit()
+            elif checkpoint.block_hash and not await self._on_chain(checkpoint):
+                await self._rewind(db, checkpoint)
+
+            head = await self._w3.eth.block_number
+            indexed = 0
+            while checkpoint.block_number < head:
+                from_block = checkpoint.block_number + 1
+                to_block = min(from_block + self.chunk - 1, head)
+                try:
+                    logs = await self._w3.eth.get_logs({
+                        'address': list(self._contracts),
+                        'topics': [self._topics],
+                        'fromBlock': from_block,
+                        'toBlock': to_block
+                    })
+                except Exception as e:
+                    if self.chunk == 1:
+                        raise
+                    self.chunk = max(self.chunk // 2, 1)
+                    logger.info(
+                        f"eth_getLogs {from_block}-{to_block} failed ({str(e)}), "
+                        f"retrying with {self.chunk} blocks")
+                    continue
+
+                indexed += await self._store(db, logs, from_block, to_block)
+                checkpoint.block_number = to_block
+                checkpoint.block_hash = (
+                    await self._w3.eth.get_block(to_block))['hash'].hex()
+                await db.commit()
+                self.chunk = min(self.chunk * 2, self.max_chunk)
+            return indexed
+
+    async def _on_chain(self, checkpoint) -> bool:
+        try:
+            block = await self._w3.eth.get_block(checkpoint.block_number)
+        except BlockNotFound:
+            return False
+        return block['hash'].hex() == checkpoint.block_hash
+
+    async def _rewind(self, db, checkpoint):
+        rewind_to = max(checkpoint.block_number - self.reorg_depth,
+                        self.start_block - 1)
+        logger.warning(
+            f"Reorg detected at block {checkpoint.block_number}, "
+            f"rewinding to {rewind_to}")
+        await db.execute(delete(models.HashAnchor).where(
+            models.HashAnchor.block_number > rewind_to))
+        checkpoint.block_number = rewind_to
+        checkpoint.block_hash = None if rewind_to < self.start_block \
+            else (await self._w3.eth.get_block(rewind_to))['hash'].hex()
+        await db.commit()
+
+    async def _store(self, db, logs, from_block: int, to_block: int) -> int:
+        existing = set((await db.execute(select(
+            models.HashAnchor.tx_hash, models.HashAnchor.log_index).where(
+            models.HashAnchor.block_number.between(from_block, to_block)))).all())
+        stored = 0
+        for log in logs:
+            key = (log['transactionHash'].hex(), log['logIndex'])
+            if log.get('removed') or key in existing:
+                continue
+            contract = self._contracts[log['address']]
+            args = contract.events.HashStored().process_log(log)['args']
+            onchain_hash = args['hash']
+            if isinstance(onchain_hash, bytes):
+                onchain_hash = onchain_hash.hex()  # v2 bytes32 digest
+            db.add(models.HashAnchor(
+                onchain_hash=onchain_hash,
+                tx_hash=key[0],
+                record_index=args['index'],
+                timestamp=args['timestamp'],
+                block_number=log['blockNumber'],
+                block_hash=log['blockHash'].hex(),
+                log_index=log['logIndex']))
+            existing.add(key)
+            stored += 1
+        return stored
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# pinned -> submitted -> confirmed, or failed from any stage
+JOB_QUEUED = 'queued'
+JOB_PINNED = 'pinned'
+JOB_SUBMITTED = 'submitted'
+JOB_CONFIRMED = 'confirmed'
+JOB_FAILED = 'failed'
+TERMINAL_STATES = (JOB_CONFIRMED, JOB_FAILED)
+
+
+class JobQueue:
+    """
+    In-process worker pool for persisted upload jobs.
+
+    Job state lives in the database, the queue only carries job ids, so
+    unfinished jobs can be re-enqueued after a restart. A job id already
+    waiting in the queue isn't added twice. `handler` is an async callable
+    that takes a job id, claims the job and drives it to a terminal state.
+    Subscribers receive every event published for a job.
+    """
+
+    def __init__(self, handler, workers: int = 4):
+        self._handler = handler
+        self.workers = max(1, workers)
+        self._queue = None
+        self._queued = set()
+        self._tasks = []
+        self._subscribers = {}
+
+    async def start(self, job_ids=()):
+        self._queue = asyncio.Queue()
+        for job_id in job_ids:
+            self.enqueue(job_id)
+        self._tasks = [asyncio.create_task(self._worker())
+                       for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, job_id: str):
+        if job_id in self._queued:
+            return
+        self._queued.add(job_id)
+        self._queue.put_nowait(job_id)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            try:
+                await self._handler(job_id)
+            except Exception as e:
+                logger.error(f"Error in upload job {job_id}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(job_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[job_id]
+
+    def publish(self, job_id: str, event: dict):
+        for queue in self._subscribers.get(job_id, ()):
+            queue.put_nowait(event)
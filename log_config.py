@@ -0,0 +1,58 @@
+import json
+import logging
+import logging.handlers
+import queue
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+
+# attributes every LogRecord has, anything else was passed in `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line with the time, level, logger and message, plus
+    any fields passed as `extra` to the logging call.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update((name, value) for name, value in vars(record).items()
+                     if name not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level: str = 'INFO', log_file: str = None,
+                  log_format: str = 'json'):
+    """
+    Route all logging through a queue, so logging calls never wait on the
+    terminal or the disk. The returned listener writes the records out on
+    its own thread, stop it at shutdown to flush them.
+    """
+    formatter = JSONFormatter() if log_format == 'json' \
+        else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # the queued record carries the bare message, the real handlers format it
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(
+        level=level.upper(),
+        handlers=[queue_handler],
+        force=True
+    )
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
@@ -0,0 +1,65 @@
+import hashlib
+
+# Domain separation so a leaf can never be passed off as an inner node.
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def hash_leaf(file_hash: str) -> bytes:
+    return hashlib.sha256(LEAF_PREFIX + bytes.fromhex(file_hash)).digest()
+
+
+def hash_node(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+class MerkleTree:
+    """
+    Binary SHA-256 Merkle tree over hex encoded file hashes.
+    An odd node at the end of a level is promoted to the next level as is.
+    """
+
+    def __init__(self, file_hashes: list[str]):
+        if not file_hashes:
+            raise ValueError("Cannot build a Merkle tree without leaves")
+
+        self.levels = [[hash_leaf(file_hash) for file_hash in file_hashes]]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            parents = [hash_node(level[i], level[i + 1])
+                       for i in range(0, len(level) - 1, 2)]
+            if len(level) % 2:
+                parents.append(level[-1])
+            self.levels.append(parents)
+
+    @property
+    def root(self) -> str:
+        return self.levels[-1][0].hex()
+
+    def proof(self, index: int) -> list[dict]:
+        """Sibling hashes from the leaf at `index` up to the root."""
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(level):
+                proof.append({
+                    "position": "left" if sibling < index else "right",
+                    "hash": level[sibling].hex()
+                })
+            index //= 2
+        return proof
+
+
+def compute_root(file_hash: str, proof: list[dict]) -> str:
+    node = hash_leaf(file_hash)
+    for step in proof:
+        sibling = bytes.fromhex(step["hash"])
+        if step["position"] == "left":
+            node = hash_node(sibling, node)
+        else:
+            node = hash_node(node, sibling)
+    return node.hex()
+
+
+def verify_proof(file_hash: str, proof: list[dict], root: str) -> bool:
+    return compute_root(file_hash, proof) == root.lower()
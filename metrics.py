@@ -0,0 +1,161 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, from a cached gas estimate up to a slow receipt wait
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                   5, 10, 30, 60, 120, 300)
+
+_registry = []
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = {key: _copy(value) for key, value in self._values.items()}
+        for key, value in sorted(values.items()):
+            lines.extend(self._samples(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonic count, one per combination of label values."""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, key, value):
+        yield f'{self.name}{self._format_labels(key)} {_number(value)}'
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed upper bounds."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _samples(self, key, value):
+        cumulative = 0
+        bounds = [_number(bound) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, value[:-1]):
+            cumulative += count
+            yield (f'{self.name}_bucket'
+                   f'{self._format_labels(key, [("le", bound)])} {cumulative}')
+        yield f'{self.name}_sum{self._format_labels(key)} {_number(value[-1])}'
+        yield f'{self.name}_count{self._format_labels(key)} {cumulative}'
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _copy(value):
+    return list(value) if isinstance(value, list) else value
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+STAGE_SECONDS = Histogram(
+    'hashstorage_stage_seconds',
+    'Time spent in each stage of handling uploads, verifications and decrypts',
+    ['stage'])
+ERRORS = Counter(
+    'hashstorage_errors_total', 'Errors raised by each stage', ['stage'])
+RPC_REQUESTS = Counter(
+    'hashstorage_rpc_requests_total',
+    'JSON-RPC requests sent to the Ethereum node', ['method'])
+RPC_ERRORS = Counter(
+    'hashstorage_rpc_errors_total',
+    'JSON-RPC requests that failed or returned an error', ['method'])
+HTTP_REQUEST_SECONDS = Histogram(
+    'hashstorage_http_request_seconds',
+    'Time to the response headers of each route', ['method', 'route', 'status'])
+
+
+@contextmanager
+def stage(name: str):
+    """Time the block as stage `name`, counting it as an error if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=name)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+
+def stage_iter(name: str, iterable):
+    """
+    Like `stage` for a (sync) stream: times only producing its items, not
+    the waits of whoever consumes them.
+    """
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            except Exception:
+                ERRORS.inc(stage=name)
+                raise
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        STAGE_SECONDS.observe(elapsed, stage=name)
@@ -0,0 +1,127 @@
+import datetime
+import logging
+from sqlalchemy import UniqueConstraint, bindparam, inspect, text
+from sqlalchemy.engine import Connection
+import models
+
+logger = logging.getLogger(__name__)
+
+LEGACY_TIMESTAMP_FORMAT = '%Y-%m-%d-%H-%M-%S'
+BACKFILL_BATCH_SIZE = 1000
+
+
+def run_migrations(connection: Connection):
+    """
+    Bring tables created by an older version up to the current models.
+    `create_all` only creates missing tables, this adds missing columns and
+    indexes, drops unique constraints the models no longer have and
+    backfills new columns. Every step is a no-op once applied.
+    """
+    for table in models.Base.metadata.sorted_tables:
+        if not inspect(connection).has_table(table.name):
+            continue
+        _add_missing_columns(connection, table)
+        _drop_stale_unique_constraints(connection, table)
+        _sync_indexes(connection, table)
+    _backfill_anchored_at(connection)
+
+
+def _add_missing_columns(connection: Connection, table):
+    existing = {column['name']
+                for column in inspect(connection).get_columns(table.name)}
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        column_type = column.type.compile(dialect=connection.dialect)
+        connection.execute(text(
+            f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        logger.info(f"Added column {table.name}.{column.name}")
+
+
+def _drop_stale_unique_constraints(connection: Connection, table):
+    wanted = {tuple(sorted(column.name for column in constraint.columns))
+              for constraint in table.constraints
+              if isinstance(constraint, UniqueConstraint)}
+    wanted |= {(column.name,) for column in table.columns if column.unique}
+    stale = [constraint for constraint
+             in inspect(connection).get_unique_constraints(table.name)
+             if tuple(sorted(constraint['column_names'])) not in wanted]
+    if not stale:
+        return
+
+    if connection.dialect.name == 'sqlite':
+        # SQLite can't drop a constraint, the table has to be rebuilt
+        _rebuild_sqlite_table(connection, table)
+    else:
+        for constraint in stale:
+            connection.execute(text(
+                f'ALTER TABLE {table.name} DROP CONSTRAINT {constraint["name"]}'))
+    for constraint in stale:
+        logger.info(f"Dropped unique constraint on {table.name}"
+                    f"({', '.join(constraint['column_names'])})")
+
+
+def _rebuild_sqlite_table(connection: Connection, table):
+    old_name = f'_{table.name}_old'
+    for index in inspect(connection).get_indexes(table.name):
+        connection.execute(text(f'DROP INDEX {index["name"]}'))
+    columns = ', '.join(
+        column['name'] for column in inspect(connection).get_columns(table.name)
+        if column['name'] in table.columns)
+    connection.execute(text(f'ALTER TABLE {table.name} RENAME TO {old_name}'))
+    table.create(connection)
+    connection.execute(text(
+        f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}'))
+    connection.execute(text(f'DROP TABLE {old_name}'))
+
+
+def _sync_indexes(connection: Connection, table):
+    existing = {index['name']: index
+                for index in inspect(connection).get_indexes(table.name)}
+    for index in table.indexes:
+        found = existing.get(index.name)
+        if found is not None and bool(found['unique']) == bool(index.unique):
+            continue
+        if found is not None:
+            # e.g. tr_hash was unique before batched anchoring
+            connection.execute(text(f'DROP INDEX {index.name}'))
+        index.create(connection)
+        logger.info(f"Created index {index.name}")
+
+
+def _backfill_anchored_at(connection: Connection):
+    transactions = models.Transaction.__table__
+    while True:
+        rows = connection.execute(
+            transactions.select()
+            .with_only_columns(
+                transactions.c.id, transactions.c.timestamp,
+                transactions.c.block_timestamp)
+            .where(transactions.c.anchored_at.is_(None))
+            .limit(BACKFILL_BATCH_SIZE)).all()
+        if not rows:
+            return
+        connection.execute(
+            transactions.update()
+            .where(transactions.c.id == bindparam('row_id'))
+            .values(anchored_at=bindparam('anchored_at')),
+            [{'row_id': row.id,
+              'anchored_at': parse_anchored_at(row.timestamp, row.block_timestamp)}
+             for row in rows])
+        logger.info(f"Backfilled anchored_at of {len(rows)} transactions")
+
+
+def parse_anchored_at(timestamp: str, block_timestamp: int = None):
+    """
+    UTC time of an anchor, from the block timestamp when known, otherwise
+    from the local time string of the timestamp column. Unparseable strings
+    give the epoch so the row still sorts and is never backfilled again.
+    """
+    if block_timestamp is not None:
+        return datetime.datetime.fromtimestamp(
+            block_timestamp, datetime.timezone.utc).replace(tzinfo=None)
+    try:
+        local = datetime.datetime.strptime(timestamp, LEGACY_TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        return datetime.datetime(1970, 1, 1)
+    return local.astimezone(datetime.timezone.utc).replace(tzinfo=None)
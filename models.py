@@ -1,18 +1,33 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, String, Text, UniqueConstraint
 from sqlalchemy.orm import relationship
 from database import Base
 
 
 class Transaction(Base):
     __tablename__ = "transactions"
+    # a user's transactions newest first, see crud.get_user_transactions
+    __table_args__ = (
+        Index("ix_transactions_user_anchored", "user_id", "anchored_at", "id"),)
     id = Column(Integer, primary_key=True)
     file_name = Column(String)
-    file_hash = Column(String)
-    tr_hash = Column(String, unique=True, index=True)
-    bc_hash_link = Column(String, unique=True)
-    bc_file_link = Column(String, unique=True)
+    # not unique: a file uploaded again, by anyone, reuses the first
+    # upload's pin and anchor
+    file_hash = Column(String, index=True)
+    # not unique: every file of a Merkle batch shares the anchoring transaction
+    tr_hash = Column(String, index=True)
+    bc_hash_link = Column(String)
+    bc_file_link = Column(String)
     decrypt_key_first_last_5 = Column(String)
     timestamp = Column(String)
+    anchored_at = Column(DateTime, nullable=True)  # timestamp as UTC, for sorting
+    merkle_root = Column(String, nullable=True)  # anchored root when batched
+    merkle_proof = Column(Text, nullable=True)  # JSON list of sibling steps
+    # decoded HashStored event, so /verify needs no receipt lookup
+    onchain_hash = Column(String, nullable=True)
+    record_index = Column(Integer, nullable=True)
+    block_number = Column(Integer, nullable=True)
+    log_index = Column(Integer, nullable=True)
+    block_timestamp = Column(Integer, nullable=True)
     user_id = Column(Integer, ForeignKey("users.id"))
 
     user = relationship("User", back_populates="transactions")
@@ -23,5 +38,85 @@ class User(Base):
     id = Column(Integer, primary_key=True)
     uname = Column(String, unique=True, index=True)
     pass_hash = Column(String)
+    # bumped with every new transaction, versions /transactions responses
+    transactions_version = Column(Integer, default=0)
+    # random per user, a user recreated after /reset-all-data with the same
+    # id never reuses an old version
+    transactions_epoch = Column(String, nullable=True)
 
     transactions = relationship("Transaction", back_populates="user")
+
+
+class UploadJob(Base):
+    __tablename__ = "upload_jobs"
+    id = Column(String, primary_key=True)  # uuid4 hex
+    user_id = Column(Integer, ForeignKey("users.id"))
+    file_name = Column(String)
+    file_hash = Column(String)
+    decrypt_key_first_last_5 = Column(String)
+    spool_path = Column(String)  # ciphertext on local disk until confirmed
+    status = Column(String, index=True)
+    ipfs_hash = Column(String, nullable=True)
+    tx_hash = Column(String, nullable=True)
+    # set in the commit that records the row, a resumed job never records twice
+    transaction_id = Column(Integer, nullable=True)
+    # worker running the job until lease_until, see crud.claim_upload_job
+    owner = Column(String, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+
+
+class NonceState(Base):
+    __tablename__ = "nonce_state"
+    address = Column(String, primary_key=True)
+    next_nonce = Column(Integer)  # next nonce never handed out before
+
+
+class ChainTransaction(Base):
+    """One row per nonce reserved by the sending account."""
+    __tablename__ = "chain_transactions"
+    __table_args__ = (UniqueConstraint("address", "nonce"),)
+    id = Column(Integer, primary_key=True)
+    address = Column(String)
+    nonce = Column(Integer)
+    status = Column(String, index=True)  # reserved, released, pending, confirmed
+    hash_value = Column(String, nullable=True)  # storeHash argument, None for gap fillers
+    first_tx_hash = Column(String, nullable=True, index=True)  # hash callers wait on
+    tx_hash = Column(String, nullable=True, index=True)  # latest broadcast
+    tx_hashes = Column(Text, nullable=True)  # JSON list of every broadcast
+    gas = Column(Integer, nullable=True)
+    max_fee_per_gas = Column(BigInteger, nullable=True)
+    max_priority_fee_per_gas = Column(BigInteger, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime)
+
+
+class HashAnchor(Base):
+    """A HashStored event found on chain by the indexer."""
+    __tablename__ = "hash_anchors"
+    __table_args__ = (UniqueConstraint("tx_hash", "log_index"),)
+    id = Column(Integer, primary_key=True)
+    onchain_hash = Column(String, index=True)
+    tx_hash = Column(String, index=True)
+    record_index = Column(Integer)
+    timestamp = Column(Integer)
+    block_number = Column(Integer, index=True)
+    block_hash = Column(String)
+    log_index = Column(Integer)
+
+
+class IndexerCheckpoint(Base):
+    __tablename__ = "indexer_checkpoints"
+    name = Column(String, primary_key=True)  # indexed contract address
+    block_number = Column(Integer)  # last block fully indexed
+    block_hash = Column(String, nullable=True)
+
+
+class SessionState(Base):
+    """Session settings every worker shares, a single row with id 1."""
+    __tablename__ = "session_state"
+    id = Column(Integer, primary_key=True)
+    secret = Column(String)  # signing key when SESSION_SECRET isn't set
+    not_before = Column(Float, default=0)  # tokens issued earlier are revoked
@@ -0,0 +1,202 @@
+import datetime
+import json
+import logging
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from database import SessionLocal
+import models
+
+logger = logging.getLogger(__name__)
+
+NONCE_RESERVED = 'reserved'
+NONCE_RELEASED = 'released'
+NONCE_PENDING = 'pending'
+NONCE_CONFIRMED = 'confirmed'
+
+
+class NonceManager:
+    """
+    Hands out nonces for `address` from a counter kept in the database, so
+    several uvicorn workers sharing the database never reuse a nonce.
+
+    Every reserved nonce gets a models.ChainTransaction row that follows it
+    through reserved -> pending -> confirmed. A nonce whose transaction could
+    not be sent is released and handed out again before the counter moves on.
+    The counter is seeded by `sync` with the account's pending transaction
+    count on chain.
+    """
+
+    def __init__(self, address: str, session_factory=SessionLocal):
+        self.address = address
+        self._session_factory = session_factory
+
+    async def sync(self, chain_nonce: int):
+        """Move the counter up to the chain's pending nonce if it is behind."""
+        async with self._session_factory() as db:
+            try:
+                state = await db.get(models.NonceState, self.address)
+                if state is None:
+                    db.add(models.NonceState(
+                        address=self.address, next_nonce=chain_nonce))
+                elif state.next_nonce < chain_nonce:
+                    logger.warning(
+                        f"Nonce counter {state.next_nonce} behind chain {chain_nonce}")
+                    await db.execute(update(models.NonceState).where(
+                        models.NonceState.address == self.address,
+                        models.NonceState.next_nonce < chain_nonce).values(
+                        next_nonce=chain_nonce))
+                await db.commit()
+            except IntegrityError:
+                # another worker created the row first
+                await db.rollback()
+
+    async def reserve(self):
+        """The next nonce to send with, or None before the first `sync`."""
+        async with self._session_factory() as db:
+            nonce = await self._claim_released(db)
+            if nonce is None:
+                nonce = await self._next_from_counter(db)
+                if nonce is None:
+                    # counter not seeded yet, see sync
+                    await db.rollback()
+                    return None
+                db.add(models.ChainTransaction(
+                    address=self.address, nonce=nonce, status=NONCE_RESERVED,
+                    updated_at=_now()))
+            await db.commit()
+            return nonce
+
+    async def _claim_released(self, db, nonce: int = None):
+        lowest = select(models.ChainTransaction.id).where(
+            models.ChainTransaction.address == self.address,
+            models.ChainTransaction.status == NONCE_RELEASED)
+        if nonce is not None:
+            lowest = lowest.where(models.ChainTransaction.nonce == nonce)
+        lowest = lowest.order_by(models.ChainTransaction.nonce).limit(1)
+
+        return (await db.execute(update(models.ChainTransaction).where(
+            models.ChainTransaction.id == lowest.scalar_subquery(),
+            models.ChainTransaction.status == NONCE_RELEASED).values(
+            status=NONCE_RESERVED, updated_at=_now()).returning(
+            models.ChainTransaction.nonce))).scalar()
+
+    async def _next_from_counter(self, db):
+        next_nonce = (await db.execute(update(models.NonceState).where(
+            models.NonceState.address == self.address).values(
+            next_nonce=models.NonceState.next_nonce + 1).returning(
+            models.NonceState.next_nonce))).scalar()
+        return None if next_nonce is None else next_nonce - 1
+
+    async def claim_gap(self, nonce: int) -> bool:
+        """Reserve a specific released nonce, False if someone else took it."""
+        async with self._session_factory() as db:
+            claimed = await self._claim_released(db, nonce) is not None
+            await db.commit()
+            return claimed
+
+    async def release(self, nonce: int):
+        await self._update(nonce, status=NONCE_RELEASED)
+
+    async def mark_sent(self, nonce: int, tx_hash: str, hash_value: str,
+                        gas: int, max_fee_per_gas: int,
+                        max_priority_fee_per_gas: int):
+        await self._update(
+            nonce, status=NONCE_PENDING, hash_value=hash_value, gas=gas,
+            first_tx_hash=tx_hash, tx_hash=tx_hash,
+            tx_hashes=json.dumps([tx_hash]),
+            max_fee_per_gas=max_fee_per_gas,
+            max_priority_fee_per_gas=max_priority_fee_per_gas,
+            sent_at=_now())
+
+    async def mark_replaced(self, record: models.ChainTransaction,
+                            tx_hash: str, max_fee_per_gas: int,
+                            max_priority_fee_per_gas: int):
+        tx_hashes = json.loads(record.tx_hashes or '[]') + [tx_hash]
+        await self._update(
+            record.nonce, tx_hash=tx_hash, tx_hashes=json.dumps(tx_hashes),
+            max_fee_per_gas=max_fee_per_gas,
+            max_priority_fee_per_gas=max_priority_fee_per_gas,
+            sent_at=_now())
+
+    async def mark_confirmed(self, nonce: int, tx_hash: str):
+        await self._update(nonce, status=NONCE_CONFIRMED, tx_hash=tx_hash)
+
+    async def find(self, tx_hash: str):
+        """The row of the nonce `tx_hash` was first or last broadcast with."""
+        async with self._session_factory() as db:
+            return (await db.execute(select(models.ChainTransaction).where(
+                models.ChainTransaction.address == self.address,
+                or_(models.ChainTransaction.first_tx_hash == tx_hash,
+                    models.ChainTransaction.tx_hash == tx_hash)))).scalar()
+
+    async def find_many(self, tx_hashes) -> dict:
+        """Like find for all `tx_hashes` in one query, {tx_hash: row}."""
+        tx_hashes = list(tx_hashes)
+        async with self._session_factory() as db:
+            records = (await db.scalars(select(models.ChainTransaction).where(
+                models.ChainTransaction.address == self.address,
+                or_(models.ChainTransaction.first_tx_hash.in_(tx_hashes),
+                    models.ChainTransaction.tx_hash.in_(tx_hashes))))).all()
+        found = {}
+        for record in records:
+            for tx_hash in (record.first_tx_hash, record.tx_hash):
+                if tx_hash in tx_hashes:
+                    found[tx_hash] = record
+        return found
+
+    async def settle(self, confirmed_count: int):
+        """
+        Everything below the confirmed count has been mined: mark pending
+        rows confirmed and drop released nonces that are no longer usable.
+        """
+        async with self._session_factory() as db:
+            await db.execute(update(models.ChainTransaction).where(
+                models.ChainTransaction.address == self.address,
+                models.ChainTransaction.nonce < confirmed_count,
+                models.ChainTransaction.status == NONCE_PENDING).values(
+                status=NONCE_CONFIRMED, updated_at=_now()))
+            await db.execute(delete(models.ChainTransaction).where(
+                models.ChainTransaction.address == self.address,
+                models.ChainTransaction.nonce < confirmed_count,
+                models.ChainTransaction.status == NONCE_RELEASED))
+            await db.commit()
+
+    async def release_stale(self, older_than: datetime.timedelta):
+        """Release nonces reserved by a sender that never came back."""
+        async with self._session_factory() as db:
+            await db.execute(update(models.ChainTransaction).where(
+                models.ChainTransaction.address == self.address,
+                models.ChainTransaction.status == NONCE_RESERVED,
+                models.ChainTransaction.updated_at < _now() - older_than).values(
+                status=NONCE_RELEASED, updated_at=_now()))
+            await db.commit()
+
+    async def stuck(self, older_than: datetime.timedelta) -> list:
+        """Pending transactions last broadcast more than `older_than` ago."""
+        return await self._records(
+            models.ChainTransaction.status == NONCE_PENDING,
+            models.ChainTransaction.sent_at < _now() - older_than)
+
+    async def gaps(self, older_than: datetime.timedelta) -> list[int]:
+        """Released nonces nobody has reused for `older_than`."""
+        return [record.nonce for record in await self._records(
+            models.ChainTransaction.status == NONCE_RELEASED,
+            models.ChainTransaction.updated_at < _now() - older_than)]
+
+    async def _records(self, *criteria) -> list:
+        async with self._session_factory() as db:
+            return (await db.execute(select(models.ChainTransaction).where(
+                models.ChainTransaction.address == self.address,
+                *criteria).order_by(models.ChainTransaction.nonce))).scalars().all()
+
+    async def _update(self, nonce: int, **fields):
+        async with self._session_factory() as db:
+            await db.execute(update(models.ChainTransaction).where(
+                models.ChainTransaction.address == self.address,
+                models.ChainTransaction.nonce == nonce).values(
+                updated_at=_now(), **fields))
+            await db.commit()
+
+
+def _now():
+    return datetime.datetime.utcnow()
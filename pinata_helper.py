@@ -1,56 +1,331 @@
+import asyncio
+import json
+import logging
 import os
-import requests
+import random
+import uuid
+import aiohttp
 from dotenv import load_dotenv
+import metrics
 
 load_dotenv()
 
 PINATA_API_KEY = os.getenv('PINATA_API_KEY')
 PINATA_SECRET_KEY = os.getenv('PINATA_SECRET_KEY')
 
-# Add debug prints
-print(f"PINATA_API_KEY loaded: {'Yes' if PINATA_API_KEY else 'No'}")
-print(f"PINATA_SECRET_KEY loaded: {'Yes' if PINATA_SECRET_KEY else 'No'}")
+# point these at a local fake Pinata for benchmarks
+PINATA_API_URL = os.getenv('PINATA_API_URL', 'https://api.pinata.cloud').rstrip('/')
+PINATA_GATEWAY_URL = os.getenv(
+    'PINATA_GATEWAY_URL', 'https://gateway.pinata.cloud').rstrip('/')
 
+# keep-alive connections to Pinata, and how many requests may be in flight
+PINATA_MAX_CONNECTIONS = int(os.getenv('PINATA_MAX_CONNECTIONS', '32'))
+PINATA_CONCURRENCY = int(os.getenv('PINATA_CONCURRENCY', '8'))
+# attempts after the first one, all of them within PINATA_DEADLINE seconds
+PINATA_RETRIES = int(os.getenv('PINATA_RETRIES', '3'))
+PINATA_DEADLINE = float(os.getenv('PINATA_DEADLINE', '300'))
+# 0 pins as Qm... CIDv0, 1 as CIDv1 with raw leaves
+PINATA_CID_VERSION = int(os.getenv('PINATA_CID_VERSION', '0'))
 
-def upload_to_pinata(file_content: bytes) -> str:
-    try:
-        url = "https://api.pinata.cloud/pinning/pinFileToIPFS"
+STREAM_CHUNK_SIZE = 1024 * 1024
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 10.0
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
 
-        # Print the headers being sent
-        headers = {
-            'pinata_api_key': PINATA_API_KEY,
-            'pinata_secret_api_key': PINATA_SECRET_KEY
-        }
-        print(f"Headers being sent: {headers}")
+logger = logging.getLogger(__name__)
 
-        files = {
-            'file': file_content
-        }
+if not PINATA_API_KEY or not PINATA_SECRET_KEY:
+    logger.warning("PINATA_API_KEY or PINATA_SECRET_KEY is not set")
 
-        response = requests.post(url, headers=headers, files=files)
 
-        if response.status_code == 200:
-            return response.json()['IpfsHash']
-        else:
-            print(f"Error uploading to Pinata: {response.text}")
-            return None
+class PinataError(Exception):
+    pass
 
-    except Exception as e:
-        print(f"Error in upload_to_pinata: {str(e)}")
-        return None
 
+class _RetryableError(Exception):
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
 
-def get_from_pinata(ipfs_hash: str) -> bytes:
-    try:
-        gateway_url = f"https://gateway.pinata.cloud/ipfs/{ipfs_hash}"
-        response = requests.get(gateway_url)
 
-        if response.status_code == 200:
-            return response.content
-        else:
-            print(f"Error fetching from Pinata: {response.text}")
-            return None
+class MultipartFileStream:
+    """
+    File-like multipart/form-data body with a text part per item of
+    `fields` and a file part per (filename, fileobj, size) in `files`.
 
-    except Exception as e:
-        print(f"Error in get_from_pinata: {str(e)}")
-        return None
+    File parts are read from their file objects on demand, so uploads are
+    streamed with a known Content-Length instead of built in memory.
+    """
+
+    def __init__(self, files, field_name: str = 'file', fields=None):
+        self.boundary = uuid.uuid4().hex
+        self._parts = []
+        self._length = 0
+        for name, value in (fields or {}).items():
+            part = (
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n'
+            ).encode()
+            self._parts.append([part, None, 0, b''])
+            self._length += len(part)
+        for filename, fileobj, size in files:
+            preamble = (
+                f'--{self.boundary}\r\n'
+                f'Content-Disposition: form-data; name="{field_name}"; '
+                f'filename="{filename}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n'
+            ).encode()
+            self._parts.append([preamble, fileobj, size, b'\r\n'])
+            self._length += len(preamble) + size + 2
+        epilogue = f'--{self.boundary}--\r\n'.encode()
+        self._parts.append([epilogue, None, 0, b''])
+        self._length += len(epilogue)
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        while self._parts:
+            part = self._parts[0]
+            preamble, fileobj, remaining, trailer = part
+            if preamble:
+                part[0] = b''
+                return preamble
+            if remaining > 0:
+                chunk = fileobj.read(
+                    remaining if size < 0 else min(size, remaining))
+                if not chunk:
+                    raise IOError("File ended before its declared size")
+                part[2] -= len(chunk)
+                return chunk
+            self._parts.pop(0)
+            if trailer:
+                return trailer
+        return b''
+
+
+class PinataClient:
+    """
+    Async Pinata client sharing one pool of keep-alive connections.
+
+    At most `concurrency` requests are in flight at once. Failed requests
+    (connection errors, timeouts, 408/429/5xx) are retried up to `retries`
+    times with jittered exponential backoff, as long as the whole call stays
+    within `deadline` seconds. Retries read the files again from the start,
+    so they have to be seekable.
+    """
+
+    def __init__(self, api_url: str = PINATA_API_URL,
+                 max_connections: int = PINATA_MAX_CONNECTIONS,
+                 concurrency: int = PINATA_CONCURRENCY,
+                 retries: int = PINATA_RETRIES,
+                 deadline: float = PINATA_DEADLINE,
+                 cid_version: int = PINATA_CID_VERSION):
+        self.api_url = api_url
+        self.max_connections = max_connections
+        self.retries = retries
+        self.deadline = deadline
+        self.cid_version = cid_version
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._session = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections, keepalive_timeout=60),
+                headers={
+                    'pinata_api_key': PINATA_API_KEY or '',
+                    'pinata_secret_api_key': PINATA_SECRET_KEY or ''
+                })
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def pin_file(self, fileobj, size: int, filename: str = 'file') -> str:
+        """
+        Pin `size` bytes read from `fileobj` and return their CID.
+        Errors raised by `fileobj.read` (e.g. a size limit) are not retried.
+        """
+        return await self._pin([(filename, fileobj, size)])
+
+    async def pin_files(self, files) -> list[str]:
+        """
+        Pin several (fileobj, size) pairs as one directory in a single
+        request. Returns a "<directory CID>/<name>" path for each file.
+        """
+        directory = uuid.uuid4().hex
+        names = [str(index) for index in range(len(files))]
+        cid = await self._pin([
+            (f'{directory}/{name}', fileobj, size)
+            for name, (fileobj, size) in zip(names, files)])
+        return [f'{cid}/{name}' for name in names]
+
+    async def _pin(self, files) -> str:
+        body_errors = []
+
+        async def attempt(timeout):
+            for _, fileobj, _ in files:
+                fileobj.seek(0)
+            body = MultipartFileStream(files, fields={
+                'pinataOptions': json.dumps({'cidVersion': self.cid_version})})
+            try:
+                async with self._session.post(
+                        f'{self.api_url}/pinning/pinFileToIPFS',
+                        data=_stream_body(body, body_errors),
+                        headers={
+                            'Content-Type': body.content_type,
+                            'Content-Length': str(len(body))
+                        },
+                        timeout=timeout) as response:
+                    await self._check(response)
+                    return (await response.json())['IpfsHash']
+            except Exception:
+                if body_errors:
+                    raise body_errors[0]
+                raise
+
+        with metrics.stage('pinata_pin'):
+            return await self._with_retries('pin', attempt)
+
+    async def _with_retries(self, what: str, attempt):
+        await self.start()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        tries = 0
+        while True:
+            remaining = deadline - loop.time()
+            try:
+                async with self._semaphore:
+                    return await attempt(aiohttp.ClientTimeout(total=remaining))
+            except (_RetryableError, aiohttp.ClientError,
+                    asyncio.TimeoutError) as e:
+                error = e
+
+            if tries >= self.retries:
+                raise PinataError(f"{what} failed after {tries + 1} attempts: {error}")
+            # full jitter keeps retrying clients from hitting Pinata in lockstep
+            delay = random.uniform(
+                0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** tries))
+            if getattr(error, 'retry_after', None) is not None:
+                delay = max(delay, error.retry_after)
+            if loop.time() + delay >= deadline:
+                raise PinataError(f"{what} ran out of time: {error}")
+            tries += 1
+            logger.warning(
+                f"Pinata {what} failed ({error}), retry {tries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _check(response):
+        if response.status == 200:
+            return
+        text = await response.text()
+        if response.status in RETRY_STATUSES:
+            retry_after = response.headers.get('Retry-After')
+            raise _RetryableError(
+                f"HTTP {response.status}: {text}",
+                float(retry_after) if retry_after and retry_after.isdigit() else None)
+        raise PinataError(f"HTTP {response.status}: {text}")
+
+
+async def _stream_body(body: MultipartFileStream, errors: list):
+    while True:
+        try:
+            chunk = await asyncio.to_thread(body.read, STREAM_CHUNK_SIZE)
+        except Exception as e:
+            # remembered so the caller sees it instead of a connection error
+            errors.append(e)
+            raise
+        if not chunk:
+            return
+        yield chunk
+
+
+class PinBatcher:
+    """
+    Pins files that arrive close together as one directory upload.
+
+    A batch is sent once `max_size` files are pending or `max_wait` seconds
+    after the first file arrived. A batch of one is pinned as a plain file.
+    If a directory upload fails its files are pinned one by one, so a single
+    bad file only fails its own upload.
+    """
+
+    def __init__(self, client: PinataClient, max_size: int = 8,
+                 max_wait: float = 0.2):
+        self._client = client
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, fileobj, size: int) -> str:
+        """Queue a file for the next batch, returns its CID or CID path."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((fileobj, size, future))
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        task = asyncio.ensure_future(self._pin_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _pin_batch(self, batch):
+        if len(batch) > 1:
+            try:
+                paths = await self._client.pin_files(
+                    [(fileobj, size) for fileobj, size, _ in batch])
+            except Exception as e:
+                logger.warning(
+                    f"Pinning batch of {len(batch)} files failed ({str(e)}), "
+                    "pinning them one by one")
+            else:
+                logger.info(f"Pinned batch of {len(batch)} files")
+                for path, (_, _, future) in zip(paths, batch):
+                    if not future.done():
+                        future.set_result(path)
+                return
+
+        await asyncio.gather(*(
+            self._pin_one(fileobj, size, future)
+            for fileobj, size, future in batch))
+
+    async def _pin_one(self, fileobj, size: int, future):
+        try:
+            cid = await self._client.pin_file(fileobj, size)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(cid)
+
+    async def close(self):
+        """Pin whatever is pending and wait for in-flight batches."""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
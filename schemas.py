@@ -1,3 +1,5 @@
+import datetime
+from typing import Optional
 from pydantic import BaseModel
 
 
@@ -13,6 +15,14 @@ class TransactionCreate(TransactionBase):
     bc_file_link: str  # link to distributed file storage
     decrypt_key_first_last_5: str
     timestamp: str
+    anchored_at: Optional[datetime.datetime] = None  # UTC
+    merkle_root: Optional[str] = None  # set when anchored as part of a batch
+    merkle_proof: Optional[str] = None  # JSON encoded inclusion proof
+    onchain_hash: Optional[str] = None  # hash in the HashStored event
+    record_index: Optional[int] = None
+    block_number: Optional[int] = None
+    log_index: Optional[int] = None
+    block_timestamp: Optional[int] = None
 
 
 class Transaction(TransactionCreate):
@@ -40,6 +50,12 @@ class User(UserCreate):
         from_attributes = True
 
 
+class Token(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    expires_in: int  # seconds
+
+
 class UploadResponse(BaseModel):
     file_name: str
     file_hash: str
@@ -48,6 +64,11 @@ class UploadResponse(BaseModel):
     timestamp: str
     ipfs_hash: str
     ipfs_link: str
+    merkle_root: Optional[str] = None
+    merkle_proof: Optional[list[dict]] = None
+    size_bytes: Optional[int] = None
+    pin_bytes_per_sec: Optional[float] = None  # pin throughput
+    deduplicated: bool = False  # file was pinned and anchored before
 
     class Config:
         orm_mode = True
@@ -55,10 +76,54 @@ class UploadResponse(BaseModel):
 
 
 class VerifyResponse(BaseModel):
-    file_name: str
+    file_name: Optional[str] = None  # None for someone else's deduplicated upload
     file_hash: str
     timestamp: str
     bc_file_link: str
+    merkle_root: Optional[str] = None
+
+    class Config:
+        orm_mode = True
+        from_attributes = True
+
+
+class BatchVerifyResult(BaseModel):
+    tx_hash: str
+    file_hash: Optional[str] = None
+    verified: bool
+    file_name: Optional[str] = None
+    timestamp: Optional[str] = None
+    bc_file_link: Optional[str] = None
+    merkle_root: Optional[str] = None
+    error: Optional[str] = None  # why the item did not verify
+
+
+class VerifyByHashResponse(BaseModel):
+    file_hash: str
+    tx_hash: str
+    record_index: int
+    block_number: int
+    timestamp: str
+    merkle_root: Optional[str] = None  # set when the file was anchored in a batch
+
+
+class AnchoredResponse(BaseModel):
+    file_hash: str
+    anchored: bool
+    timestamp: Optional[str] = None  # time of the first anchor
+    merkle_root: Optional[str] = None  # set when the file was anchored in a batch
+
+
+class UploadJob(BaseModel):
+    id: str  # job id to poll at /jobs/{id}
+    file_name: str
+    file_hash: str
+    status: str  # queued, pinned, submitted, confirmed or failed
+    ipfs_hash: Optional[str] = None
+    tx_hash: Optional[str] = None
+    error: Optional[str] = None
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
 
     class Config:
         orm_mode = True
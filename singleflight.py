@@ -0,0 +1,39 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time. Callers arriving while the call for
+    their key is running wait for it and share its result or exception.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn) -> tuple:
+        """
+        Await `fn()` unless a call for `key` is already running. Returns
+        (result, joined) where joined is True for callers that waited on
+        someone else's call.
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        # nobody may be waiting, don't warn about an unretrieved exception
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
@@ -0,0 +1,329 @@
+"""
+Segmented AES-GCM container.
+
+Layout (all integers big endian):
+
+    header       MAGIC (6) | version u8 | flags u8 | segment_size u32 | nonce_prefix (7)
+    name record  length u32 | AES-GCM(filename)
+    segments     AES-GCM(plaintext[i * segment_size:(i + 1) * segment_size]) ...
+
+Every record is sealed with the nonce nonce_prefix | counter u32 | last u8,
+where the name record uses counter 0 and data segment i uses counter i + 1.
+The header is the associated data of every record, so segments cannot be
+reordered, dropped, truncated at a segment boundary or moved between files.
+The last data segment carries last = 1 and is the only one that may be
+shorter than segment_size (an empty file is a single empty last segment).
+
+Version 2 compresses the data: the name record holds codec u8 | filename,
+and the segments hold the compressed stream cut into segment_size pieces.
+Plaintext offsets no longer map to segments, so version 2 containers are
+only decrypted from the start. Uncompressed files are still written as
+version 1.
+
+Files produced by encrypt_and_hash.encrypt_file (nonce | ciphertext of
+filename \\x00 data) do not start with MAGIC and are handled as legacy.
+"""
+import secrets
+import struct
+import zlib
+import zstandard
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+MAGIC = b'IPFSEG'
+VERSION = 1
+COMPRESSED_VERSION = 2
+HEADER_SIZE = len(MAGIC) + 1 + 1 + 4 + 7
+NAME_LENGTH_SIZE = 4
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODECS = {'none': CODEC_NONE, 'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+# data whose first segment compresses to more than this share of its size
+# is stored uncompressed
+COMPRESSION_MIN_SAVING = 0.1
+# compressed bytes decompressed per call; a segment can expand thousandfold
+# (zstd goes past 30000:1), so its output is produced a slice at a time
+DECOMPRESS_SLICE = 256
+
+
+class ContainerError(ValueError):
+    pass
+
+
+def is_segmented(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def _nonce(prefix: bytes, counter: int, last: bool) -> bytes:
+    return prefix + struct.pack('>IB', counter, 1 if last else 0)
+
+
+def pack_header(segment_size: int, nonce_prefix: bytes, flags: int = 0,
+                version: int = VERSION) -> bytes:
+    return MAGIC + struct.pack('>BBI', version, flags, segment_size) + nonce_prefix
+
+
+def header_version(header: bytes) -> int:
+    return header[len(MAGIC)]
+
+
+def parse_header(header: bytes) -> tuple[int, int, bytes]:
+    """Returns (flags, segment_size, nonce_prefix) of a container header."""
+    if len(header) < HEADER_SIZE or not is_segmented(header):
+        raise ContainerError("Not a segmented container")
+    version, flags, segment_size = struct.unpack(
+        '>BBI', header[len(MAGIC):len(MAGIC) + 6])
+    if version not in (VERSION, COMPRESSED_VERSION):
+        raise ContainerError(f"Unsupported container version {version}")
+    if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+        raise ContainerError(f"Invalid segment size {segment_size}")
+    return flags, segment_size, header[HEADER_SIZE - NONCE_PREFIX_SIZE:HEADER_SIZE]
+
+
+def compressor(codec: int, level: int = None):
+    """Streaming compressor with compress(data) and flush() for `codec`."""
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level)
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    raise ContainerError(f"Unknown codec {codec}")
+
+
+def decompressor(codec: int):
+    """Streaming decompressor with decompress(data) and flush() for `codec`."""
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ContainerError(f"Unknown codec {codec}")
+
+
+def worth_compressing(sample: bytes, codec: int, level: int = None) -> bool:
+    """Whether `sample` shrinks by at least COMPRESSION_MIN_SAVING."""
+    if not sample:
+        return False
+    sample_compressor = compressor(codec, level)
+    size = len(sample_compressor.compress(sample)) + len(sample_compressor.flush())
+    return size <= len(sample) * (1 - COMPRESSION_MIN_SAVING)
+
+
+def encrypt_stream(src, dst, filename: str, key: bytes,
+                   segment_size: int = DEFAULT_SEGMENT_SIZE,
+                   codec: int = CODEC_NONE, level: int = None) -> int:
+    """
+    Encrypt the file object `src` into `dst` holding at most two segments in
+    memory. Returns the number of bytes written.
+
+    With a `codec` the data is compressed first, at `level` (the codec's
+    default if None), unless its first segment shows it is incompressible.
+    """
+    aesgcm = AESGCM(key)
+    nonce_prefix = secrets.token_bytes(NONCE_PREFIX_SIZE)
+
+    sample = src.read(segment_size)
+    if codec != CODEC_NONE and not worth_compressing(sample, codec, level):
+        codec = CODEC_NONE
+    chunks = _read_chunks(src, sample, segment_size)
+    if codec == CODEC_NONE:
+        header = pack_header(segment_size, nonce_prefix)
+        name = filename.encode()
+    else:
+        header = pack_header(segment_size, nonce_prefix,
+                             version=COMPRESSED_VERSION)
+        name = bytes([codec]) + filename.encode()
+        chunks = _compress_chunks(chunks, compressor(codec, level))
+
+    name_record = aesgcm.encrypt(_nonce(nonce_prefix, 0, False), name, header)
+    written = dst.write(header)
+    written += dst.write(struct.pack('>I', len(name_record)))
+    written += dst.write(name_record)
+
+    # look one segment ahead so the last one can be flagged
+    segments = _segments(chunks, segment_size)
+    counter = 1
+    chunk = next(segments)
+    while True:
+        next_chunk = next(segments, None)
+        last = next_chunk is None
+        written += dst.write(aesgcm.encrypt(
+            _nonce(nonce_prefix, counter, last), chunk, header))
+        if last:
+            return written
+        chunk = next_chunk
+        counter += 1
+
+
+def _read_chunks(src, first: bytes, size: int):
+    chunk = first
+    while chunk:
+        yield chunk
+        chunk = src.read(size)
+
+
+def _compress_chunks(chunks, chunk_compressor):
+    for chunk in chunks:
+        yield chunk_compressor.compress(chunk)
+    yield chunk_compressor.flush()
+
+
+def _segments(chunks, segment_size: int):
+    """
+    Cut `chunks` into segment_size pieces, the last one shorter and possibly
+    empty.
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) > segment_size:
+            yield bytes(buffer[:segment_size])
+            del buffer[:segment_size]
+    # a full last segment is only yielded once the input has ended, keeping
+    # empty trailing segments out of the container
+    yield bytes(buffer)
+
+
+class StreamDecryptor:
+    """
+    Incremental decryptor: `feed` ciphertext as it arrives and get plaintext
+    back segment by segment, then call `finish` once the input has ended.
+    `filename` is set as soon as the name record has been decrypted, as is
+    `codec`; compressed data is decompressed on the way out. `feed_chunks`
+    and `finish_chunks` return the plaintext as an iterator of pieces
+    instead, so memory stays bounded however far a segment decompresses.
+    Raises cryptography.exceptions.InvalidTag on a wrong key or tampering.
+    """
+
+    def __init__(self, key: bytes):
+        self._aesgcm = AESGCM(key)
+        self._buffer = bytearray()
+        self._counter = 1
+        self._decompressor = None
+        self.header = None
+        self.flags = 0
+        self.segment_size = None
+        self.name_length = None
+        self.filename = None
+        self.codec = CODEC_NONE
+
+    def feed(self, data: bytes) -> bytes:
+        return b''.join(self.feed_chunks(data))
+
+    def finish(self) -> bytes:
+        return b''.join(self.finish_chunks())
+
+    def feed_chunks(self, data: bytes):
+        """Like feed; consume the iterator before feeding more."""
+        self._buffer += data
+        if self.filename is None and not self._read_preamble():
+            return iter(())
+        return self._open_segments()
+
+    def finish_chunks(self):
+        if self.filename is None:
+            raise ContainerError("Container ended before its name record")
+        if len(self._buffer) < TAG_SIZE:
+            raise ContainerError("Container is truncated")
+        record = bytes(self._buffer)
+        self._buffer.clear()
+        return self._open_last(record)
+
+    def _open_segments(self):
+        # keep the trailing segment buffered until we know it is not the last
+        record_size = self.segment_size + TAG_SIZE
+        while len(self._buffer) > record_size:
+            record = bytes(self._buffer[:record_size])
+            del self._buffer[:record_size]
+            yield from self._open(record, False)
+
+    def _open_last(self, record: bytes):
+        yield from self._open(record, True)
+        if self._decompressor is not None:
+            yield self._decompressor.flush()
+
+    def _read_preamble(self) -> bool:
+        preamble_size = HEADER_SIZE + NAME_LENGTH_SIZE
+        if len(self._buffer) < preamble_size:
+            return False
+        name_length = struct.unpack(
+            '>I', self._buffer[HEADER_SIZE:preamble_size])[0]
+        if len(self._buffer) < preamble_size + name_length:
+            return False
+
+        header = bytes(self._buffer[:HEADER_SIZE])
+        self.flags, self.segment_size, self._nonce_prefix = parse_header(header)
+        self.header = header
+        self.name_length = name_length
+        name_record = bytes(
+            self._buffer[preamble_size:preamble_size + name_length])
+        name = self._aesgcm.decrypt(
+            _nonce(self._nonce_prefix, 0, False), name_record, header)
+        if header_version(header) == COMPRESSED_VERSION:
+            self.codec, name = name[0], name[1:]
+            self._decompressor = decompressor(self.codec)
+        self.filename = name.decode()
+        del self._buffer[:preamble_size + name_length]
+        return True
+
+    def _open(self, record: bytes, last: bool):
+        plaintext = self._aesgcm.decrypt(
+            _nonce(self._nonce_prefix, self._counter, last), record, self.header)
+        self._counter += 1
+        if self._decompressor is None:
+            yield plaintext
+            return
+        for start in range(0, len(plaintext), DECOMPRESS_SLICE):
+            piece = self._decompressor.decompress(
+                plaintext[start:start + DECOMPRESS_SLICE])
+            if piece:
+                yield piece
+
+
+def decrypt_bytes(data: bytes, key: bytes) -> tuple[str, bytes]:
+    decryptor = StreamDecryptor(key)
+    plaintext = decryptor.feed(data)
+    plaintext += decryptor.finish()
+    return decryptor.filename, plaintext
+
+
+class ContainerLayout:
+    """
+    Maps plaintext byte ranges to ciphertext byte ranges of a container of
+    `total_size` bytes, given its header and name record length. For
+    compressed containers the "plaintext" is the compressed stream.
+    """
+
+    def __init__(self, header: bytes, name_length: int, total_size: int):
+        self.header = header
+        self.flags, self.segment_size, self.nonce_prefix = parse_header(header)
+        self.data_offset = HEADER_SIZE + NAME_LENGTH_SIZE + name_length
+        data_size = total_size - self.data_offset
+        if data_size < TAG_SIZE:
+            raise ContainerError("Container is truncated")
+
+        record_size = self.segment_size + TAG_SIZE
+        self.segment_count = -(-data_size // record_size)
+        self.plaintext_size = data_size - self.segment_count * TAG_SIZE
+
+    def segments_for(self, start: int, end: int) -> tuple[int, int]:
+        """First and last segment index covering plaintext bytes start..end."""
+        return start // self.segment_size, end // self.segment_size
+
+    def ciphertext_range(self, first: int, last: int) -> tuple[int, int]:
+        """Inclusive ciphertext byte range holding segments first..last."""
+        record_size = self.segment_size + TAG_SIZE
+        start = self.data_offset + first * record_size
+        end = min(self.data_offset + (last + 1) * record_size,
+                  self.data_offset + self.plaintext_size
+                  + self.segment_count * TAG_SIZE)
+        return start, end - 1
+
+    def decrypt_segment(self, key: bytes, index: int, record: bytes) -> bytes:
+        return AESGCM(key).decrypt(
+            _nonce(self.nonce_prefix, index + 1,
+                   index == self.segment_count - 1),
+            record, self.header)
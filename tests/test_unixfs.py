@@ -0,0 +1,97 @@
+"""
+CIDBuilder against the CIDs `ipfs add` gives. check_pinned_cid trusts the
+builder, so a wrong CID here would flag every upload as mismatched.
+"""
+import os
+import pytest
+from unixfs import CHUNK_SIZE, MAX_LINKS, CIDBuilder, compute_cid
+
+DEMO_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'decryptionDemo')
+
+# ipfs add --only-hash, and --cid-version=1 (raw leaves)
+DEMO_CIDS = {
+    'MyCoolProof.txt': ('Qmbxf4F8zQLdhAqReUDp471g62AzcJ3xVGVG3tBec79CvH',
+                        'bafkreiciav47j77eme3ciyjfv7io6fqydskbhevh2wej7h2bp372s6yvry'),
+    'encrypt_and_hash.py': ('QmdaovXV1STtJKupeePRStCVvcb5hzkb2Kk74CuydQQjV1',
+                            'bafkreibheygxnewhvbforjd6qwfgr3tw7ttumzvxx7wu6dpabzevure5im'),
+    'encryptionKey.txt': ('Qmab4AEn1EYg6RkY7d7BE1UWfrTnPvGhba4hWNhme7WRGt',
+                          'bafkreicst2artakldslv4ydmcnubxabhxgnpjek7f7zugtnggvadxx7vlm'),
+    'test1.txt': ('QmYAYk14kyHzCtN7GB5EdbAGDyRxSWJseodzzEeRbFeLk3',
+                  'bafkreieuzglr4b5aacupm4u62aebwsgddedfxris3cw4jhujsojn2k7wli'),
+    'test2.txt': ('QmT791thQbD459uCQTTtVn4cZvSaZvwQawQ8FSoFAuqXL1',
+                  'bafkreibsvlfdncsuk6l7nggjiixgq2jorqcpzeibullut7sozeu4mcms7y'),
+    'test3.txt': ('QmVJgpZ8EfiX6L4DmWrB4XSX49RRiKeadfkJjGF82GKYq3',
+                  'bafkreickcpthqrz63wvdrflmkkqylvrytx6n6ybtrfl5xvfdyj5uqyx2bm'),
+    'test4.txt': ('QmU3g7GUFWEdnXmoVqCe46ni8vNgKeCoGuBrTkL3sPXyzw',
+                  'bafkreihznebffekrive6vpevwr2zj7gb75r2jp3prwa755fcjbtorqhmpe'),
+}
+
+# bytes 0..255 repeated, cut to the size
+PATTERN_CIDS = {
+    CHUNK_SIZE: ('QmST7dgog87n3RYz743DBMy6Z38VVF1432NLrwvqA4NJsE',
+                 'bafkreibdci4uxwmvixm54ey4etx3paphmwwbv3beh4xnsndvs6tzhjav5e'),
+    CHUNK_SIZE + 1: ('QmRZxDLdjSMPrpDsSJ4vucbwMSa6RogubGfDrt5g6w996b',
+                     'bafybeibp4affrl5svfd2wwp3l2srpu76awzmvyc37zmrtap5iqydfxffuy'),
+    600000: ('QmdrZnW2SewZs7tu4jjpJyoFtD7vFg8RE74L7EeA2yuxPB',
+             'bafybeigcsrlyo35x6t2m2zoobktxg4iuc4x5tots3przzug7tddwczujai'),
+    # a root of exactly MAX_LINKS leaves, and one more chunk for a second level
+    MAX_LINKS * CHUNK_SIZE: ('QmYF6BNvuvMXVnBY9ofeyTgC39qXcBufyzWek6BYEFnode',
+                             'bafybeic6aphmw3ff6rusfv3xkhvt5hr5qukkef4uybaq2kr4gfurjdadwi'),
+    MAX_LINKS * CHUNK_SIZE + 1: ('QmZXcrPgxjJduiNd6Rx4oUXLiqBmpgKxLGSZpyPXuegcib',
+                                 'bafybeifesat4tfkoyjquv3u4ptxx43lfa3xewmq4wlbn6gmosvp7ov6nfy'),
+}
+
+
+def pattern(size: int) -> bytes:
+    return (bytes(range(256)) * (size // 256 + 1))[:size]
+
+
+def test_empty_file():
+    assert compute_cid(b'') == 'QmbFMke1KXqnYyBBWxB74N4c5SBnJMVAiMNRcGu6x1AwQH'
+    assert compute_cid(b'', cid_version=1) == \
+        'bafkreihdwdcefgh4dqkjv67uzcmw7ojee6xedzdetojuzjevtenxquvyku'
+
+
+def test_hello_world():
+    assert compute_cid(b'hello world\n') == \
+        'QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o'
+    assert compute_cid(b'hello world\n', cid_version=1) == \
+        'bafkreifjjcie6lypi6ny7amxnfftagclbuxndqonfipmb64f2km2devei4'
+
+
+@pytest.mark.parametrize('name', sorted(DEMO_CIDS))
+def test_demo_files(name):
+    with open(os.path.join(DEMO_DIR, name), 'rb') as file:
+        data = file.read()
+    assert (compute_cid(data), compute_cid(data, cid_version=1)) == DEMO_CIDS[name]
+
+
+def test_every_demo_file_is_covered():
+    files = {name for name in os.listdir(DEMO_DIR)
+             if os.path.isfile(os.path.join(DEMO_DIR, name))}
+    assert files == set(DEMO_CIDS)
+
+
+@pytest.mark.parametrize('size', sorted(PATTERN_CIDS))
+def test_multi_chunk(size):
+    data = pattern(size)
+    assert (compute_cid(data), compute_cid(data, cid_version=1)) == PATTERN_CIDS[size]
+
+
+@pytest.mark.parametrize('cid_version', [0, 1])
+def test_incremental_updates(cid_version):
+    # pieces that don't line up with chunks give the same CID
+    data = pattern(600000)
+    builder = CIDBuilder(cid_version)
+    for start in range(0, len(data), 100003):
+        builder.update(data[start:start + 100003])
+    assert builder.cid() == PATTERN_CIDS[600000][cid_version]
+
+
+def test_update_after_cid():
+    builder = CIDBuilder()
+    builder.update(b'data')
+    builder.cid()
+    with pytest.raises(ValueError):
+        builder.update(b'more')
@@ -0,0 +1,173 @@
+import base64
+import hashlib
+
+# defaults of `ipfs add`, which Pinata's pinFileToIPFS uses
+CHUNK_SIZE = 256 * 1024
+MAX_LINKS = 174
+
+UNIXFS_FILE = 2
+CODEC_RAW = 0x55
+CODEC_DAG_PB = 0x70
+SHA2_256 = 0x12
+
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+
+class CIDBuilder:
+    """
+    Computes the CID `ipfs add` gives a file, fed incrementally with
+    `update` like a hashlib object.
+
+    Builds the same DAG as the default importer: 256 KiB chunks under a
+    balanced tree of dag-pb UnixFS nodes with at most 174 links each.
+    CIDv0 keeps the chunks in UnixFS leaf nodes, CIDv1 stores them as raw
+    blocks (`--cid-version=1` implies `--raw-leaves`). Only block hashes are
+    kept, never the blocks themselves.
+    """
+
+    def __init__(self, cid_version: int = 0, chunk_size: int = CHUNK_SIZE,
+                 max_links: int = MAX_LINKS):
+        if cid_version not in (0, 1):
+            raise ValueError("cid_version must be 0 or 1")
+        self.cid_version = cid_version
+        self.chunk_size = chunk_size
+        self.max_links = max_links
+        self._buffer = bytearray()
+        self._chunks = 0
+        # links waiting for a parent, per tree level: (cid, tsize, filesize)
+        self._levels = [[]]
+        self._cid = None
+
+    def update(self, data: bytes):
+        if self._cid is not None:
+            raise ValueError("update() after cid()")
+        self._buffer += data
+        while len(self._buffer) > self.chunk_size:
+            # keep a full last chunk buffered, a single chunk file is its
+            # own root instead of a leaf
+            self._add_leaf(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+
+    def cid(self) -> str:
+        if self._cid is None:
+            if self._buffer or not self._chunks:
+                self._add_leaf(bytes(self._buffer))
+                self._buffer.clear()
+            self._cid = _encode_cid(self._root(), self.cid_version)
+        return self._cid
+
+    def _add_leaf(self, chunk: bytes):
+        self._chunks += 1
+        if self.cid_version == 1:
+            block, codec = chunk, CODEC_RAW
+        else:
+            block, codec = _pb_node([], _unixfs_data(
+                chunk if chunk else None, len(chunk))), CODEC_DAG_PB
+        self._push(0, (_cid_bytes(block, codec, self.cid_version),
+                       len(block), len(chunk)))
+
+    def _push(self, level: int, link):
+        self._levels[level].append(link)
+        if len(self._levels[level]) == self.max_links:
+            # a full node never changes again
+            self._push_parent(level)
+
+    def _push_parent(self, level: int):
+        if level + 1 == len(self._levels):
+            self._levels.append([])
+        self._push(level + 1, self._node(self._levels[level]))
+        self._levels[level] = []
+
+    def _node(self, links):
+        filesize = sum(link[2] for link in links)
+        block = _pb_node(links, _unixfs_data(
+            None, filesize, [link[2] for link in links]))
+        return (_cid_bytes(block, CODEC_DAG_PB, self.cid_version),
+                len(block) + sum(link[1] for link in links), filesize)
+
+    def _root(self) -> bytes:
+        level = 0
+        while True:
+            links = self._levels[level]
+            if len(links) == 1 and not any(self._levels[level + 1:]):
+                return links[0][0]
+            if links:
+                self._push_parent(level)
+            level += 1
+
+
+def compute_cid(data: bytes, cid_version: int = 0) -> str:
+    builder = CIDBuilder(cid_version)
+    builder.update(data)
+    return builder.cid()
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number: int, value: bytes) -> bytes:
+    """A length delimited protobuf field."""
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _uint_field(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value)
+
+
+def _unixfs_data(data, filesize: int, blocksizes=()) -> bytes:
+    out = _uint_field(1, UNIXFS_FILE)
+    if data is not None:
+        out += _field(2, data)
+    out += _uint_field(3, filesize)
+    for blocksize in blocksizes:
+        out += _uint_field(4, blocksize)
+    return out
+
+
+def _pb_node(links, data: bytes) -> bytes:
+    # dag-pb puts Links (field 2) before Data (field 1), the importer
+    # always writes an empty link Name
+    out = b''.join(
+        _field(2, _field(1, cid) + _field(2, b'') + _uint_field(3, tsize))
+        for cid, tsize, _ in links)
+    return out + _field(1, data)
+
+
+def _cid_bytes(block: bytes, codec: int, cid_version: int) -> bytes:
+    multihash = bytes([SHA2_256, 32]) + hashlib.sha256(block).digest()
+    if cid_version == 0:
+        return multihash
+    return _varint(1) + _varint(codec) + multihash
+
+
+def _encode_cid(cid: bytes, cid_version: int) -> str:
+    if cid_version == 0:
+        return _base58(cid)
+    return 'b' + base64.b32encode(cid).decode().lower().rstrip('=')
+
+
+def _base58(data: bytes) -> str:
+    number = int.from_bytes(data, 'big')
+    out = ''
+    while number:
+        number, remainder = divmod(number, 58)
+        out = BASE58_ALPHABET[remainder] + out
+    zeros = len(data) - len(data.lstrip(b'\0'))
+    return BASE58_ALPHABET[0] * zeros + out
+
+
+if __name__ == "__main__":
+    # prints what `ipfs add --only-hash` would, e.g. python unixfs.py *.txt
+    import sys
+    for path in sys.argv[1:]:
+        builder = CIDBuilder()
+        with open(path, 'rb') as file:
+            while chunk := file.read(CHUNK_SIZE):
+                builder.update(chunk)
+        print(f"{builder.cid()} {path}")